@@ -0,0 +1,202 @@
+import random
+import sqlite3
+from datetime import datetime, timedelta, timezone
+
+DOMAINS = [
+    'www.google.com', 'www.youtube.com', 'github.com', 'stackoverflow.com', 'www.reddit.com',
+    'en.wikipedia.org', 'news.ycombinator.com', 'www.bbc.co.uk', 'mail.google.com', 'docs.python.org',
+    'www.amazon.com', 'twitter.com', 'www.linkedin.com', 'medium.com', 'www.nytimes.com',
+    'foo.github.io', 'www.netflix.com', 'drive.google.com', 'www.twitch.tv', 'arxiv.org',
+]
+MIMES = ['application/pdf', 'image/png', 'image/jpeg', 'application/zip', 'text/csv',
+         'application/octet-stream', 'video/mp4']
+DANGERS = ['safe', 'safe', 'safe', 'file', 'url', 'uncommon']
+STATUSES = ['complete', 'complete', 'complete', 'interrupted']
+SUBREDDITS = ['python', 'django', 'MachineLearning', 'programming', 'datascience', 'aww',
+              'science', 'worldnews', 'AskReddit', 'learnpython']
+WORDS = ('data query index vector cache batch stream python mongo chart search embedding '
+         'latency memory throughput ingest browser history bookmark download reddit').split()
+
+# Visits follow a Zipf-like popularity over domains, like real browsing.
+WEIGHTS = [1 / (rank + 1) for rank in range(len(DOMAINS))]
+
+
+def identity(index=0):
+    return {'email': f'user{index}@example.com', 'id': str(100000 + index)}
+
+
+def title(rng, words=4):
+    return ' '.join(rng.choice(WORDS) for _ in range(words)).capitalize()
+
+
+def nowMillis():
+    return int(datetime.now(timezone.utc).timestamp() * 1000)
+
+
+def historyItems(count, seed=0, days=30, now=None):
+    rng = random.Random(seed)
+    now = now or nowMillis()
+    for index in range(count):
+        domain = rng.choices(DOMAINS, WEIGHTS)[0]
+        yield {
+            'id': str(index),
+            'url': f'https://{domain}/{rng.choice(WORDS)}/{rng.randrange(10 * count + 1)}',
+            'title': title(rng),
+            'lastVisitTime': now - rng.random() * days * 86400000,
+            'visitCount': rng.randint(1, 50),
+            'typedCount': rng.randint(0, 3),
+        }
+
+
+def historyPayload(count, seed=0, user=0):
+    return {
+        'routine': 'periodicHistory',
+        'data': {'history': list(historyItems(count, seed)), 'recordedAt': nowMillis(),
+                 'identity': identity(user)},
+    }
+
+
+def bookmarkTree(count, seed=0, fanout=20, days=200, now=None):
+    # A chrome.bookmarks.getTree() result with `count` bookmarks spread over
+    # nested folders of at most `fanout` children each.
+    rng = random.Random(seed)
+    now = now or nowMillis()
+    root = {'id': '0', 'title': '', 'children': []}
+    folders = [root]
+    nextId = 1
+    for index in range(count):
+        parent = rng.choice(folders)
+        while len(parent['children']) >= fanout:
+            folder = {'id': str(nextId), 'parentId': parent['id'], 'title': title(rng, 2),
+                      'dateAdded': now, 'children': []}
+            nextId += 1
+            parent['children'].append(folder)
+            folders.append(folder)
+            parent = folder
+        domain = rng.choices(DOMAINS, WEIGHTS)[0]
+        parent['children'].append({
+            'id': str(nextId), 'parentId': parent['id'], 'index': len(parent['children']),
+            'title': title(rng), 'url': f'https://{domain}/{index}',
+            'dateAdded': now - rng.random() * days * 86400000,
+        })
+        nextId += 1
+    return [root]
+
+
+def bookmarksPayload(count, seed=0, user=0):
+    return {
+        'routine': 'periodicBookmarks',
+        'data': {'bookmarks': bookmarkTree(count, seed), 'recordedAt': nowMillis(),
+                 'identity': identity(user)},
+    }
+
+
+def downloadItems(count, seed=0, days=30, user=0):
+    rng = random.Random(seed)
+    now = datetime.now(timezone.utc)
+    for index in range(count):
+        end = now - timedelta(seconds=rng.random() * days * 86400)
+        domain = rng.choices(DOMAINS, WEIGHTS)[0]
+        yield {
+            'id': index,
+            'startTime': (end - timedelta(seconds=rng.randint(1, 600))).isoformat().replace('+00:00', 'Z'),
+            'totalBytes': rng.randint(1000, 10 ** 9),
+            'receivedBytes': 0,
+            'identity': identity(user),
+            'mime': rng.choice(MIMES),
+            'danger': rng.choice(DANGERS),
+            'url': f'https://{domain}/files/{index}',
+            'incognito': False,
+            'referrer': f'https://{rng.choices(DOMAINS, WEIGHTS)[0]}/',
+            'endTime': end.isoformat(timespec='milliseconds').replace('+00:00', 'Z'),
+            'status': rng.choice(STATUSES),
+        }
+
+
+# The tables of a Chrome History SQLite file read by import_chrome_history.
+HISTORY_SCHEMA = '''
+    CREATE TABLE urls (id INTEGER PRIMARY KEY AUTOINCREMENT, url LONGVARCHAR, title LONGVARCHAR,
+                       visit_count INTEGER DEFAULT 0 NOT NULL, typed_count INTEGER DEFAULT 0 NOT NULL,
+                       last_visit_time INTEGER NOT NULL, hidden INTEGER DEFAULT 0 NOT NULL);
+    CREATE TABLE visits (id INTEGER PRIMARY KEY, url INTEGER NOT NULL, visit_time INTEGER NOT NULL,
+                         from_visit INTEGER, transition INTEGER DEFAULT 0 NOT NULL,
+                         segment_id INTEGER, visit_duration INTEGER DEFAULT 0 NOT NULL);
+    CREATE TABLE downloads (id INTEGER PRIMARY KEY, guid VARCHAR NOT NULL, current_path LONGVARCHAR NOT NULL,
+                            target_path LONGVARCHAR NOT NULL, start_time INTEGER NOT NULL,
+                            received_bytes INTEGER NOT NULL, total_bytes INTEGER NOT NULL,
+                            state INTEGER NOT NULL, danger_type INTEGER NOT NULL,
+                            interrupt_reason INTEGER NOT NULL, end_time INTEGER NOT NULL,
+                            opened INTEGER NOT NULL, referrer VARCHAR NOT NULL,
+                            mime_type VARCHAR(255) NOT NULL, original_mime_type VARCHAR(255) NOT NULL);
+    CREATE TABLE downloads_url_chains (id INTEGER NOT NULL, chain_index INTEGER NOT NULL,
+                                       url LONGVARCHAR NOT NULL, PRIMARY KEY (id, chain_index));
+'''
+
+
+def webkitTime(moment):
+    return int((moment - datetime(1601, 1, 1, tzinfo=timezone.utc)).total_seconds() * 1000000)
+
+
+def chromeHistoryFile(path, visits, downloads=0, seed=0, days=365):
+    # Writes a Chrome History database with `visits` visits over about
+    # visits / 5 URLs (a few of them hidden or subframe loads) and
+    # `downloads` downloads, spread over the last `days` days.
+    rng = random.Random(seed)
+    now = datetime.now(timezone.utc)
+    connection = sqlite3.connect(path)
+    connection.executescript(HISTORY_SCHEMA)
+    urlCount = max(visits // 5, 1)
+    lastVisits = [0] * urlCount
+    counts = [0] * urlCount
+    rows = []
+    for index in range(visits):
+        urlId = rng.randrange(urlCount)
+        visitTime = webkitTime(now - timedelta(seconds=rng.random() * days * 86400))
+        lastVisits[urlId] = max(lastVisits[urlId], visitTime)
+        counts[urlId] += 1
+        transition = 3 if rng.random() < 0.05 else rng.choice([0, 1, 805306368])
+        rows.append((index + 1, urlId + 1, visitTime, transition))
+    connection.executemany('INSERT INTO visits (id, url, visit_time, transition) VALUES (?, ?, ?, ?)', rows)
+    connection.executemany(
+        'INSERT INTO urls (id, url, title, visit_count, typed_count, last_visit_time, hidden) '
+        'VALUES (?, ?, ?, ?, ?, ?, ?)',
+        ((urlId + 1, f'https://{rng.choices(DOMAINS, WEIGHTS)[0]}/{rng.choice(WORDS)}/{urlId}',
+          title(rng), counts[urlId], rng.randint(0, 3), lastVisits[urlId], int(rng.random() < 0.02))
+         for urlId in range(urlCount)))
+    for index, item in enumerate(downloadItems(downloads, seed), start=1):
+        end = datetime.fromisoformat(item['endTime'].replace('Z', '+00:00'))
+        start = datetime.fromisoformat(item['startTime'].replace('Z', '+00:00'))
+        connection.execute(
+            'INSERT INTO downloads VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (index, f'guid-{index}', f'/tmp/file{index}', f'/tmp/file{index}', webkitTime(start),
+             item['totalBytes'], item['totalBytes'], 1 if item['status'] == 'complete' else 4,
+             ['safe', 'file', 'url', 'content', 'content', 'uncommon'].index(item['danger']), 0,
+             webkitTime(end), 0, item['referrer'], item['mime'], item['mime']))
+        connection.execute('INSERT INTO downloads_url_chains VALUES (?, 0, ?)', (index, item['url']))
+    connection.commit()
+    connection.close()
+    return path
+
+
+def redditPosts(count, seed=0):
+    rng = random.Random(seed)
+    for index in range(count):
+        subreddit = rng.choice(SUBREDDITS)
+        yield {'kind': 't3', 'data': {
+            'thumbnail': 'self', 'url': f'https://www.reddit.com/r/{subreddit}/comments/{index:x}/',
+            'title': title(rng, 8), 'subreddit': subreddit, 'subreddit_type': 'public',
+            'author': f'author{rng.randrange(1000)}', 'upvote_ratio': round(rng.random(), 2),
+            'ups': rng.randrange(10000), 'downs': 0, 'score': rng.randrange(10000),
+            'created': 1.6e9 + index, 'num_comments': rng.randrange(500),
+            'subreddit_subscribers': rng.randrange(10 ** 7), 'over_18': False, 'is_video': False,
+        }}
+
+
+def redditListingPages(count, seed=0, pageSize=100):
+    # Listing pages as /user/<name>/<listing> returns them, chained by 'after'.
+    posts = list(redditPosts(count, seed))
+    pages = []
+    for start in range(0, max(count, 1), pageSize):
+        after = f't3_{start + pageSize}' if start + pageSize < count else None
+        pages.append({'kind': 'Listing', 'data': {'after': after, 'children': posts[start:start + pageSize]}})
+    return pages
@@ -0,0 +1,271 @@
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import tempfile
+import statistics
+import subprocess
+from datetime import datetime, timezone
+
+from benchmarks import generate, stubs
+
+USERNAME = 'benchmark-user'
+DOWNLOAD_LIMIT = 5000
+
+
+def gitCommit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def configure(args):
+    # Everything that talks to the outside world is replaced before Django
+    # (and with it every views module) is imported.
+    os.environ['MONGO_DB_NAME'] = stubs.useMongo(args.mongo)
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'personalized_webapp.settings')
+    os.environ.setdefault('SECRET_KEY', 'benchmark')
+    os.environ['EMBEDDING_PROVIDER'] = 'langchainbot.embeddings.FakeEmbedder'
+    os.environ['EMBEDDING_CACHE_PATH'] = ''
+    os.environ['VECTOR_SEARCH_ENGINE'] = 'local'
+    os.environ['VECTOR_INDEX_DIR'] = tempfile.mkdtemp(prefix='vectorindex-')
+    os.environ['DASHBOARD_WARM_CACHE'] = 'False'
+    os.environ['WRITE_BEHIND'] = str(args.write_behind)
+    os.environ['WRITE_BEHIND_SPILL_DIR'] = ''
+    os.environ['CHROME_STORAGE'] = args.storage
+    import django
+    django.setup()
+
+
+def post(view, payload):
+    from django.test import RequestFactory
+    request = RequestFactory().post('/', data=json.dumps(payload), content_type='application/json')
+    return view(request)
+
+
+def drain():
+    # Ingest timings include the write-behind flush, so they measure stored
+    # documents rather than queued ones.
+    from personalized_webapp.writebehind import getWriteBehind
+    getWriteBehind().flush()
+
+
+def resetDatabase(name):
+    from personalized_webapp.mongo import getClient
+    getClient().drop_database(name)
+
+
+def benchExtractLeafNodes(scale):
+    from chromepipeline.views import extract_leaf_nodes
+    tree = generate.bookmarkTree(scale)
+    return lambda repeat: extract_leaf_nodes(tree), scale
+
+
+def benchRecentHistory(scale):
+    import pandas as pd
+    from visualization.views import getRecentHistoryData
+    frame = pd.DataFrame(list(generate.historyItems(scale)))
+    return lambda repeat: getRecentHistoryData(frame.copy()), scale
+
+
+def benchBookmarksActivity(scale):
+    import pandas as pd
+    from chromepipeline.bookmarks import isLeaf
+    from visualization.views import bookMarksActivity
+    stack = generate.bookmarkTree(scale)
+    leaves = []
+    while stack:
+        node = stack.pop()
+        if isLeaf(node):
+            leaves.append(node)
+        stack.extend(node.get('children', []))
+    frame = pd.DataFrame(leaves)
+    return lambda repeat: bookMarksActivity(frame.copy()), scale
+
+
+def benchIngestHistory(scale):
+    from chromepipeline.views import routines
+    resetDatabase('userChromeData')
+    # Each repeat uploads a fresh sample; the natural key includes
+    # lastVisitTime so nothing is deduplicated away.
+
+    def run(repeat):
+        post(routines, generate.historyPayload(scale, seed=repeat))
+        drain()
+    return run, scale
+
+
+def benchIngestBookmarks(scale):
+    from chromepipeline.views import routines
+    resetDatabase('userChromeData')
+    return lambda repeat: post(routines, generate.bookmarksPayload(scale, seed=repeat)), scale
+
+
+def benchIngestDownloads(scale):
+    from chromepipeline.views import downloads
+    resetDatabase('userChromeData')
+    count = min(scale, DOWNLOAD_LIMIT)
+
+    def run(repeat):
+        for download in generate.downloadItems(count, seed=repeat):
+            post(downloads, {'download': download})
+        drain()
+    return run, count
+
+
+def benchImportHistory(scale):
+    # import_chrome_history on a generated History file of `scale` visits;
+    # every repeat imports it for a new identity, so all of it is written.
+    from chromepipeline.management.commands.import_chrome_history import importFile
+    resetDatabase('userChromeData')
+    directory = tempfile.mkdtemp(prefix='chrome-history-')
+    path = generate.chromeHistoryFile(os.path.join(directory, 'History'), scale,
+                                      downloads=min(scale // 10, DOWNLOAD_LIMIT))
+    options = {'history': 'visits', 'batch_size': 5000, 'checkpoint_dir': directory, 'restart': True}
+    return lambda repeat: importFile(path, generate.identity(repeat), options), scale
+
+
+def seedChromeData(scale):
+    from chromepipeline.views import downloads, routines
+    from personalized_webapp.mongo import getDatabase
+    from visualization.rollups import markBuilt
+    resetDatabase('userChromeData')
+    post(routines, generate.historyPayload(scale))
+    post(routines, generate.bookmarksPayload(scale))
+    for download in generate.downloadItems(min(scale, DOWNLOAD_LIMIT)):
+        post(downloads, {'download': download})
+    drain()
+    # Every event went through the ingest endpoints into an empty database,
+    # so the rollups are already complete.
+    markBuilt(getDatabase('userChromeData'))
+
+
+def renderBenchmark(source):
+    def bench(scale):
+        from django.conf import settings
+        from django.test import RequestFactory
+        from visualization import cache
+        from visualization.views import chart_view
+        seedChromeData(scale)
+        settings.DASHBOARD_SOURCE = source
+
+        def run(repeat):
+            # A cold render: the cached dashboard would otherwise answer.
+            cache.dashboardCache().clear()
+            chart_view(RequestFactory().get('/visual/'))
+        return run, scale
+    return bench
+
+
+def benchRedditProcessing(scale):
+    from redditInfo.views import redditProcessing
+    resetDatabase('redditData')
+    payload = {'username': USERNAME, 'password': 'benchmark', 'paginate': True,
+               'listings': ['upvoted']}
+    return lambda repeat: post(redditProcessing, payload), scale
+
+
+def redditQueryBenchmark(cached):
+    def bench(scale):
+        from django.core.management import call_command
+        from redditInfo.views import redditProcessing
+        from langchainbot.views import redditQuery
+        resetDatabase('redditData')
+        post(redditProcessing, {'username': USERNAME, 'password': 'benchmark', 'paginate': True,
+                                'listings': ['upvoted']})
+        call_command('embed_reddit', username=USERNAME, stdout=open(os.devnull, 'w'))
+
+        def payload(repeat):
+            # A new query per repeat misses the search cache; the cached
+            # variant repeats the warm-up query.
+            query = 'python data latency' if cached else f'python data latency {repeat}'
+            return {'username': USERNAME, 'password': 'benchmark', 'query': query, 'numposts': 10}
+
+        # The first query builds the user's index partition; time the steady state.
+        post(redditQuery, payload('warmup'))
+        return lambda repeat: post(redditQuery, payload(repeat)), scale
+    return bench
+
+
+BENCHMARKS = {
+    'extract_leaf_nodes': benchExtractLeafNodes,
+    'recent_history': benchRecentHistory,
+    'bookmarks_activity': benchBookmarksActivity,
+    'ingest_history': benchIngestHistory,
+    'ingest_bookmarks': benchIngestBookmarks,
+    'ingest_downloads': benchIngestDownloads,
+    'import_history': benchImportHistory,
+    'render_rollups': renderBenchmark('rollups'),
+    'render_raw': renderBenchmark('raw'),
+    'reddit_processing': benchRedditProcessing,
+    'reddit_query': redditQueryBenchmark(cached=False),
+    'reddit_query_cached': redditQueryBenchmark(cached=True),
+}
+
+
+def measure(name, scale, repeats, mongo):
+    from django.conf import settings
+    run, records = BENCHMARKS[name](scale)
+    seconds = []
+    for repeat in range(repeats):
+        start = time.perf_counter()
+        run(repeat)
+        seconds.append(time.perf_counter() - start)
+    median = statistics.median(seconds)
+    return {
+        'benchmark': name,
+        'scale': scale,
+        'records': records,
+        'seconds': seconds,
+        'median': median,
+        'min': min(seconds),
+        'recordsPerSecond': records / median if median else None,
+        'mongo': mongo,
+        'writeBehind': settings.WRITE_BEHIND,
+        'chromeStorage': settings.CHROME_STORAGE,
+        'commit': gitCommit(),
+        'python': platform.python_version(),
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the ingest and dashboard hot paths '
+                                     'on synthetic data.')
+    parser.add_argument('--scale', type=int, nargs='+', default=[1000],
+                        help='Number of records per benchmark, e.g. 1000 100000 1000000.')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--only', nargs='+', choices=sorted(BENCHMARKS), default=list(BENCHMARKS))
+    parser.add_argument('--mongo', default='mongomock',
+                        help="'mongomock' for an in-memory stand-in, or a MongoDB URI.")
+    parser.add_argument('--write-behind', action='store_true',
+                        help='Ingest through the write-behind buffer (WRITE_BEHIND=True).')
+    parser.add_argument('--storage', choices=['single', 'monthly'], default='single',
+                        help='Store Chrome events in one collection or per month (CHROME_STORAGE).')
+    parser.add_argument('--output', help='Append JSON lines here instead of stdout.')
+    args = parser.parse_args(argv)
+    configure(args)
+
+    from django.conf import settings
+    output = open(args.output, 'a') if args.output else sys.stdout
+    try:
+        with stubs.FakeReddit([]) as reddit:
+            settings.REDDIT_BASE_URL = reddit.url + '/'
+            settings.REDDIT_OAUTH_URL = reddit.url
+            for scale in args.scale:
+                reddit.pages = generate.redditListingPages(scale)
+                for name in args.only:
+                    result = measure(name, scale, args.repeat, args.mongo)
+                    output.write(json.dumps(result) + '\n')
+                    output.flush()
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+
+def useMongo(uri):
+    # 'mongomock' swaps pymongo.MongoClient for one shared in-memory client;
+    # anything else is used as the URI of a real (local) mongod.
+    if uri != 'mongomock':
+        return uri
+    import bson
+    import mongomock
+    import pymongo
+    from mongomock.collection import Collection
+
+    client = mongomock.MongoClient()
+
+    def aggregateRawBatches(self, pipeline, batchSize=1000, **kwargs):
+        # mongomock has no raw batch cursors; encode the results the same way.
+        documents = list(self.aggregate(pipeline))
+        for start in range(0, len(documents), batchSize):
+            yield b''.join(bson.encode(document) for document in documents[start:start + batchSize])
+
+    Collection.aggregate_raw_batches = aggregateRawBatches
+    pymongo.MongoClient = lambda *args, **kwargs: client
+    return 'mongodb://mongomock'
+
+
+class FakeReddit:
+    # Serves the password grant and paginated /user/<name>/<listing> pages
+    # from generated data, on an ephemeral localhost port.
+
+    def __init__(self, pages, pageSize=100):
+        self.pages = pages
+        self.pageSize = pageSize
+        self.requests = 0
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                stub.requests += 1
+                self.reply({'access_token': 'benchmark-token', 'token_type': 'bearer', 'expires_in': 3600})
+
+            def do_GET(self):
+                stub.requests += 1
+                after = parse_qs(urlsplit(self.path).query).get('after', [None])[0]
+                # 'after' is t3_<offset> as produced by redditListingPages.
+                index = int(after.split('_')[1]) // stub.pageSize if after else 0
+                self.reply(stub.pages[index])
+
+            def reply(self, payload):
+                body = json.dumps(payload).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server.server_port}'
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,270 @@
+import hashlib
+import threading
+import pymongo
+from datetime import datetime, timezone
+from chromepipeline.domains import annotate
+from chromepipeline.stream import RetryLater
+from personalized_webapp import partitions
+
+# Per identity, the folder hashes of the last synced tree; its leaves are
+# stored one document per identity and bookmark id in bookmarkLeaves, so a
+# large tree never approaches MongoDB's 16 MB document limit.
+SNAPSHOTS = 'bookmarkSnapshots'
+LEAVES = 'bookmarkLeaves'
+# Bookmark ids per $in query when loading leaves.
+LEAF_QUERY_BATCH = 10000
+# Nodes of streamed bookmark uploads that have not completed yet; abandoned
+# uploads expire after UPLOAD_TTL seconds.
+UPLOADS = 'bookmarkUploads'
+UPLOAD_TTL = 24 * 3600
+
+_uploadsIndexed = False
+_uploadsIndexedLock = threading.Lock()
+_leavesIndexed = False
+_leavesIndexedLock = threading.Lock()
+
+
+class IncompleteUpload(RetryLater):
+    pass
+
+
+def isLeaf(node):
+    return 'url' in node
+
+
+def leafEntry(node):
+    return {
+        'parentId': node.get('parentId'),
+        'url': node['url'],
+        'title': node.get('title', ''),
+        'dateAdded': node.get('dateAdded'),
+    }
+
+
+def hashFolders(roots):
+    # Merkle-style hashes for every folder, computed with an explicit stack
+    # (post-order) so arbitrarily deep trees never hit the recursion limit.
+    hashes = {}
+    folders = {}
+    stack = [(node, False) for node in reversed(roots) if not isLeaf(node)]
+    while stack:
+        node, expanded = stack.pop()
+        children = node.get('children', [])
+        if not expanded:
+            folders[node['id']] = node
+            stack.append((node, True))
+            stack.extend((child, False) for child in reversed(children) if not isLeaf(child))
+            continue
+        digest = hashlib.sha1(node.get('title', '').encode('utf-8'))
+        for child in children:
+            if isLeaf(child):
+                entry = leafEntry(child)
+                digest.update(f"\x00L{child['id']}\x01{entry['url']}\x01{entry['title']}\x01{entry['dateAdded']}".encode('utf-8'))
+            else:
+                digest.update(f"\x00F{child['id']}\x01{hashes[child['id']]}".encode('utf-8'))
+        hashes[node['id']] = digest.hexdigest()
+    return hashes, folders
+
+
+def diffTree(roots, snapshot, loadLeaves):
+    # loadLeaves(folderIds, leafIds) returns the previous leaves {id: entry}
+    # that were in those folders or have those ids.
+    previousFolders = snapshot.get('folders', {})
+    hashes, folders = hashFolders(roots)
+
+    # Walk top-down, descending only into folders whose hash changed.
+    changedFolders = set()
+    currentLeaves = {}
+    stack = [node for node in roots if not isLeaf(node)]
+    while stack:
+        node = stack.pop()
+        if previousFolders.get(node['id']) == hashes[node['id']]:
+            continue
+        changedFolders.add(node['id'])
+        for child in node.get('children', []):
+            if isLeaf(child):
+                currentLeaves[child['id']] = leafEntry(child)
+            else:
+                stack.append(child)
+
+    removedFolders = set(previousFolders) - set(hashes)
+    touched = changedFolders | removedFolders
+    previousLeaves = loadLeaves(touched, currentLeaves)
+    added, removed = {}, {}
+    for leafId, entry in currentLeaves.items():
+        previous = previousLeaves.get(leafId)
+        if previous != entry:
+            added[leafId] = entry
+            if previous is not None:
+                removed[leafId] = previous
+    for leafId, previous in previousLeaves.items():
+        if previous['parentId'] in touched and leafId not in currentLeaves:
+            removed[leafId] = previous
+
+    return {
+        'folders': {folderId: hashes[folderId] for folderId in changedFolders},
+        'removedFolders': removedFolders,
+        'added': added,
+        'removed': removed,
+    }
+
+
+def bookmarkDocument(entry, identity):
+    return annotate({
+        'title': entry['title'],
+        'url': entry['url'],
+        'dateAdded': entry['dateAdded'],
+        'identity': identity,
+    })
+
+
+def ensureLeafIndexes(db):
+    global _leavesIndexed
+    with _leavesIndexedLock:
+        if _leavesIndexed:
+            return
+        db[LEAVES].create_index([('identity', pymongo.ASCENDING), ('leafId', pymongo.ASCENDING)],
+                                unique=True, name='identity_leaf')
+        db[LEAVES].create_index([('identity', pymongo.ASCENDING), ('parentId', pymongo.ASCENDING)],
+                                name='identity_parent')
+        _leavesIndexed = True
+
+
+def loadLeaves(db, identity, folderIds, leafIds):
+    ensureLeafIndexes(db)
+    projection = {'_id': 0, 'identity': 0}
+    queries = [{'identity': identity, 'parentId': {'$in': list(folderIds)}}] if folderIds else []
+    leafIds = list(leafIds)
+    for start in range(0, len(leafIds), LEAF_QUERY_BATCH):
+        queries.append({'identity': identity, 'leafId': {'$in': leafIds[start:start + LEAF_QUERY_BATCH]}})
+    leaves = {}
+    for query in queries:
+        for document in db[LEAVES].find(query, projection):
+            leaves[document.pop('leafId')] = document
+    return leaves
+
+
+def storeLeaves(db, identity, added, removed):
+    ensureLeafIndexes(db)
+    operations = [
+        pymongo.ReplaceOne({'identity': identity, 'leafId': leafId},
+                           dict(entry, identity=identity, leafId=leafId), upsert=True)
+        for leafId, entry in added.items()]
+    operations.extend(pymongo.DeleteOne({'identity': identity, 'leafId': leafId})
+                      for leafId in removed if leafId not in added)
+    if operations:
+        db[LEAVES].bulk_write(operations, ordered=False)
+
+
+def moveSnapshotLeaves(db, identity, leaves):
+    # Snapshots written before bookmarkLeaves existed embed the leaves.
+    storeLeaves(db, identity, leaves, {})
+    db[SNAPSHOTS].update_one({'identity': identity}, {'$unset': {'leaves': ''}})
+
+
+def applyBookmarkChanges(db, identity, added, removed, upsert, folders=None, removedFolders=()):
+    # Writes the added/removed leaves (keyed by bookmark id) to the bookmarks
+    # collection and records them in bookmarkLeaves, and the folder hashes in
+    # the snapshot.
+    folders = folders or {}
+    collection = db['bookmarks']
+    deletes = {}
+    for entry in removed.values():
+        for holder in partitions.holders(db, 'bookmarks', entry):
+            deletes.setdefault(holder.name, []).append(pymongo.DeleteOne(
+                {'identity': identity, 'url': entry['url'], 'dateAdded': entry['dateAdded']}))
+    for holder, operations in deletes.items():
+        db[holder].bulk_write(operations, ordered=False)
+    stored = upsert(collection, [
+        bookmarkDocument(entry, identity) for entry in added.values()
+    ])
+
+    storeLeaves(db, identity, added, removed)
+    update = {}
+    if folders:
+        update['$set'] = {f'folders.{folderId}': value for folderId, value in folders.items()}
+    if removedFolders:
+        update['$unset'] = {f'folders.{folderId}': '' for folderId in removedFolders}
+    if update:
+        db[SNAPSHOTS].update_one({'identity': identity}, update, upsert=True)
+    return {'added': stored,
+            'removed': [bookmarkDocument(entry, identity) for entry in removed.values()]}
+
+
+def syncBookmarks(db, identity, roots, upsert):
+    # Applies only the bookmarks that were added, removed or moved since the
+    # previous tree this identity sent, then records the new snapshot.
+    snapshot = db[SNAPSHOTS].find_one({'identity': identity}) or {}
+    if 'leaves' in snapshot:
+        moveSnapshotLeaves(db, identity, snapshot.pop('leaves'))
+    diff = diffTree(roots, snapshot,
+                    lambda folderIds, leafIds: loadLeaves(db, identity, folderIds, leafIds))
+    return applyBookmarkChanges(db, identity, diff['added'], diff['removed'], upsert,
+                                diff['folders'], diff['removedFolders'])
+
+
+def ensureUploadIndexes(db):
+    global _uploadsIndexed
+    with _uploadsIndexedLock:
+        if _uploadsIndexed:
+            return
+        db[UPLOADS].create_index([('identity', pymongo.ASCENDING), ('upload', pymongo.ASCENDING),
+                                  ('node.id', pymongo.ASCENDING)], unique=True, name='upload_node')
+        db[UPLOADS].create_index([('createdAt', pymongo.ASCENDING)], name='createdAt_ttl',
+                                 expireAfterSeconds=UPLOAD_TTL)
+        _uploadsIndexed = True
+
+
+def lastUpload(db, identity):
+    snapshot = db[SNAPSHOTS].find_one({'identity': identity}, {'upload': 1}) or {}
+    return snapshot.get('upload')
+
+
+def stageBookmarks(db, identity, upload, nodes):
+    # Bookmarks streamed through /ingest/ arrive as flat nodes, possibly over
+    # several requests when batches are retried, so they are kept in
+    # bookmarkUploads until the upload's bookmarksComplete. Upserts keyed by
+    # node id make a resent batch harmless; nodes of an upload older than the
+    # last applied one are dropped.
+    completed = lastUpload(db, identity)
+    if not nodes or (completed is not None and upload <= completed):
+        return 0
+    ensureUploadIndexes(db)
+    now = datetime.now(timezone.utc)
+    db[UPLOADS].bulk_write([
+        pymongo.UpdateOne({'identity': identity, 'upload': upload, 'node.id': node['id']},
+                          {'$set': {'node': node, 'createdAt': now}}, upsert=True)
+        for node in nodes], ordered=False)
+    return len(nodes)
+
+
+def buildTree(nodes):
+    # Nests flat {id, parentId, index, ...} nodes back into the tree
+    # chrome.bookmarks.getTree returns, without recursion.
+    byId = {node['id']: dict(node) if isLeaf(node) else dict(node, children=[]) for node in nodes}
+    roots = []
+    for node in sorted(byId.values(), key=lambda node: node.get('index', 0)):
+        parent = byId.get(node.get('parentId'))
+        if parent is None or isLeaf(parent):
+            roots.append(node)
+        else:
+            parent['children'].append(node)
+    return roots
+
+
+def completeBookmarks(db, identity, upload, count, upsert):
+    # Applies a streamed upload once all of its `count` nodes are staged,
+    # through the same subtree diff as a tree sent in one piece. Returns None
+    # for an upload superseded by a newer one (e.g. a late retry).
+    completed = lastUpload(db, identity)
+    if completed is not None and upload <= completed:
+        db[UPLOADS].delete_many({'identity': identity, 'upload': upload})
+        return None
+    nodes = [document['node'] for document in db[UPLOADS].find(
+        {'identity': identity, 'upload': upload}, {'node': 1})]
+    if len(nodes) < count:
+        raise IncompleteUpload(f'{len(nodes)} of {count} bookmark nodes received')
+    changes = syncBookmarks(db, identity, buildTree(nodes), upsert)
+    db[SNAPSHOTS].update_one({'identity': identity}, {'$set': {'upload': upload}}, upsert=True)
+    db[UPLOADS].delete_many({'identity': identity, 'upload': {'$lte': upload}})
+    return changes
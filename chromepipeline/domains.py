@@ -0,0 +1,138 @@
+import functools
+import ipaddress
+from urllib.parse import urlsplit
+from django.conf import settings
+
+# Fallback for when PUBLIC_SUFFIX_LIST_PATH is not set: the generic TLDs are
+# matched by the "*" default rule, so only multi-label suffixes are listed.
+BUILTIN_SUFFIXES = """
+ac.uk co.uk gov.uk ltd.uk me.uk net.uk org.uk plc.uk sch.uk nhs.uk police.uk
+com.au net.au org.au edu.au gov.au asn.au id.au
+co.nz net.nz org.nz govt.nz ac.nz school.nz
+co.in net.in org.in firm.in gen.in ind.in ac.in edu.in res.in gov.in
+co.jp ne.jp or.jp ac.jp ad.jp ed.jp go.jp gr.jp lg.jp
+com.br net.br org.br gov.br edu.br
+com.cn net.cn org.cn gov.cn edu.cn ac.cn
+com.mx org.mx gob.mx edu.mx
+co.za org.za gov.za ac.za web.za
+co.kr or.kr go.kr ac.kr ne.kr re.kr
+com.sg edu.sg gov.sg org.sg net.sg
+com.hk org.hk edu.hk gov.hk net.hk
+com.tw org.tw edu.tw gov.tw net.tw
+com.tr org.tr gov.tr edu.tr net.tr
+com.ar org.ar gob.ar edu.ar net.ar
+co.il org.il ac.il gov.il net.il
+com.my org.my gov.my edu.my net.my
+co.id or.id ac.id go.id web.id
+com.ph org.ph gov.ph edu.ph net.ph
+com.pk org.pk gov.pk edu.pk net.pk
+com.ng org.ng gov.ng edu.ng
+com.eg org.eg gov.eg edu.eg
+com.sa org.sa gov.sa edu.sa net.sa
+com.ua org.ua gov.ua net.ua
+co.th or.th ac.th go.th in.th
+com.vn net.vn org.vn gov.vn edu.vn
+github.io gitlab.io herokuapp.com appspot.com blogspot.com netlify.app vercel.app
+pages.dev workers.dev azurewebsites.net cloudfront.net web.app firebaseapp.com
+"""
+
+
+class PublicSuffixList:
+    def __init__(self, lines):
+        self.rules = set()
+        self.wildcards = set()
+        self.exceptions = set()
+        for line in lines:
+            rule = line.strip().split(' ')[0].lower()
+            if not rule or rule.startswith('//'):
+                continue
+            if rule.startswith('!'):
+                self.exceptions.add(rule[1:])
+            elif rule.startswith('*.'):
+                self.wildcards.add(rule[2:])
+            else:
+                self.rules.add(rule)
+
+    def suffixLength(self, labels):
+        # Number of trailing labels forming the public suffix; the longest
+        # matching rule wins and the implicit "*" rule matches one label.
+        for start in range(len(labels)):
+            candidate = '.'.join(labels[start:])
+            if candidate in self.exceptions:
+                return len(labels) - start - 1
+            if candidate in self.rules:
+                return len(labels) - start
+            if start + 1 < len(labels) and '.'.join(labels[start + 1:]) in self.wildcards:
+                return len(labels) - start
+        return 1
+
+
+@functools.lru_cache(maxsize=1)
+def publicSuffixList():
+    if settings.PUBLIC_SUFFIX_LIST_PATH:
+        with open(settings.PUBLIC_SUFFIX_LIST_PATH, encoding='utf-8') as handle:
+            return PublicSuffixList(handle)
+    return PublicSuffixList(BUILTIN_SUFFIXES.split())
+
+
+@functools.lru_cache(maxsize=1 << 16)
+def splitHost(host):
+    host = (host or '').strip('.').lower()
+    if not host:
+        return '', ''
+    try:
+        ipaddress.ip_address(host)
+        return host, host
+    except ValueError:
+        pass
+    labels = host.split('.')
+    if len(labels) == 1:
+        return host, host
+    suffixLength = publicSuffixList().suffixLength(labels)
+    if suffixLength >= len(labels):
+        return host, host
+    registrable = labels[-suffixLength - 1:]
+    return registrable[0], '.'.join(registrable)
+
+
+@functools.lru_cache(maxsize=1 << 16)
+def normalizeUrl(url):
+    # Returns (domain, registrableDomain), e.g. ('bbc', 'bbc.co.uk') for
+    # https://www.bbc.co.uk/news; bare hosts without a scheme are accepted.
+    if not url:
+        return '', ''
+    try:
+        parts = urlsplit(url if '//' in url else '//' + url)
+        return splitHost(parts.hostname)
+    except ValueError:
+        return '', ''
+
+
+def domainOf(url):
+    return normalizeUrl(url)[0]
+
+
+def domainColumns(urls):
+    # Vectorized over a pandas Series: every distinct URL is parsed once and
+    # the results are broadcast back through the factorized codes.
+    import numpy as np
+    import pandas as pd
+    codes, uniques = pd.factorize(urls.fillna(''), sort=False)
+    parsed = [normalizeUrl(url) for url in uniques]
+    domains = np.array([item[0] for item in parsed] or [''], dtype=object)
+    registrable = np.array([item[1] for item in parsed] or [''], dtype=object)
+    return (pd.Series(domains[codes], index=urls.index),
+            pd.Series(registrable[codes], index=urls.index))
+
+
+def annotate(document, urlField='url', prefix=''):
+    # Stores the normalized domain next to the url at ingest time, e.g.
+    # 'domain'/'registrableDomain' or 'referrerDomain'/'referrerRegistrableDomain'.
+    domain, registrable = normalizeUrl(document.get(urlField))
+    if prefix:
+        document[prefix + 'Domain'] = domain
+        document[prefix + 'RegistrableDomain'] = registrable
+    else:
+        document['domain'] = domain
+        document['registrableDomain'] = registrable
+    return document
@@ -0,0 +1,131 @@
+import sqlite3
+from datetime import datetime, timedelta, timezone
+
+# Chrome stores times as microseconds since 1601-01-01 UTC.
+WEBKIT_EPOCH = datetime(1601, 1, 1, tzinfo=timezone.utc)
+WEBKIT_EPOCH_OFFSET_MS = 11644473600000
+
+# downloads.state -> the state chrome.downloads reports; in-progress
+# downloads are skipped, as the extension only sends finished ones.
+DOWNLOAD_STATES = {
+    1: 'complete',
+    2: 'interrupted',  # cancelled
+    3: 'interrupted',  # interrupted (before Chrome 27)
+    4: 'interrupted',
+}
+# downloads.danger_type -> chrome.downloads DangerType
+DANGER_TYPES = {
+    0: 'safe',
+    1: 'file',
+    2: 'url',
+    3: 'content',
+    4: 'content',
+    5: 'uncommon',
+    6: 'accepted',
+    7: 'host',
+    8: 'unwanted',
+    9: 'safe',
+}
+
+# One row per visit; like chrome.history, hidden URLs and subframe loads
+# (transition core types 3 and 4) are left out.
+VISITS_QUERY = '''
+    SELECT v.id, u.id, u.url, u.title, u.visit_count, u.typed_count, v.visit_time
+    FROM visits v JOIN urls u ON u.id = v.url
+    WHERE v.id > ? AND u.hidden = 0 AND (v.transition & 255) NOT IN (3, 4)
+    ORDER BY v.id
+'''
+URLS_QUERY = '''
+    SELECT u.id, u.id, u.url, u.title, u.visit_count, u.typed_count, u.last_visit_time
+    FROM urls u
+    WHERE u.id > ? AND u.hidden = 0 AND u.last_visit_time > 0
+    ORDER BY u.id
+'''
+DOWNLOADS_QUERY = '''
+    SELECT d.id, d.start_time, d.end_time, d.total_bytes, d.received_bytes, d.state,
+           d.danger_type, d.mime_type, d.referrer,
+           (SELECT c.url FROM downloads_url_chains c WHERE c.id = d.id
+            ORDER BY c.chain_index LIMIT 1)
+    FROM downloads d
+    WHERE d.id > ?
+    ORDER BY d.id
+'''
+SOURCES = {
+    # source: (query, table its ids come from)
+    'visits': (VISITS_QUERY, 'visits'),
+    'urls': (URLS_QUERY, 'urls'),
+    'downloads': (DOWNLOADS_QUERY, 'downloads'),
+}
+
+
+def webkitMillis(value):
+    return value / 1000 - WEBKIT_EPOCH_OFFSET_MS
+
+
+def webkitIso(value):
+    if not value:
+        return None
+    moment = WEBKIT_EPOCH + timedelta(microseconds=value)
+    return moment.isoformat(timespec='milliseconds').replace('+00:00', 'Z')
+
+
+def openHistory(path):
+    # Read-only and without locking, so it also works on a copy taken while
+    # Chrome was running; the live file is locked by Chrome.
+    connection = sqlite3.connect(f'file:{path}?mode=ro&immutable=1', uri=True)
+    connection.execute('PRAGMA query_only = 1')
+    return connection
+
+
+def lastId(connection, source):
+    table = SOURCES[source][1]
+    return connection.execute(f'SELECT coalesce(max(id), 0) FROM {table}').fetchone()[0]
+
+
+def historyItem(row, source='visits'):
+    # The HistoryItem chrome.history.search returns. In 'visits' mode there
+    # is one item per visit, each counting once: the URL's total would be
+    # counted again for every one of its visits on the dashboard.
+    _, urlId, url, title, visitCount, typedCount, visitTime = row
+    return {
+        'id': str(urlId),
+        'url': url,
+        'title': title or '',
+        'lastVisitTime': webkitMillis(visitTime),
+        'visitCount': 1 if source == 'visits' else visitCount,
+        'typedCount': typedCount,
+    }
+
+
+def downloadItem(row):
+    # The download record the extension sends once a download finishes.
+    (downloadId, startTime, endTime, totalBytes, receivedBytes, state, danger,
+     mime, referrer, url) = row
+    return {
+        'id': downloadId,
+        'startTime': webkitIso(startTime),
+        'totalBytes': totalBytes,
+        'receivedBytes': receivedBytes,
+        'mime': mime,
+        'danger': DANGER_TYPES.get(danger),
+        'url': url,
+        'incognito': False,
+        'referrer': referrer,
+        'endTime': webkitIso(endTime),
+        'status': DOWNLOAD_STATES[state],
+    }
+
+
+def readChunks(connection, source, after=0, chunkSize=5000):
+    # Yields (last row id, items) per chunk of rows with an id above `after`,
+    # fetched from one streaming cursor.
+    cursor = connection.execute(SOURCES[source][0], (after,))
+    while True:
+        rows = cursor.fetchmany(chunkSize)
+        if not rows:
+            return
+        if source == 'downloads':
+            items = [downloadItem(row) for row in rows if row[5] in DOWNLOAD_STATES]
+        else:
+            items = [historyItem(row, source) for row in rows]
+        yield rows[-1][0], items
@@ -0,0 +1,31 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from personalized_webapp import partitions
+from personalized_webapp.mongo import getDatabase
+
+
+class Command(BaseCommand):
+    help = ('Remove the Chrome events older than their retention (HISTORY_RETENTION_DAYS, ...): '
+            'expired month partitions are dropped whole, other expired events deleted. '
+            'Meant to run daily, e.g. from cron.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--archive', action='store_true', default=settings.CHROME_RETENTION_ARCHIVE,
+                            help='Roll expired events into <collection>_archive before removing them.')
+        parser.add_argument('--collection', choices=sorted(partitions.PARTITIONED),
+                            help='Only apply the retention of this collection.')
+
+    def handle(self, *args, **options):
+        db = getDatabase(partitions.DATABASE)
+        names = [options['collection']] if options['collection'] else list(partitions.PARTITIONED)
+        for name in names:
+            days = partitions.retentionDays(name)
+            if not days:
+                self.stdout.write(f'{name}: kept forever')
+                continue
+            removed = partitions.expire(db, name, options['archive'])
+            action = 'archived' if options['archive'] else 'removed'
+            for collectionName, count in removed.items():
+                self.stdout.write(f'{collectionName}: {action} {count} events')
+            self.stdout.write(self.style.SUCCESS(
+                f'{name}: {action} {sum(removed.values())} events older than {days} days'))
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+from personalized_webapp import partitions
+from personalized_webapp.ingestion import NATURAL_KEYS, ensureIndexes, removeDuplicates
+from visualization.queries import createQueryIndexes
+from personalized_webapp.mongo import getClient
+
+
+class Command(BaseCommand):
+    help = ('Create the unique natural key indexes, the dashboard query indexes and the '
+            'retention TTL indexes.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dedupe', action='store_true',
+                            help='Delete duplicate documents before building the unique indexes.')
+
+    def handle(self, *args, **options):
+        client = getClient()
+        for dbName, collectionName in NATURAL_KEYS:
+            db = client[dbName]
+            partitioned = dbName == partitions.DATABASE and collectionName in partitions.PARTITIONED
+            collections = partitions.allCollections(db, collectionName) if partitioned else [db[collectionName]]
+            for collection in collections:
+                if options['dedupe']:
+                    removed = removeDuplicates(collection)
+                    self.stdout.write(f'{dbName}.{collection.name}: removed {removed} duplicates')
+                ensureIndexes(collection)
+                if partitioned:
+                    createQueryIndexes(collection)
+                    # Replaces the TTL index when the retention changed.
+                    partitions.ensureRetentionIndex(collection, replace=True)
+                self.stdout.write(self.style.SUCCESS(f'{dbName}.{collection.name}: indexes ready'))
@@ -0,0 +1,154 @@
+import os
+import json
+import time
+import hashlib
+import django
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from chromepipeline import historydb
+from chromepipeline.domains import annotate
+
+
+def checkpointPath(directory, path):
+    digest = hashlib.sha1(os.path.abspath(path).encode('utf-8')).hexdigest()[:16]
+    return os.path.join(directory, f'{digest}.json')
+
+
+def readCheckpoint(path):
+    if not os.path.exists(path):
+        return None
+    with open(path) as handle:
+        return json.load(handle)
+
+
+def writeCheckpoint(path, state):
+    tmpPath = path + '.tmp'
+    with open(tmpPath, 'w') as handle:
+        json.dump(state, handle)
+    os.replace(tmpPath, path)
+
+
+def importFile(path, identity, options, progress=None):
+    # Imports one History file chunk by chunk, recording after every chunk
+    # the last row id written, so a rerun carries on from there (and, on a
+    # newer copy of the file, only imports what was added since). Writes are
+    # natural key upserts, so replaying the last chunk is harmless.
+    from chromepipeline.views import downloadDocument, storeDownloads, storeHistory
+    checkpoint = checkpointPath(options['checkpoint_dir'], path)
+    state = None if options['restart'] else readCheckpoint(checkpoint)
+    state = state or {'path': os.path.abspath(path), 'sources': {}}
+    state['done'] = False
+    # Records read by this run; the per-source counts include earlier runs.
+    state['imported'] = 0
+    connection = historydb.openHistory(path)
+    try:
+        for source in (options['history'], 'downloads'):
+            counts = state['sources'].setdefault(source, {'lastId': 0, 'read': 0})
+            counts['maxId'] = historydb.lastId(connection, source)
+            for chunkLastId, items in historydb.readChunks(connection, source, counts['lastId'],
+                                                           options['batch_size']):
+                if source == 'downloads':
+                    storeDownloads([downloadDocument(dict(item, identity=identity)) for item in items])
+                else:
+                    storeHistory([{'data': annotate(item), 'identity': identity} for item in items])
+                counts['lastId'] = chunkLastId
+                counts['read'] += len(items)
+                state['imported'] += len(items)
+                writeCheckpoint(checkpoint, state)
+                if progress:
+                    progress(state)
+    finally:
+        connection.close()
+    state['done'] = True
+    writeCheckpoint(checkpoint, state)
+    return state
+
+
+def describe(state):
+    parts = []
+    for source, counts in state['sources'].items():
+        share = counts['lastId'] / counts['maxId'] if counts.get('maxId') else 1
+        parts.append(f"{source} {counts['read']} ({share:.0%})")
+    return f"{state['path']}: {', '.join(parts)}"
+
+
+class Command(BaseCommand):
+    help = ('Import the visits and downloads of Chrome History SQLite files (copied from a '
+            'profile directory) as if the extension had sent them. Each file is read in '
+            'chunks by one of --workers processes and resumes from its checkpoint.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('files', nargs='+', metavar='HISTORY[=EMAIL]',
+                            help='History files, each optionally followed by =email of its profile.')
+        parser.add_argument('--email', help='Profile email of files given without one.')
+        parser.add_argument('--id', dest='profile_id', help='Profile (GAIA) id of the identity.')
+        parser.add_argument('--history', choices=['visits', 'urls'], default='visits',
+                            help="'visits' stores every visit with a visitCount of 1, 'urls' one "
+                            'item per URL at its last visit with its total, like '
+                            'chrome.history.search.')
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--workers', type=int, default=min(os.cpu_count() or 1, 4))
+        parser.add_argument('--checkpoint-dir', default=os.path.join(
+            settings.BASE_DIR, 'data', 'chrome_import'))
+        parser.add_argument('--restart', action='store_true',
+                            help='Ignore existing checkpoints.')
+        parser.add_argument('--progress-seconds', type=float, default=10)
+
+    def handle(self, *args, **options):
+        jobs = []
+        for spec in options['files']:
+            path, _, email = spec.rpartition('=') if '=' in spec else (spec, '', '')
+            if not os.path.isfile(path):
+                raise CommandError(f'{path} does not exist')
+            identity = {'email': email or options['email'] or '', 'id': options['profile_id'] or ''}
+            if not identity['email'] and not identity['id']:
+                raise CommandError(f'No identity for {path}: give HISTORY=EMAIL, --email or --id')
+            jobs.append((path, identity))
+        os.makedirs(options['checkpoint_dir'], exist_ok=True)
+        workers = max(1, min(options['workers'], len(jobs)))
+        interval = options['progress_seconds']
+        fileOptions = {name: options[name] for name in
+                       ('history', 'batch_size', 'checkpoint_dir', 'restart')}
+
+        started = time.monotonic()
+        if workers == 1:
+            states = self.importSerial(jobs, fileOptions, interval)
+        else:
+            states = self.importParallel(jobs, fileOptions, interval, workers)
+        seconds = time.monotonic() - started
+        rows = sum(state['imported'] for state in states)
+        for state in states:
+            self.stdout.write(describe(state))
+        self.stdout.write(self.style.SUCCESS(
+            f'Imported {rows} records from {len(states)} files in {seconds:.1f}s '
+            f'({rows / seconds if seconds else 0:.0f}/s)'))
+
+    def importSerial(self, jobs, options, interval):
+        reported = time.monotonic()
+
+        def progress(state):
+            nonlocal reported
+            if time.monotonic() - reported >= interval:
+                reported = time.monotonic()
+                self.stdout.write(describe(state))
+        return [importFile(path, identity, options, progress) for path, identity in jobs]
+
+    def importParallel(self, jobs, options, interval, workers):
+        # One process per file, as mapping rows and parsing domains is Python
+        # work that threads would serialize; progress is read back from the
+        # checkpoints the workers write.
+        states = []
+        with ProcessPoolExecutor(max_workers=workers, initializer=django.setup) as executor:
+            pending = {executor.submit(importFile, path, identity, options): path
+                       for path, identity in jobs}
+            while pending:
+                done, _ = wait(pending, timeout=interval, return_when=FIRST_COMPLETED)
+                for future in done:
+                    pending.pop(future)
+                    states.append(future.result())
+                for path in pending.values():
+                    state = readCheckpoint(checkpointPath(options['checkpoint_dir'], path))
+                    if state:
+                        self.stdout.write(describe(state))
+        return states
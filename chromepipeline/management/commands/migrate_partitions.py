@@ -0,0 +1,77 @@
+import pymongo
+from django.core.management.base import BaseCommand
+from personalized_webapp import partitions
+from personalized_webapp.ingestion import bulkUpsert
+from personalized_webapp.mongo import getDatabase
+
+
+class Command(BaseCommand):
+    help = ('Move the Chrome events of the history, bookmarks and downloads collections into '
+            'their month partitions (CHROME_STORAGE=monthly), or stamp the eventTime read by '
+            'the retention index on them in place (CHROME_STORAGE=single).')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--collection', choices=sorted(partitions.PARTITIONED),
+                            help='Only migrate this collection.')
+        parser.add_argument('--drop-source', action='store_true',
+                            help='Drop the unpartitioned collection once all of its events '
+                            'are stored in partitions.')
+
+    def handle(self, *args, **options):
+        db = getDatabase(partitions.DATABASE)
+        names = [options['collection']] if options['collection'] else list(partitions.PARTITIONED)
+        for name in names:
+            if partitions.enabled():
+                self.partition(db, name, options)
+            else:
+                self.stamp(db, name, options)
+
+    def partition(self, db, name, options):
+        # Copying is an upsert on the natural key, so an interrupted run can
+        # simply be started again. Expired events would not be copied, so
+        # the retention is applied (and they are archived) first.
+        source = db[name]
+        if partitions.retentionDays(name):
+            self.stamp(db, name, options)
+        expired = partitions.expire(db, name).get(name, 0)
+        if expired:
+            self.stdout.write(f'{name}: {expired} expired events removed before the copy')
+        batch, copied, moved = [], 0, 0
+        for document in source.find({}).sort('_id', pymongo.ASCENDING).batch_size(options['batch_size']):
+            batch.append(document)
+            if len(batch) >= options['batch_size']:
+                copied += len(bulkUpsert(source, batch))
+                moved += len(batch)
+                batch = []
+        copied += len(bulkUpsert(source, batch))
+        moved += len(batch)
+        self.stdout.write(self.style.SUCCESS(
+            f'{name}: {moved} events in {len(partitions.existing(db, name))} partitions '
+            f'({copied} copied)'))
+        if options['drop_source']:
+            # New events already go to the partitions; anything added to the
+            # source meanwhile means another writer still uses it.
+            remaining = source.count_documents({})
+            if remaining != moved:
+                self.stderr.write(f'{name}: {remaining - moved} events arrived during the copy, '
+                                  'not dropping it; run the command again')
+                return
+            source.drop()
+            self.stdout.write(f'{name}: dropped the unpartitioned collection')
+
+    def stamp(self, db, name, options):
+        collection = db[name]
+        partitions.prepare(collection)
+        operations, updated = [], 0
+        for document in collection.find({'eventTime': {'$exists': False}}).batch_size(options['batch_size']):
+            when = partitions.eventTime(name, document)
+            if when is None:
+                continue
+            operations.append(pymongo.UpdateOne({'_id': document['_id']}, {'$set': {'eventTime': when}}))
+            if len(operations) >= options['batch_size']:
+                updated += collection.bulk_write(operations, ordered=False).modified_count
+                operations = []
+        if operations:
+            updated += collection.bulk_write(operations, ordered=False).modified_count
+        self.stdout.write(self.style.SUCCESS(f'{name}: stamped {updated} events'))
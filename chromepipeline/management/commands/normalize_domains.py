@@ -0,0 +1,40 @@
+import pymongo
+from django.core.management.base import BaseCommand
+from chromepipeline.domains import normalizeUrl
+from personalized_webapp import partitions
+from personalized_webapp.mongo import getDatabase
+
+# collection: [(url field, domain field, registrable domain field)]
+FIELDS = {
+    'history': [('data.url', 'data.domain', 'data.registrableDomain')],
+    'bookmarks': [('url', 'domain', 'registrableDomain')],
+    'downloads': [('url', 'domain', 'registrableDomain'),
+                  ('referrer', 'referrerDomain', 'referrerRegistrableDomain')],
+}
+
+
+class Command(BaseCommand):
+    help = 'Store normalized domains on Chrome documents ingested before domain normalization.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        db = getDatabase('userChromeData')
+        collections = [collection for name in FIELDS for collection in partitions.allCollections(db, name)]
+        for collection in collections:
+            fields = FIELDS[partitions.baseName(collection.name)]
+            query = {'$or': [{registrable: {'$exists': False}} for _, _, registrable in fields]}
+            projection = {url: 1 for url, _, _ in fields}
+            operations, updated = [], 0
+            for document in collection.find(query, projection).batch_size(options['batch_size']):
+                update = {}
+                for url, domain, registrable in fields:
+                    update[domain], update[registrable] = normalizeUrl(partitions.getPath(document, url))
+                operations.append(pymongo.UpdateOne({'_id': document['_id']}, {'$set': update}))
+                if len(operations) >= options['batch_size']:
+                    updated += collection.bulk_write(operations, ordered=False).modified_count
+                    operations = []
+            if operations:
+                updated += collection.bulk_write(operations, ordered=False).modified_count
+            self.stdout.write(self.style.SUCCESS(f'{collection.name}: normalized {updated} documents'))
@@ -0,0 +1,233 @@
+import json
+import zlib
+import logging
+from django.conf import settings
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+
+class StreamError(Exception):
+    pass
+
+
+class RetryLater(Exception):
+    # Raised by a handler when its records cannot be applied yet; the batch is
+    # acknowledged as 'retry' rather than logged as a failure.
+    pass
+
+
+class Identity:
+    def reader(self, stream, readSize):
+        return stream
+
+
+class GzipReader:
+    # Inflates at most `size` bytes per read(), so a small, highly
+    # compressed body never expands into memory at once: input the
+    # decompressor could not use yet waits in unconsumed_tail. A new member
+    # is started after each one ends, as for concatenated gzip files.
+
+    def __init__(self, stream, readSize):
+        self.stream = stream
+        self.readSize = readSize
+        self._input = b''
+        self._drained = False
+        # 32 + MAX_WBITS accepts both gzip and zlib headers.
+        self._decompressor = zlib.decompressobj(32 + zlib.MAX_WBITS)
+
+    def read(self, size):
+        while True:
+            if not self._input and not self._drained:
+                self._input = self.stream.read(self.readSize)
+                self._drained = not self._input
+            if self._decompressor is None:
+                if not self._input:
+                    return b''
+                self._decompressor = zlib.decompressobj(32 + zlib.MAX_WBITS)
+            decompressor = self._decompressor
+            try:
+                data = decompressor.decompress(self._input, size)
+            except zlib.error as error:
+                raise StreamError(f'Corrupt gzip stream: {error}')
+            if decompressor.eof:
+                self._input = decompressor.unused_data
+                self._decompressor = None
+            else:
+                self._input = decompressor.unconsumed_tail
+            if data:
+                return data
+            if self._drained and not self._input and self._decompressor is not None:
+                # zlib stops quietly at the end of the input, so a body cut
+                # short would otherwise pass as complete.
+                raise StreamError('Truncated gzip stream')
+
+
+class Gzip:
+    def reader(self, stream, readSize):
+        return GzipReader(stream, readSize)
+
+
+class ZstdReader:
+    def __init__(self, stream, readSize):
+        # stream_reader returns at most the requested size per read and
+        # carries on into the next frame of concatenated ones.
+        self._reader = zstandard.ZstdDecompressor().stream_reader(
+            stream, read_size=readSize, read_across_frames=True, closefd=False)
+
+    def read(self, size):
+        try:
+            return self._reader.read(size)
+        except zstandard.ZstdError as error:
+            raise StreamError(f'Corrupt zstd stream: {error}')
+
+
+class Zstd:
+    def reader(self, stream, readSize):
+        return ZstdReader(stream, readSize)
+
+
+def decoderFor(encoding):
+    encoding = (encoding or 'identity').strip().lower()
+    if encoding == 'identity':
+        return Identity()
+    if encoding in ('gzip', 'x-gzip', 'deflate'):
+        return Gzip()
+    if encoding == 'zstd' and zstandard is not None:
+        return Zstd()
+    return None
+
+
+def iterLines(stream, decoder, readSize=None, maxLine=None):
+    # Reads the decoded body readSize bytes at a time and yields complete
+    # NDJSON lines, so memory is bounded by readSize plus the longest line
+    # whatever the compression ratio.
+    readSize = readSize or settings.INGEST_READ_BYTES
+    maxLine = maxLine or settings.INGEST_MAX_LINE_BYTES
+    reader = decoder.reader(stream, readSize)
+    pending = b''
+    while True:
+        data = reader.read(readSize)
+        if not data:
+            break
+        pending += data
+        lines = pending.split(b'\n')
+        pending = lines.pop()
+        if len(pending) > maxLine:
+            raise StreamError(f'Line longer than {maxLine} bytes')
+        for line in lines:
+            if line.strip():
+                yield line
+    if pending.strip():
+        yield pending
+
+
+class BatchIngest:
+    # Routes NDJSON records of mixed types to their collections in chunks of
+    # `chunkSize` and tracks one acknowledgement per client batch. Every
+    # record names its batch; records of one batch are sent contiguously, so
+    # when the stream breaks only the batch being read can be incomplete.
+    #
+    #   {"type": "identity", "identity": {...}}         default for what follows
+    #   {"type": "history", "batch": "h1", "item": {...}}
+    #   {"type": "download", "batch": "d1", "item": {...}}
+    #   {"type": "bookmark", "batch": "b1", "upload": 1700000000000, "item": {...}}
+    #                                                   a bookmark tree node
+    #   {"type": "bookmarksComplete", "batch": "b9", "upload": 1700000000000, "count": 812}
+    #                                                   all nodes of the upload were sent
+    #
+    # Bookmark records name the upload (the tree snapshot, numbered in
+    # time order) they belong to.
+    #
+    # A record that can never be stored is rejected on its own: a line that
+    # is not JSON (its batch is unknown) is listed in `rejected` by its number
+    # among the non-empty lines, and one of an unknown type is counted in its batch's
+    # 'rejected'. Neither fails a batch, since resending it would not help.
+
+    def __init__(self, handlers, chunkSize=None):
+        # handlers: type -> callable(records, identity, upload=None, count=None);
+        # count is only given for bookmarksComplete.
+        self.handlers = handlers
+        self.chunkSize = chunkSize or settings.INGEST_CHUNK_SIZE
+        self.identity = None
+        self.chunks = {}
+        self.batches = {}
+        self.rejected = []
+        self.lines = 0
+        self.lastBatch = None
+
+    def _ack(self, batch, status, error=None):
+        current = self.batches.setdefault(batch, {'status': 'ok', 'records': 0, 'rejected': 0})
+        if status != 'ok':
+            current['status'] = status
+            current['error'] = error
+        return current
+
+    def _reject(self, batch, error):
+        current = self._ack(batch, 'ok')
+        current['rejected'] += 1
+        current.setdefault('error', error)
+
+    def add(self, line):
+        self.lines += 1
+        try:
+            record = json.loads(line)
+            kind = record['type']
+        except (ValueError, KeyError, TypeError):
+            self.rejected.append({'line': self.lines, 'error': 'Malformed record'})
+            return
+        if kind == 'identity':
+            self.identity = record.get('identity')
+            return
+        batch = str(record.get('batch', ''))
+        self.lastBatch = batch
+        if kind not in self.handlers and kind != 'bookmarksComplete':
+            self._reject(batch, f'Unknown record type {kind!r}')
+            return
+        upload = record.get('upload')
+        if kind in ('bookmark', 'bookmarksComplete') and not isinstance(upload, (int, float)):
+            self._reject(batch, 'Bookmark record without an upload')
+            return
+        identity = record.get('identity', self.identity)
+        self._ack(batch, 'ok')
+        self.batches[batch]['records'] += 1
+        if kind == 'bookmarksComplete':
+            self.flush('bookmark', identity)
+            self._run('bookmark', identity, [], [batch], upload, record.get('count', 0))
+            return
+        key = (kind, json.dumps(identity, sort_keys=True), upload)
+        chunk = self.chunks.setdefault(key, {'identity': identity, 'upload': upload, 'items': [],
+                                             'batches': set()})
+        chunk['items'].append(record.get('item'))
+        chunk['batches'].add(batch)
+        if len(chunk['items']) >= self.chunkSize:
+            self._flushChunk(key)
+
+    def _run(self, kind, identity, items, batches, upload=None, count=None):
+        try:
+            self.handlers[kind](items, identity, upload=upload, count=count)
+        except RetryLater as error:
+            for batch in batches:
+                self._ack(batch, 'retry', str(error))
+        except Exception as error:
+            logger.exception('Batch ingest of %d %s records failed', len(items), kind)
+            for batch in batches:
+                self._ack(batch, 'error', str(error) or error.__class__.__name__)
+
+    def _flushChunk(self, key):
+        chunk = self.chunks.pop(key)
+        self._run(key[0], chunk['identity'], chunk['items'], chunk['batches'], chunk['upload'])
+
+    def flush(self, kind=None, identity=None):
+        for key in list(self.chunks):
+            if kind is None or (key[0] == kind and self.chunks[key]['identity'] == identity):
+                self._flushChunk(key)
+
+    def fail(self, error):
+        # The stream broke: the batch being read may be missing records.
+        if self.lastBatch is not None:
+            self._ack(self.lastBatch, 'error', str(error))
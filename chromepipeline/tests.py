@@ -1,3 +1,511 @@
-from django.test import TestCase
+import io
+import os
+import json
+import gzip
+import zlib
+import sqlite3
+import tempfile
+import pandas as pd
+from datetime import datetime, timedelta, timezone
+from unittest import mock
+from asgiref.sync import async_to_sync
+from django.core.management import call_command
+from django.test import RequestFactory, SimpleTestCase, override_settings
+from benchmarks import generate
+from benchmarks.generate import chromeHistoryFile
+from chromepipeline import domains, views
+from chromepipeline.bookmarks import LEAVES, SNAPSHOTS, UPLOADS, buildTree
+from chromepipeline.management.commands.import_chrome_history import importFile
+from chromepipeline.stream import BatchIngest, Gzip, GzipReader, Identity, StreamError, iterLines
+from chromepipeline.views import batchIngest
+from personalized_webapp import partitions
+from personalized_webapp.ingestion import bulkUpsert
+from personalized_webapp.testing import MongoMockMixin
+from visualization import rollups
 
-# Create your tests here.
+
+class StreamDecodingTests(SimpleTestCase):
+
+    def setUp(self):
+        self.lines = [b'{"type": "history", "batch": "h%d"}' % number for number in range(5000)]
+        self.body = b'\n'.join(self.lines) + b'\n'
+
+    def decode(self, body, decoder, readSize=4096):
+        return list(iterLines(io.BytesIO(body), decoder, readSize, 1024 * 1024))
+
+    def testIdentity(self):
+        self.assertEqual(self.decode(self.body, Identity()), self.lines)
+
+    def testGzipAndZlib(self):
+        self.assertEqual(self.decode(gzip.compress(self.body), Gzip()), self.lines)
+        self.assertEqual(self.decode(zlib.compress(self.body), Gzip()), self.lines)
+
+    def testConcatenatedGzipMembers(self):
+        middle = len(self.body) // 3
+        body = gzip.compress(self.body[:middle]) + gzip.compress(self.body[middle:])
+        self.assertEqual(self.decode(body, Gzip()), self.lines)
+
+    def testReadsAreBoundedWhateverTheRatio(self):
+        # ~200 KB of gzip inflating to 200 MB.
+        reader = GzipReader(io.BytesIO(gzip.compress(b'\n' * (200 << 20))), 65536)
+        largest = total = 0
+        while True:
+            data = reader.read(65536)
+            if not data:
+                break
+            largest, total = max(largest, len(data)), total + len(data)
+        self.assertEqual(largest, 65536)
+        self.assertEqual(total, 200 << 20)
+
+    def testRejectsTruncatedAndCorruptBodies(self):
+        body = gzip.compress(self.body)
+        for broken in (body[:-8], b'', b'not gzip', body + b'\x1f'):
+            with self.assertRaises(StreamError):
+                self.decode(broken, Gzip())
+
+    def testRejectsLongLines(self):
+        with self.assertRaises(StreamError):
+            list(iterLines(io.BytesIO(b'x' * 10000), Identity(), 1024, 2048))
+
+
+class DomainTests(SimpleTestCase):
+
+    def setUp(self):
+        self.addCleanup(self.clearCaches)
+        self.clearCaches()
+
+    def clearCaches(self):
+        for cached in (domains.publicSuffixList, domains.splitHost, domains.normalizeUrl):
+            cached.cache_clear()
+
+    def testSplitsAtThePublicSuffix(self):
+        self.assertEqual(domains.splitHost('www.bbc.co.uk'), ('bbc', 'bbc.co.uk'))
+        self.assertEqual(domains.splitHost('alice.github.io'), ('alice', 'alice.github.io'))
+        self.assertEqual(domains.splitHost('news.example.com'), ('example', 'example.com'))
+        self.assertEqual(domains.splitHost('WWW.Example.COM.'), ('example', 'example.com'))
+        # A host that is itself a public suffix is kept whole.
+        self.assertEqual(domains.splitHost('github.io'), ('github.io', 'github.io'))
+        self.assertEqual(domains.splitHost('co.uk'), ('co.uk', 'co.uk'))
+
+    def testAddressesAndSingleLabelHosts(self):
+        self.assertEqual(domains.splitHost('192.168.0.10'), ('192.168.0.10', '192.168.0.10'))
+        self.assertEqual(domains.splitHost('::1'), ('::1', '::1'))
+        self.assertEqual(domains.splitHost('localhost'), ('localhost', 'localhost'))
+        self.assertEqual(domains.splitHost(''), ('', ''))
+        self.assertEqual(domains.splitHost(None), ('', ''))
+
+    def testNormalizesUrls(self):
+        self.assertEqual(domains.normalizeUrl('https://www.bbc.co.uk/news?x=1'), ('bbc', 'bbc.co.uk'))
+        self.assertEqual(domains.normalizeUrl('https://user:pw@example.com:8443/'), ('example', 'example.com'))
+        self.assertEqual(domains.normalizeUrl('example.com/path'), ('example', 'example.com'))
+        self.assertEqual(domains.normalizeUrl('http://[2001:db8::1]:8080/'), ('2001:db8::1', '2001:db8::1'))
+        self.assertEqual(domains.normalizeUrl('http://10.0.0.1/admin'), ('10.0.0.1', '10.0.0.1'))
+        self.assertEqual(domains.normalizeUrl('http://intranet/'), ('intranet', 'intranet'))
+        for url in ('', None, 'http://[::1', 'file:///home/alice/notes.txt'):
+            self.assertEqual(domains.normalizeUrl(url), ('', ''), url)
+
+    def testReadsTheConfiguredList(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.dat', delete=False) as handle:
+            handle.write('// comment\nuk\nco.uk\n*.ck\n!www.ck\n')
+        self.addCleanup(os.remove, handle.name)
+        with override_settings(PUBLIC_SUFFIX_LIST_PATH=handle.name):
+            self.clearCaches()
+            self.assertEqual(domains.splitHost('shop.bbc.co.uk'), ('bbc', 'bbc.co.uk'))
+            self.assertEqual(domains.splitHost('a.b.ck'), ('a', 'a.b.ck'))
+            self.assertEqual(domains.splitHost('www.ck'), ('www', 'www.ck'))
+            # Not in this list: only the "*" rule applies.
+            self.assertEqual(domains.splitHost('alice.github.io'), ('github', 'github.io'))
+
+    def testDomainColumns(self):
+        urls = pd.Series(['https://a.example.com/1', None, 'https://www.bbc.co.uk/',
+                          'https://a.example.com/1', '', 'http://127.0.0.1/'], index=[5, 6, 7, 8, 9, 10])
+        domain, registrable = domains.domainColumns(urls)
+        self.assertEqual(list(domain.index), [5, 6, 7, 8, 9, 10])
+        self.assertEqual(list(domain), ['example', '', 'bbc', 'example', '', '127.0.0.1'])
+        self.assertEqual(list(registrable), ['example.com', '', 'bbc.co.uk', 'example.com', '', '127.0.0.1'])
+        empty = domains.domainColumns(pd.Series([], dtype=object))
+        self.assertEqual([len(column) for column in empty], [0, 0])
+
+    def testAnnotate(self):
+        document = domains.annotate({'url': 'https://alice.github.io/blog'})
+        self.assertEqual((document['domain'], document['registrableDomain']), ('alice', 'alice.github.io'))
+        document = domains.annotate({'referrer': None}, urlField='referrer', prefix='referrer')
+        self.assertEqual((document['referrerDomain'], document['referrerRegistrableDomain']), ('', ''))
+        self.assertEqual(domains.annotate({})['domain'], '')
+
+
+class BatchIngestAckTests(SimpleTestCase):
+
+    def setUp(self):
+        self.stored = []
+        self.ingest = BatchIngest({'history': self.store}, chunkSize=2)
+
+    def store(self, items, identity, upload=None, count=None):
+        self.stored.extend(items)
+
+    def add(self, *records):
+        for record in records:
+            self.ingest.add(record if isinstance(record, bytes) else json.dumps(record).encode('utf-8'))
+        self.ingest.flush()
+
+    def testMalformedLineIsRejectedAlone(self):
+        self.add({'type': 'history', 'batch': 'h1', 'item': 1},
+                 {'type': 'history', 'batch': 'h1', 'item': 2},
+                 b'{"type": "history", "batch": "h2", "item"',
+                 {'type': 'history', 'batch': 'h2', 'item': 3})
+        self.assertEqual(self.stored, [1, 2, 3])
+        self.assertEqual(self.ingest.rejected, [{'line': 3, 'error': 'Malformed record'}])
+        self.assertEqual({batch: ack['status'] for batch, ack in self.ingest.batches.items()},
+                         {'h1': 'ok', 'h2': 'ok'})
+
+    def testUnknownTypeIsCountedInItsBatch(self):
+        self.add({'type': 'history', 'batch': 'h1', 'item': 1},
+                 {'type': 'tabs', 'batch': 'h1', 'item': 2},
+                 {'type': 'bookmark', 'batch': 'h1', 'item': 3})
+        ack = self.ingest.batches['h1']
+        self.assertEqual((ack['status'], ack['records'], ack['rejected']), ('ok', 1, 2))
+        self.assertEqual(ack['error'], "Unknown record type 'tabs'")
+        self.assertEqual(self.stored, [1])
+
+    def testHandlerFailureFailsItsBatches(self):
+        ingest = BatchIngest({'history': mock.Mock(side_effect=RuntimeError('down'))}, chunkSize=2)
+        with self.assertLogs('chromepipeline.stream', 'ERROR'):
+            for batch in ('h1', 'h2'):
+                ingest.add(json.dumps({'type': 'history', 'batch': batch, 'item': 1}).encode('utf-8'))
+        self.assertEqual({batch: ack['status'] for batch, ack in ingest.batches.items()},
+                         {'h1': 'error', 'h2': 'error'})
+
+
+def bookmarkNodes(tree):
+    # Flattens a getTree() result the way background.js does.
+    nodes, stack = [], list(tree)
+    while stack:
+        node = stack.pop()
+        flat = {key: node[key] for key in ('id', 'parentId', 'index', 'title', 'dateAdded', 'url') if key in node}
+        stack.extend(node.get('children', []))
+        nodes.append(flat)
+    return nodes
+
+
+def bookmarkTree(urls):
+    leaves = [{'id': str(100 + number), 'parentId': '2', 'index': number, 'title': url,
+               'url': f'https://{url}/', 'dateAdded': 1.7e12 + number} for number, url in enumerate(urls)]
+    return [{'id': '0', 'index': 0, 'title': '', 'children': [
+        {'id': '1', 'parentId': '0', 'index': 0, 'title': 'Bookmarks bar', 'children': [
+            {'id': '2', 'parentId': '1', 'index': 0, 'title': 'Reading', 'children': leaves}]},
+        {'id': '3', 'parentId': '0', 'index': 1, 'title': 'Other', 'children': []}]}]
+
+
+@override_settings(DASHBOARD_WARM_CACHE=False, WRITE_BEHIND=False)
+class BatchIngestBookmarkTests(MongoMockMixin, SimpleTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.db = self.client['userChromeData']
+        self.identity = {'email': 'a@example.com', 'id': '1'}
+
+    def upload(self, urls, upload, batchSize=4):
+        nodes = bookmarkNodes(bookmarkTree(urls))
+        batches = {}
+        for start in range(0, len(nodes), batchSize):
+            batches[f'b{upload}-{start}'] = [{'type': 'bookmark', 'upload': upload, 'item': node}
+                                            for node in nodes[start:start + batchSize]]
+        batches[f'c{upload}'] = [{'type': 'bookmarksComplete', 'upload': upload, 'count': len(nodes)}]
+        return batches
+
+    def send(self, batches):
+        lines = [{'type': 'identity', 'identity': self.identity}]
+        for batchId, records in batches.items():
+            lines.extend(dict(record, batch=batchId) for record in records)
+        body = b''.join(json.dumps(line).encode('utf-8') + b'\n' for line in lines)
+        request = RequestFactory().post('/ingest/', body, content_type='application/x-ndjson')
+        return json.loads(batchIngest(request).content)
+
+    def stored(self):
+        return sorted(document['title'] for document in self.db['bookmarks'].find())
+
+    def testAppliesACompleteUpload(self):
+        acks = self.send(self.upload(['a.com', 'b.com', 'c.com'], 1))
+        self.assertTrue(all(ack['status'] == 'ok' for ack in acks['batches'].values()))
+        self.assertEqual(self.stored(), ['a.com', 'b.com', 'c.com'])
+        snapshot = self.db[SNAPSHOTS].find_one({'identity': self.identity})
+        # The folder hashes are kept for the next subtree diff.
+        self.assertEqual(set(snapshot['folders']), {'0', '1', '2', '3'})
+        self.assertEqual(self.db[UPLOADS].count_documents({}), 0)
+
+    def testWaitsForRetriedBatches(self):
+        batches = self.upload(['a.com', 'b.com', 'c.com'], 1)
+        missing = next(iter(batches))
+        acks = self.send({batchId: records for batchId, records in batches.items() if batchId != missing})
+        self.assertEqual(acks['batches']['c1']['status'], 'retry')
+        self.assertEqual(self.stored(), [])
+        acks = self.send({missing: batches[missing], 'c1': batches['c1']})
+        self.assertEqual(acks['batches']['c1']['status'], 'ok')
+        self.assertEqual(self.stored(), ['a.com', 'b.com', 'c.com'])
+
+    def testIgnoresRetriesOfOlderUploads(self):
+        old = self.upload(['a.com', 'b.com'], 1)
+        self.send(old)
+        self.send(self.upload(['a.com'], 2))
+        self.assertEqual(self.stored(), ['a.com'])
+        # A late retry of the first upload must not bring b.com back.
+        acks = self.send(old)
+        self.assertTrue(all(ack['status'] == 'ok' for ack in acks['batches'].values()))
+        self.assertEqual(self.stored(), ['a.com'])
+        self.assertEqual(self.db[UPLOADS].count_documents({}), 0)
+
+    def testUnchangedTreeWritesNothing(self):
+        self.send(self.upload(['a.com', 'b.com'], 1))
+        with mock.patch('chromepipeline.views.recordBookmarkChanges') as record:
+            self.send(self.upload(['a.com', 'b.com'], 2))
+        changes = record.call_args[0][2]
+        self.assertEqual((changes['added'], changes['removed']), ([], []))
+
+    def leaves(self):
+        return {document['leafId']: document['parentId'] for document in self.db[LEAVES].find()}
+
+    def testStoresOneDocumentPerLeaf(self):
+        self.send(self.upload(['a.com', 'b.com', 'c.com'], 1))
+        self.assertEqual(self.leaves(), {'100': '2', '101': '2', '102': '2'})
+        self.assertNotIn('leaves', self.db[SNAPSHOTS].find_one({'identity': self.identity}))
+        self.send(self.upload(['a.com'], 2))
+        self.assertEqual(self.leaves(), {'100': '2'})
+
+    def testMovedBookmarksKeepTheirEvent(self):
+        tree = bookmarkTree(['a.com', 'b.com'])
+        views.syncBookmarks(self.db, self.identity, tree, bulkUpsert)
+        reading, other = tree[0]['children'][0]['children'][0], tree[0]['children'][1]
+        moved = reading['children'].pop(0)
+        other['children'].append(dict(moved, parentId='3'))
+        changes = views.syncBookmarks(self.db, self.identity, tree, bulkUpsert)
+        self.assertEqual(len(changes['removed']), 1)
+        self.assertEqual(self.stored(), ['a.com', 'b.com'])
+        self.assertEqual(self.leaves(), {'100': '3', '101': '2'})
+
+    def testMovesLeavesOutOfOlderSnapshots(self):
+        self.send(self.upload(['a.com', 'b.com'], 1))
+        leaves = {document.pop('leafId'): document for document in self.db[LEAVES].find({}, {'_id': 0, 'identity': 0})}
+        self.db[LEAVES].delete_many({})
+        self.db[SNAPSHOTS].update_one({'identity': self.identity}, {'$set': {'leaves': leaves}})
+        self.send(self.upload(['a.com'], 2))
+        self.assertEqual(self.stored(), ['a.com'])
+        self.assertEqual(self.leaves(), {'100': '2'})
+        self.assertNotIn('leaves', self.db[SNAPSHOTS].find_one({'identity': self.identity}))
+
+    def testBuildTreeRestoresTheTree(self):
+        tree = bookmarkTree(['a.com', 'b.com'])
+        self.assertEqual(buildTree(bookmarkNodes(tree)), tree)
+
+
+@override_settings(DASHBOARD_WARM_CACHE=False, WRITE_BEHIND=False)
+class ImportChromeHistoryTests(MongoMockMixin, SimpleTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.db = self.client['userChromeData']
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = chromeHistoryFile(os.path.join(self.directory.name, 'History'), 300, seed=1)
+        self.identity = {'email': 'a@example.com', 'id': ''}
+        connection = sqlite3.connect(self.path)
+        self.urls = {urlId: visitCount for urlId, visitCount in connection.execute(
+            'SELECT id, visit_count FROM urls WHERE hidden = 0 AND last_visit_time > 0')}
+        self.visits = {}
+        for urlId, transition in connection.execute('SELECT url, transition FROM visits'):
+            if urlId in self.urls and transition & 255 not in (3, 4):
+                self.visits[urlId] = self.visits.get(urlId, 0) + 1
+        connection.close()
+
+    def tearDown(self):
+        self.directory.cleanup()
+        super().tearDown()
+
+    def importHistory(self, history='visits', restart=False):
+        return importFile(self.path, self.identity, {
+            'history': history, 'batch_size': 50, 'checkpoint_dir': self.directory.name,
+            'restart': restart})
+
+    def visitCounts(self):
+        counts = {}
+        for document in self.db['history'].find():
+            urlId = int(document['data']['id'])
+            counts[urlId] = counts.get(urlId, 0) + document['data']['visitCount']
+        return counts
+
+    def testVisitsCountOnceEach(self):
+        self.importHistory()
+        self.assertEqual(self.db['history'].count_documents({}), sum(self.visits.values()))
+        self.assertEqual(self.visitCounts(), self.visits)
+
+    def testUrlsKeepTheirTotal(self):
+        self.importHistory('urls')
+        self.assertEqual(self.db['history'].count_documents({}), len(self.urls))
+        self.assertEqual(self.visitCounts(), self.urls)
+
+    def testResumesFromTheCheckpoint(self):
+        store = views.storeHistory
+        calls = []
+
+        def failingStore(documents):
+            calls.append(len(documents))
+            if len(calls) == 3:
+                raise RuntimeError('connection lost')
+            store(documents)
+        with mock.patch.object(views, 'storeHistory', failingStore):
+            with self.assertRaises(RuntimeError):
+                self.importHistory()
+        state = self.importHistory()
+        self.assertTrue(state['done'])
+        self.assertEqual(state['imported'], sum(self.visits.values()) - sum(calls[:2]))
+        self.assertEqual(self.visitCounts(), self.visits)
+
+
+@override_settings(DASHBOARD_WARM_CACHE=False, WRITE_BEHIND=False)
+class RollupRetryTests(MongoMockMixin, SimpleTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.db = self.client['userChromeData']
+        self.identity = {'email': 'a@example.com', 'id': ''}
+
+    def history(self, count):
+        return [{'identity': self.identity, 'data': {
+            'id': str(number), 'url': f'https://example.com/{number}', 'title': 'Example',
+            'lastVisitTime': 1.7e12 + number * 60000, 'visitCount': 1}} for number in range(count)]
+
+    def counted(self):
+        return sum(row['visits'] for row in self.db[rollups.ACTIVITY].find())
+
+    def testRetryFinishesAFailedRollupUpdate(self):
+        with mock.patch.object(views, 'recordHistory', side_effect=RuntimeError('rollups down')):
+            with self.assertRaises(RuntimeError):
+                views.storeHistory(self.history(5))
+        self.assertEqual(self.db['history'].count_documents({}), 5)
+        self.assertEqual(self.counted(), 0)
+        # The retried batch stores nothing new but still gets counted, once.
+        views.storeHistory(self.history(5))
+        self.assertEqual(self.counted(), 5)
+        views.storeHistory(self.history(5))
+        self.assertEqual(self.counted(), 5)
+        self.assertEqual(self.db['history'].count_documents({rollups.PENDING: {'$exists': True}}), 0)
+
+    def testLaterWritesPickUpLeftoverEvents(self):
+        with mock.patch.object(views, 'recordHistory', side_effect=RuntimeError('rollups down')):
+            with self.assertRaises(RuntimeError):
+                views.storeHistory(self.history(5))
+        views.storeHistory(self.history(8)[5:])
+        self.assertEqual(self.counted(), 8)
+
+
+@override_settings(DASHBOARD_WARM_CACHE=False, WRITE_BEHIND=False)
+class AsyncIngestViewTests(MongoMockMixin, SimpleTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.db = self.client['userChromeData']
+
+    def post(self, view, body):
+        request = RequestFactory().post('/', json.dumps(body), content_type='application/json')
+        return async_to_sync(view)(request)
+
+    def testRoutinesAsyncStoresHistory(self):
+        response = self.post(views.routinesAsync, {'routine': 'periodicHistory', 'data': {
+            'history': list(generate.historyItems(5)), 'identity': generate.identity(0)}})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.db['history'].count_documents({}), 5)
+
+    def testDownloadsAsyncStoresTheDownload(self):
+        download = next(generate.downloadItems(1))
+        self.assertEqual(self.post(views.downloadsAsync, {'download': download}).status_code, 200)
+        self.assertEqual(self.db['downloads'].count_documents({}), 1)
+
+    def testBusyWhenTheBufferIsFull(self):
+        with mock.patch.object(views, 'storeRoutine', side_effect=views.BufferFull):
+            response = self.post(views.routinesAsync, {'routine': 'periodicHistory', 'data': {}})
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '1')
+        with mock.patch.object(views, 'storeDownload', side_effect=views.BufferFull):
+            self.assertEqual(self.post(views.downloadsAsync, {'download': {}}).status_code, 503)
+
+
+@override_settings(CHROME_STORAGE='monthly', CHROME_RETENTION_ARCHIVE=False,
+                   CHROME_RETENTION_DAYS={'history': 30, 'bookmarks': 0, 'downloads': 0})
+class PartitionTests(MongoMockMixin, SimpleTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.db = self.client[partitions.DATABASE]
+        self.now = datetime.now(timezone.utc)
+
+    def visit(self, when, id='1'):
+        return {'identity': {'email': 'a@example.com'}, 'data': {
+            'id': id, 'url': 'https://example.com/', 'lastVisitTime': when.timestamp() * 1000}}
+
+    def stored(self, name='history'):
+        return {collection.name: collection.count_documents({})
+                for collection in partitions.allCollections(self.db, name)
+                if collection.count_documents({})}
+
+    @override_settings(CHROME_RETENTION_DAYS={})
+    def testRoutesEventsToTheirMonth(self):
+        may, june = datetime(2024, 5, 31, 23, tzinfo=timezone.utc), datetime(2024, 6, 1, 1, tzinfo=timezone.utc)
+        added = bulkUpsert(self.db['history'], [self.visit(may, '1'), self.visit(june, '2')])
+        self.assertEqual(len(added), 2)
+        self.assertEqual(self.stored(), {'history_2024_05': 1, 'history_2024_06': 1})
+        self.assertEqual(self.db['history_2024_05'].find_one()['eventTime'].replace(tzinfo=timezone.utc), may)
+        # The same event lands in the same partition again.
+        self.assertEqual(bulkUpsert(self.db['history'], [self.visit(june, '2')]), [])
+        # An empty startTime falls back to the endTime.
+        bulkUpsert(self.db['downloads'], [{'identity': {'email': 'a@example.com'}, 'id': 1,
+                                           'startTime': '', 'endTime': '2024-04-02T10:00:00Z'}])
+        self.assertEqual(self.stored('downloads'), {'downloads_2024_04': 1})
+
+    def testSkipsExpiredEventsAtIngest(self):
+        documents = [self.visit(self.now - timedelta(days=40), '1'), self.visit(self.now, '2')]
+        with self.assertLogs('personalized_webapp.partitions', 'INFO') as logs:
+            added = bulkUpsert(self.db['history'], documents)
+        self.assertEqual([document['data']['id'] for document in added], ['2'])
+        self.assertIn('Skipped 1 history events', logs.output[0])
+        self.assertEqual(sum(self.stored().values()), 1)
+
+    def testApplyRetentionRemovesExpiredEvents(self):
+        old = self.now - timedelta(days=40)
+        self.db['history_2000_01'].insert_one(self.visit(datetime(2000, 1, 5, tzinfo=timezone.utc)))
+        current = partitions.partitionName('history', old)
+        self.db[current].insert_one(dict(self.visit(old, '2'), eventTime=old))
+        bulkUpsert(self.db['history'], [self.visit(self.now, '3')])
+        call_command('apply_retention', stdout=io.StringIO())
+        self.assertNotIn('history_2000_01', self.db.list_collection_names())
+        self.assertEqual(sum(self.stored().values()), 1)
+        self.assertEqual(self.db['history_archive'].count_documents({}), 0)
+
+    def testArchivesExpiredEvents(self):
+        self.db['history_2000_01'].insert_one(self.visit(datetime(2000, 1, 5, tzinfo=timezone.utc)))
+        old = self.now - timedelta(days=40)
+        self.db[partitions.partitionName('history', old)].insert_one(dict(self.visit(old, '2'), eventTime=old))
+        call_command('apply_retention', '--archive', stdout=io.StringIO())
+        self.assertEqual(self.stored(), {})
+        archived = list(partitions.archivedEvents(self.db, 'history'))
+        self.assertEqual(sorted(event['data']['id'] for event in archived), ['1', '2'])
+        self.assertEqual(len(list(partitions.archivedEvents(self.db, 'history', '2000_01'))), 1)
+        # A re-sent expired event is neither stored nor archived again.
+        with self.assertLogs('personalized_webapp.partitions', 'INFO'):
+            bulkUpsert(self.db['history'], [self.visit(old, '2')])
+        call_command('apply_retention', '--archive', stdout=io.StringIO())
+        self.assertEqual(len(list(partitions.archivedEvents(self.db, 'history'))), 2)
+
+    @override_settings(CHROME_RETENTION_ARCHIVE=True)
+    def testMigratePartitionsArchivesThenMovesEvents(self):
+        expired = self.visit(self.now - timedelta(days=40), '1')
+        recent = [self.visit(self.now - timedelta(days=days), str(days)) for days in (2, 3)]
+        self.db['history'].insert_many([expired] + recent)
+        call_command('migrate_partitions', '--collection', 'history', '--drop-source', stdout=io.StringIO())
+        self.assertNotIn('history', self.db.list_collection_names())
+        self.assertEqual(sum(self.stored().values()), 2)
+        self.assertEqual([event['data']['id'] for event in partitions.archivedEvents(self.db, 'history')], ['1'])
+
+    @override_settings(CHROME_STORAGE='single')
+    def testMigratePartitionsStampsInSingleMode(self):
+        self.db['history'].insert_one(self.visit(self.now))
+        call_command('migrate_partitions', '--collection', 'history', stdout=io.StringIO())
+        self.assertIn('eventTime', self.db['history'].find_one())
+        self.assertIn('eventTime_ttl', self.db['history'].index_information())
@@ -1,65 +1,230 @@
-import re
 import json
-import pymongo
+import asyncio
 from django.conf import settings
+from django.http import JsonResponse
 from django.shortcuts import render
 from datetime import datetime, timedelta
 from django.views.decorators.csrf import csrf_exempt
 from corsheaders.defaults import default_headers
 from django.views.decorators.http import require_http_methods
+from personalized_webapp.ingestion import bulkUpsert
+from chromepipeline.bookmarks import completeBookmarks, stageBookmarks, syncBookmarks
+from chromepipeline.stream import BatchIngest, RetryLater, StreamError, decoderFor, iterLines
+from chromepipeline.domains import annotate, domainOf
+from visualization.cache import bumpVersion, warm
+from visualization.rollups import (identityKey, markPending, recordBookmarks, recordDownloads,
+                                   recordHistory, recordPending, updatesPaused)
+from personalized_webapp.aio import csrfExemptAsync, runBlocking
+from personalized_webapp.metrics import span
+from personalized_webapp.mongo import getDatabase
+from personalized_webapp.writebehind import BufferFull, getWriteBehind
 
-client = pymongo.MongoClient(settings.MONGO_DB_NAME)
 
+def refreshDashboards(db, documents, collectionName):
+    identities = {identityKey(document.get('identity')): document.get('identity') for document in documents}
+    for identity in identities.values():
+        bumpVersion(db, identity, collectionName)
+        warm(db, identity)
 
-@csrf_exempt
-def routines(request):
-    data = json.loads(request.body.decode('utf-8'))
+
+def storeHistory(documents):
+    dbName = getDatabase('userChromeData')
+    bulkUpsert(dbName['history'], markPending(documents))
+    with span('rollups.update'):
+        recorded = recordPending(dbName, 'history', recordHistory, documents)
+    refreshDashboards(dbName, recorded, 'history')
+
+
+def storeDownloads(documents):
+    dbName = getDatabase('userChromeData')
+    bulkUpsert(dbName['downloads'], markPending(documents))
+    with span('rollups.update'):
+        recorded = recordPending(dbName, 'downloads', recordDownloads, documents)
+    refreshDashboards(dbName, recorded, 'downloads')
+
+
+# Flushed in batches by the write-behind buffer when settings.WRITE_BEHIND is
+# on; both handlers are idempotent, so a retried or replayed batch is safe.
+writeBehind = getWriteBehind()
+writeBehind.register('history', storeHistory)
+writeBehind.register('downloads', storeDownloads)
+
+
+def ingest(target, documents, block=None):
+    if settings.WRITE_BEHIND:
+        writeBehind.submit(target, documents, timeout=block)
+    else:
+        writeBehind.handlers[target](documents)
+
+
+def storeRoutine(data, block=None):
     if data['routine'] == 'periodicHistory':
         historical_data = []
         for instances in data['data']['history']:
             historical_data.append({
-                'data': instances,
+                'data': annotate(instances),
                 'identity': data['data']['identity']
             })
-        dbName = client['userChromeData']
-        collectionName = dbName['history']
-        collectionName.insert_many(historical_data)
+        ingest('history', historical_data, block)
     else:
-        leaf_nodes = extract_leaf_nodes(data["data"]["bookmarks"])
-        dbName = client['userChromeData']
-        collectionName = dbName['bookmarks']
-        collectionName.insert_many(leaf_nodes)
+        dbName = getDatabase('userChromeData')
+        checkRollupsPaused(dbName)
+        with span('bookmarks.sync'):
+            changes = syncBookmarks(dbName, data['data']['identity'], data['data']['bookmarks'],
+                                    bulkUpsert)
+        recordBookmarkChanges(dbName, data['data']['identity'], changes)
+
+
+def checkRollupsPaused(dbName):
+    # Bookmark changes are counted as they are applied, which would race the
+    # scan of rebuild_rollups; the upload is retried once it is done.
+    if updatesPaused(dbName):
+        raise RetryLater('Dashboard rollups are being rebuilt')
+
+
+def recordBookmarkChanges(dbName, identity, changes):
+    with span('rollups.update'):
+        recordBookmarks(dbName, changes['removed'], sign=-1)
+        recordBookmarks(dbName, changes['added'])
+    if changes['added'] or changes['removed']:
+        bumpVersion(dbName, identity, 'bookmarks')
+        warm(dbName, identity)
+
+
+def downloadDocument(download):
+    annotate(download)
+    return annotate(download, 'referrer', 'referrer')
+
+
+def storeDownload(data, block=None):
+    ingest('downloads', [downloadDocument(data['download'])], block)
+
+
+def busy(request, context=None):
+    response = render(request, 'bookmarks.html', context=context, status=503)
+    response['Retry-After'] = '1'
+    return response
+
+
+@csrf_exempt
+def routines(request):
+    data = json.loads(request.body.decode('utf-8'))
+    try:
+        storeRoutine(data)
+    except (BufferFull, RetryLater):
+        return busy(request)
     return render(request, 'bookmarks.html')
 
 
 @csrf_exempt
 def downloads(request):
     data = json.loads(request.body)
-    dbName = client['userChromeData']
-    collectionName = dbName['downloads']
-    collectionName.insert_one(data['download'])
+    try:
+        storeDownload(data)
+    except BufferFull:
+        return busy(request, data)
+    return render(request, 'bookmarks.html', context=data)
+
+
+# Async twins of the ingest views for the ASGI app (settings.ASYNC_VIEWS):
+# the PyMongo work runs on the bounded blocking executor, so the event loop
+# keeps accepting uploads while earlier ones wait on MongoDB. A full
+# write-behind buffer is reported right away instead of holding a thread.
+@csrfExemptAsync
+async def routinesAsync(request):
+    data = json.loads(request.body.decode('utf-8'))
+    try:
+        await runBlocking(storeRoutine, data, block=0)
+    except (BufferFull, RetryLater):
+        return busy(request)
+    except asyncio.TimeoutError:
+        return render(request, 'bookmarks.html', status=504)
+    return render(request, 'bookmarks.html')
+
+
+@csrfExemptAsync
+async def downloadsAsync(request):
+    data = json.loads(request.body)
+    try:
+        await runBlocking(storeDownload, data, block=0)
+    except BufferFull:
+        return busy(request, data)
+    except asyncio.TimeoutError:
+        return render(request, 'bookmarks.html', status=504)
     return render(request, 'bookmarks.html', context=data)
 
 
+def batchHandlers():
+    dbName = getDatabase('userChromeData')
+
+    def history(items, identity, upload=None, count=None):
+        ingest('history', [{'data': annotate(item), 'identity': identity} for item in items], 0)
+
+    def downloads(items, identity, upload=None, count=None):
+        documents = []
+        for item in items:
+            item['identity'] = item.get('identity') or identity
+            documents.append(downloadDocument(item))
+        ingest('downloads', documents, 0)
+
+    def bookmarks(items, identity, upload=None, count=None):
+        if count is None:
+            stageBookmarks(dbName, identity, upload, items)
+            return
+        checkRollupsPaused(dbName)
+        with span('bookmarks.sync'):
+            changes = completeBookmarks(dbName, identity, upload, count, bulkUpsert)
+        if changes is not None:
+            recordBookmarkChanges(dbName, identity, changes)
+
+    return {'history': history, 'download': downloads, 'bookmark': bookmarks}
+
+
+@csrf_exempt
+@require_http_methods(['POST'])
+def batchIngest(request):
+    # NDJSON records (see chromepipeline.stream.BatchIngest), optionally gzip
+    # or zstd compressed, read and written chunk by chunk; the response acks
+    # every batch so the extension only resends the ones that failed, and
+    # lists the lines that could not be parsed.
+    decoder = decoderFor(request.headers.get('Content-Encoding'))
+    if decoder is None:
+        return JsonResponse({'error': 'unsupported Content-Encoding'}, status=415)
+    batch = BatchIngest(batchHandlers())
+    status, error = 200, None
+    try:
+        with span('ingest.stream'):
+            for line in iterLines(request, decoder):
+                batch.add(line)
+    except StreamError as streamError:
+        status, error = 400, str(streamError)
+    batch.flush()
+    if error:
+        batch.fail(error)
+    records = sum(ack['records'] for ack in batch.batches.values())
+    response = {'batches': batch.batches, 'records': records}
+    if batch.rejected:
+        response['rejected'] = batch.rejected
+    if error:
+        response['error'] = error
+    return JsonResponse(response, status=status)
+
+
 def extract_leaf_nodes(bookmarks):
     leaf_nodes = []
-    for bookmark in bookmarks:
+    stack = list(reversed(bookmarks))
+    while stack:
+        bookmark = stack.pop()
         children = bookmark.get("children", [])
         if not children:
             leaf_nodes.append(bookmark)
         else:
-            leaf_nodes.extend(extract_leaf_nodes(children))
+            stack.extend(reversed(children))
     return extractLastWeek(leaf_nodes)
 
 
 def extract_domain_name(url):
-    domain_pattern = r"(?:http[s]?://)?(?:www\.)?([a-zA-Z0-9.-]+)"
-    match = re.search(domain_pattern, url)
-    if match:
-        domain_name = match.group(1)
-        return re.sub(r"\.[a-zA-Z0-9-]+$", "", domain_name)
-    else:
-        return None
+    return domainOf(url)
 
 
 def extractLastWeek(bookmarks):
@@ -68,10 +233,9 @@ def extractLastWeek(bookmarks):
     for bookmark in bookmarks:
         if bookmark['dateAdded']/1000 < timenow:
             required_bookmarks.append(bookmark)
-    required_bookmarks = list(map(lambda bookmark: {
-        "domain": extract_domain_name(bookmark["url"]),
+    required_bookmarks = list(map(lambda bookmark: annotate({
         "title": bookmark["title"],
         "url": bookmark["url"],
         "dateAdded": bookmark["dateAdded"],
-    }, required_bookmarks))
+    }), required_bookmarks))
     return required_bookmarks
@@ -84,62 +84,141 @@ chrome.alarms.onAlarm.addListener(function (alarm) {
     processAlarmData(alarm);
 });
 
-function routineData(data, routine) {
-    if (routine === 'periodicHistory') {
-        fetch('http://127.0.0.1:8000/routine/', {
+const INGEST_URL = 'http://127.0.0.1:8000/ingest/';
+const BATCH_SIZE = 500;
+const MAX_PENDING_BATCHES = 200;
+// Uploads a batch takes part in before it is dropped, so one the server can
+// never accept (e.g. a record over its line limit) is not resent forever.
+const MAX_ATTEMPTS = 10;
+// Acks worth resending the batch for; anything else the server settled.
+const RETRY_STATUSES = ['error', 'retry'];
+
+// Splits items into batches of NDJSON records; the server acknowledges each
+// batch separately, so only the failed ones are kept and resent.
+function toBatches(type, items, identity, fields = {}) {
+    const batches = [];
+    const prefix = `${type}-${Date.now()}-${Math.random().toString(36).slice(2, 8)}`;
+    for (let start = 0; start < items.length; start += BATCH_SIZE) {
+        batches.push({
+            id: `${prefix}-${start / BATCH_SIZE}`,
+            records: items.slice(start, start + BATCH_SIZE).map(item => ({ type: type, item: item, identity: identity, ...fields }))
+        });
+    }
+    return batches;
+}
+
+// Every folder and bookmark of the tree as a flat node; the server rebuilds
+// the tree from parentId and index once the whole upload has arrived.
+function bookmarkNodes(tree) {
+    const nodes = [];
+    const stack = [...tree];
+    while (stack.length) {
+        const node = stack.pop();
+        const flat = { id: node.id, parentId: node.parentId, index: node.index, title: node.title, dateAdded: node.dateAdded };
+        if (node.url) {
+            flat.url = node.url;
+        } else if (node.children) {
+            stack.push(...node.children);
+        }
+        nodes.push(flat);
+    }
+    return nodes;
+}
+
+async function gzipLines(lines) {
+    const stream = new Blob(lines).stream().pipeThrough(new CompressionStream('gzip'));
+    return await new Response(stream).blob();
+}
+
+// The bookmark upload a batch belongs to, if any.
+function uploadOf(batch) {
+    return batch.records.length ? batch.records[0].upload : undefined;
+}
+
+// Batches kept for the next send. A bookmark upload only completes whole, so
+// it is never cut: uploads older than the newest one pending are dropped (the
+// newer tree supersedes them), as is an upload that lost a batch to
+// MAX_ATTEMPTS, and only other batches make room for MAX_PENDING_BATCHES.
+function pendingBatches(failed) {
+    const exhausted = failed.filter(batch => batch.attempts >= MAX_ATTEMPTS);
+    if (exhausted.length) {
+        console.error(`Dropped ${exhausted.length} batches after ${MAX_ATTEMPTS} attempts`);
+    }
+    const abandoned = new Set(exhausted.map(uploadOf).filter(upload => upload !== undefined));
+    const uploads = failed.map(uploadOf).filter(upload => upload !== undefined && !abandoned.has(upload));
+    const newest = uploads.length ? Math.max(...uploads) : undefined;
+    const kept = failed.filter(batch => batch.attempts < MAX_ATTEMPTS && (uploadOf(batch) === undefined || uploadOf(batch) === newest));
+    const bookmarkBatches = kept.filter(batch => uploadOf(batch) !== undefined).length;
+    const room = Math.max(0, MAX_PENDING_BATCHES - bookmarkBatches);
+    const others = kept.filter(batch => uploadOf(batch) === undefined);
+    const dropped = new Set(others.slice(0, Math.max(0, others.length - room)));
+    return kept.filter(batch => !dropped.has(batch));
+}
+
+// Sends run one at a time: each reads, resends and rewrites pendingBatches,
+// so overlapping sends (an alarm and a download) would resend the same
+// batches and overwrite each other's failures.
+let sending = Promise.resolve();
+
+function sendBatches(batches) {
+    const send = sending.then(() => sendPending(batches));
+    sending = send.catch(error => console.error('Error:', error));
+    return send;
+}
+
+async function sendPending(batches) {
+    const stored = await chrome.storage.local.get('pendingBatches');
+    const all = (stored.pendingBatches || []).concat(batches);
+    if (!all.length) {
+        return;
+    }
+    const lines = [];
+    for (const batch of all) {
+        for (const record of batch.records) {
+            lines.push(JSON.stringify({ ...record, batch: batch.id }) + '\n');
+        }
+    }
+    for (const batch of all) {
+        batch.attempts = (batch.attempts || 0) + 1;
+    }
+    let failed = all;
+    try {
+        const response = await fetch(INGEST_URL, {
             method: 'POST',
             headers: {
-                'Content-Type': 'application/json'
+                'Content-Type': 'application/x-ndjson',
+                'Content-Encoding': 'gzip'
             },
-            body: JSON.stringify({
-                'data': data,
-                'routine': routine
-            })
-        })
-            .then(response => response.json())
-            .then(data => {
-                console.log('Successfully sent user history to server:', data);
-            })
-            .catch(error => {
-                console.error('Error:', error);
-            });
+            body: await gzipLines(lines)
+        });
+        const acks = (await response.json()).batches || {};
+        failed = all.filter(batch => !acks[batch.id] || RETRY_STATUSES.includes(acks[batch.id].status));
+        console.log(`Sent ${all.length - failed.length} batches to server, ${failed.length} to retry`);
+    } catch (error) {
+        console.error('Error:', error);
+    }
+    await chrome.storage.local.set({ pendingBatches: pendingBatches(failed) });
+}
+
+function routineData(data, routine) {
+    if (routine === 'periodicHistory') {
+        sendBatches(toBatches('history', data.history, data.identity));
     }
     else if (routine === 'periodicBookmarks') {
-        fetch('http://127.0.0.1:8000/routine/', {
-            method: 'POST',
-            headers: {
-                'Content-Type': 'application/json'
-            },
-            body: JSON.stringify({
-                'data': data,
-                'routine': routine
-            })
-        })
-            .then(response => response.json())
-            .then(data => {
-                console.log('Successfully sent user bookmark data to server:', data);
-            })
-            .catch(error => {
-                console.error('Error:', error);
-            });
+        // The upload number orders tree snapshots: the server applies an
+        // upload once all its nodes arrived, and ignores older ones that are
+        // retried after a newer upload was applied.
+        const upload = Date.now();
+        const nodes = bookmarkNodes(data.bookmarks);
+        const batches = toBatches('bookmark', nodes, data.identity, { upload: upload });
+        batches.push({
+            id: `bookmarksComplete-${upload}`,
+            records: [{ type: 'bookmarksComplete', identity: data.identity, upload: upload, count: nodes.length }]
+        });
+        sendBatches(batches);
     }
 }
 
 function userDownloads(data) {
-    fetch('http://127.0.0.1:8000/downloads/', {
-        method: 'POST',
-        headers: {
-            'Content-Type': 'application/json'
-        },
-        body: JSON.stringify(data)
-    })
-        .then(response => response.json())  
-        .then(data => {
-            console.log('Successfully sent user download data to server:', data);
-        }
-    )
-        .catch(error => {
-            console.error('Error:', error);
-        }
-    );  
-}
\ No newline at end of file
+    sendBatches(toBatches('download', [data.download], data.download.identity));
+}
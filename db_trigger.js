@@ -26,11 +26,17 @@ exports = async function (changeEvent) {
             const collection = db.collection('userRedditData'); 
             const result = await collection.updateOne(
                 { _id: doc._id },
-                { $set: { plot_embedding: embedding }}
+                { $set: { plot_embedding: embedding, embeddedAt: new Date() }}
             );
 
             if(result.modifiedCount === 1) {
                 console.log("Successfully updated the document.");
+                // Searches cached by the web app for this user are now stale.
+                await db.collection('searchVersions').updateOne(
+                    { username: doc.username },
+                    { $inc: { version: 1 }},
+                    { upsert: true }
+                );
             } else {
                 console.log("Failed to update the document.");
             }
@@ -0,0 +1,219 @@
+import os
+import hashlib
+import sqlite3
+import threading
+import numpy as np
+from collections import OrderedDict
+from django.conf import settings
+from django.utils.module_loading import import_string
+from personalized_webapp.aio import httpClient, runBlocking
+from personalized_webapp.metrics import CACHE_REQUESTS, UPSTREAM_ERRORS, cacheResult
+
+DEFAULT_MODEL = "text-embedding-ada-002"
+OPENAI_EMBEDDINGS_URL = "https://api.openai.com/v1/embeddings"
+
+
+def normalizeText(text):
+    return " ".join(text.replace("\n", " ").split())
+
+
+def cacheKey(text, model):
+    return hashlib.sha256(f'{model}\x00{normalizeText(text)}'.encode('utf-8')).hexdigest()
+
+
+class OpenAIEmbedder:
+    maxBatchSize = 2048
+
+    def embed(self, texts, model=DEFAULT_MODEL):
+        import openai
+        openai.api_key = settings.OPENAI_API_KEY
+        response = openai.Embedding.create(input=texts, model=model)
+        ordered = sorted(response['data'], key=lambda item: item['index'])
+        return [item['embedding'] for item in ordered]
+
+    async def aembed(self, texts, model=DEFAULT_MODEL):
+        response = await httpClient().post(
+            OPENAI_EMBEDDINGS_URL, json={'input': texts, 'model': model},
+            headers={'Authorization': f'Bearer {settings.OPENAI_API_KEY}'})
+        response.raise_for_status()
+        ordered = sorted(response.json()['data'], key=lambda item: item['index'])
+        return [item['embedding'] for item in ordered]
+
+
+class FakeEmbedder:
+    # Deterministic offline embedder: the vector only depends on the text, so
+    # identical inputs always map to identical embeddings.
+    maxBatchSize = 2048
+
+    def __init__(self, dimensions=1536):
+        self.dimensions = dimensions
+        self.calls = 0
+
+    def embed(self, texts, model=DEFAULT_MODEL):
+        self.calls += 1
+        vectors = []
+        for text in texts:
+            seed = int.from_bytes(hashlib.sha256(text.encode('utf-8')).digest()[:8], 'little')
+            vector = np.random.default_rng(seed).standard_normal(self.dimensions)
+            vectors.append((vector / np.linalg.norm(vector)).tolist())
+        return vectors
+
+    async def aembed(self, texts, model=DEFAULT_MODEL):
+        return self.embed(texts, model=model)
+
+
+class MemoryTier:
+    def __init__(self, maxBytes):
+        self.maxBytes = maxBytes
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            vector = self._entries.get(key)
+            if vector is not None:
+                self._entries.move_to_end(key)
+            return vector
+
+    def put(self, key, vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.size -= previous.nbytes
+            self._entries[key] = vector
+            self.size += vector.nbytes
+            while self.size > self.maxBytes and self._entries:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= evicted.nbytes
+
+
+class SQLiteTier:
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self._local = threading.local()
+        self._connection().execute(
+            'CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL)')
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute('PRAGMA journal_mode=WAL')
+            self._local.connection = connection
+        return connection
+
+    def getMany(self, keys):
+        found = {}
+        connection = self._connection()
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            rows = connection.execute(
+                'SELECT key, vector FROM embeddings WHERE key IN (%s)' % ','.join('?' * len(chunk)), chunk)
+            for key, blob in rows:
+                found[key] = np.frombuffer(blob, dtype=np.float32)
+        return found
+
+    def putMany(self, items):
+        connection = self._connection()
+        with connection:
+            connection.executemany(
+                'INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)',
+                [(key, np.asarray(vector, dtype=np.float32).tobytes()) for key, vector in items])
+
+
+class EmbeddingCache:
+    # Content-addressed cache in front of an embedding provider: an in-memory
+    # LRU bounded by bytes, backed by a persistent SQLite file. Misses are
+    # sent to the provider in batches of at most provider.maxBatchSize.
+
+    def __init__(self, provider, memoryBytes=64 * 1024 * 1024, path=None):
+        self.provider = provider
+        self.memory = MemoryTier(memoryBytes)
+        self.disk = SQLiteTier(path) if path else None
+
+    def _lookup(self, texts, model):
+        keys = [cacheKey(text, model) for text in texts]
+        vectors = {}
+        for key in keys:
+            vector = self.memory.get(key)
+            cacheResult('embedding.memory', vector is not None)
+            if vector is not None:
+                vectors[key] = vector
+        missing = [key for key in dict.fromkeys(keys) if key not in vectors]
+        if missing and self.disk is not None:
+            found = self.disk.getMany(missing)
+            for key, vector in found.items():
+                self.memory.put(key, vector)
+                vectors[key] = vector
+            CACHE_REQUESTS.labels('embedding.disk', 'hit').inc(len(found))
+            CACHE_REQUESTS.labels('embedding.disk', 'miss').inc(len(missing) - len(found))
+        pending = OrderedDict()
+        for key, text in zip(keys, texts):
+            if key not in vectors and key not in pending:
+                pending[key] = normalizeText(text)
+        pendingKeys = list(pending)
+        batches = [pendingKeys[start:start + self.provider.maxBatchSize]
+                   for start in range(0, len(pendingKeys), self.provider.maxBatchSize)]
+        return keys, vectors, pending, batches
+
+    def _store(self, vectors, batchKeys, embedded):
+        fetched = list(zip(batchKeys, embedded))
+        for key, vector in fetched:
+            self.memory.put(key, vector)
+            vectors[key] = np.asarray(vector, dtype=np.float32)
+        if self.disk is not None:
+            self.disk.putMany(fetched)
+
+    def embedMany(self, texts, model=DEFAULT_MODEL):
+        keys, vectors, pending, batches = self._lookup(texts, model)
+        for batchKeys in batches:
+            try:
+                embedded = self.provider.embed([pending[key] for key in batchKeys], model=model)
+            except Exception:
+                UPSTREAM_ERRORS.labels('embedding').inc()
+                raise
+            self._store(vectors, batchKeys, embedded)
+        return [vectors[key].tolist() for key in keys]
+
+    async def aembedMany(self, texts, model=DEFAULT_MODEL):
+        # The SQLite tier is blocking, so lookups and stores run on the shared
+        # executor while the provider call itself is awaited.
+        keys, vectors, pending, batches = await runBlocking(self._lookup, texts, model)
+        for batchKeys in batches:
+            try:
+                embedded = await self.provider.aembed([pending[key] for key in batchKeys], model=model)
+            except Exception:
+                UPSTREAM_ERRORS.labels('embedding').inc()
+                raise
+            await runBlocking(self._store, vectors, batchKeys, embedded)
+        return [vectors[key].tolist() for key in keys]
+
+    def embed(self, text, model=DEFAULT_MODEL):
+        return self.embedMany([text], model=model)[0]
+
+
+_cache = None
+_cacheLock = threading.Lock()
+
+
+def getEmbeddingCache():
+    global _cache
+    with _cacheLock:
+        if _cache is None:
+            provider = import_string(settings.EMBEDDING_PROVIDER)()
+            _cache = EmbeddingCache(
+                provider,
+                memoryBytes=settings.EMBEDDING_CACHE_MEMORY_BYTES,
+                path=settings.EMBEDDING_CACHE_PATH)
+        return _cache
+
+
+def get_embeddings(texts, model=DEFAULT_MODEL):
+    return getEmbeddingCache().embedMany(texts, model=model)
+
+
+async def aget_embeddings(texts, model=DEFAULT_MODEL):
+    return await getEmbeddingCache().aembedMany(texts, model=model)
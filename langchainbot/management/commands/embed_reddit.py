@@ -0,0 +1,76 @@
+import pymongo
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils.module_loading import import_string
+from langchainbot.embeddings import EmbeddingCache, getEmbeddingCache
+from langchainbot.quantize import QUANTIZED_FIELD, storedFields
+from langchainbot.searchcache import bumpSearchVersion
+from personalized_webapp.mongo import getDatabase
+
+
+def postText(doc):
+    return f"{doc.get('subreddit', '')}:{doc.get('title', '')}"
+
+
+class Command(BaseCommand):
+    help = ('Embed userRedditData posts that are missing plot_embedding, in batches '
+            '(stored as settings.EMBEDDING_STORAGE).')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=512)
+        parser.add_argument('--concurrency', type=int, default=4)
+        parser.add_argument('--username', help='Only backfill posts of this user.')
+        parser.add_argument('--embedder', help='Dotted path of an embedding provider class, '
+                            'defaults to settings.EMBEDDING_PROVIDER through the shared cache.')
+
+    def handle(self, *args, **options):
+        collection = getDatabase('redditData')['userRedditData']
+        if options['embedder']:
+            cache = EmbeddingCache(import_string(options['embedder'])())
+        else:
+            cache = getEmbeddingCache()
+
+        # Only posts still without a vector are read, so an interrupted run
+        # resumes where it stopped, whichever users or _ids it covered.
+        query = {'plot_embedding': {'$exists': False}, QUANTIZED_FIELD: {'$exists': False}}
+        if options['username']:
+            query['username'] = options['username']
+        cursor = collection.find(query, {'subreddit': 1, 'title': 1, 'username': 1}).sort(
+            '_id', pymongo.ASCENDING).batch_size(options['batch_size'])
+
+        def embedBatch(docs):
+            vectors = cache.embedMany([postText(doc) for doc in docs])
+            fields = [storedFields(vector, settings.EMBEDDING_STORAGE, settings.EMBEDDING_KEEP_FLOAT32)
+                      for vector in vectors]
+            operations = [pymongo.UpdateOne({'_id': doc['_id']}, {'$set': field})
+                          for doc, field in zip(docs, fields)]
+            collection.bulk_write(operations, ordered=False)
+            for username in {doc.get('username') for doc in docs}:
+                bumpSearchVersion(collection.database, username)
+            return len(operations)
+
+        inFlight = deque()
+        total = 0
+
+        def settleOldest():
+            nonlocal total
+            total += inFlight.popleft().result()
+            self.stdout.write(f'Embedded {total} posts')
+
+        with ThreadPoolExecutor(max_workers=options['concurrency']) as executor:
+            batch = []
+            for doc in cursor:
+                batch.append(doc)
+                if len(batch) < options['batch_size']:
+                    continue
+                inFlight.append(executor.submit(embedBatch, batch))
+                batch = []
+                while len(inFlight) >= options['concurrency'] * 2:
+                    settleOldest()
+            if batch:
+                inFlight.append(executor.submit(embedBatch, batch))
+            while inFlight:
+                settleOldest()
+        self.stdout.write(self.style.SUCCESS(f'Done, embedded {total} posts.'))
@@ -0,0 +1,116 @@
+import random
+import pymongo
+import numpy as np
+from bson import BSON
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from langchainbot.quantize import FLOAT32_FIELD, FORMATS, QUANTIZED_FIELD, fullVector, storedFields
+from langchainbot.vectorindex import measureRecall
+from langchainbot.searchcache import bumpSearchVersion
+from personalized_webapp.mongo import getDatabase
+
+
+def storedBytes(fields):
+    return len(BSON.encode(fields))
+
+
+class Command(BaseCommand):
+    help = ('Write the compact binary plot_embedding_q (float32 or int8) for userRedditData '
+            'posts that only have the plot_embedding array, and report the recall of int8 search.')
+
+    def add_arguments(self, parser):
+        default = settings.EMBEDDING_STORAGE if settings.EMBEDDING_STORAGE in FORMATS else 'int8'
+        parser.add_argument('--format', choices=sorted(FORMATS), default=default)
+        parser.add_argument('--keep-float32', action='store_true',
+                            default=settings.EMBEDDING_KEEP_FLOAT32,
+                            help='Also store a float32 copy next to int8 codes, for re-ranking.')
+        parser.add_argument('--drop-array', action='store_true',
+                            help='Unset plot_embedding once converted. Atlas knnBeta needs the '
+                            'array, so only use this with VECTOR_SEARCH_ENGINE=local.')
+        parser.add_argument('--force', action='store_true',
+                            help='Re-encode posts that already have plot_embedding_q.')
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--username', help='Only convert posts of this user.')
+        parser.add_argument('--recall', type=int, default=0, metavar='QUERIES',
+                            help='Measure recall@k of int8 search with this many sampled posts '
+                            'as queries (per user, up to --recall-users users).')
+        parser.add_argument('--recall-users', type=int, default=5)
+        parser.add_argument('-k', type=int, default=10)
+
+    def handle(self, *args, **options):
+        collection = getDatabase('redditData')['userRedditData']
+        if options['drop_array'] and settings.VECTOR_SEARCH_ENGINE != 'local':
+            self.stderr.write(self.style.WARNING(
+                'Dropping plot_embedding breaks Atlas search (VECTOR_SEARCH_ENGINE is not local).'))
+
+        query = {'plot_embedding': {'$exists': True}}
+        if not options['force']:
+            query[QUANTIZED_FIELD] = {'$exists': False}
+        if options['username']:
+            query['username'] = options['username']
+        cursor = collection.find(query, {'plot_embedding': 1, 'username': 1}).sort(
+            '_id', pymongo.ASCENDING).batch_size(options['batch_size'])
+
+        converted, before, after = 0, 0, 0
+        operations = []
+        usernames = set()
+        for doc in cursor:
+            vector = doc['plot_embedding']
+            fields = storedFields(vector, options['format'], options['keep_float32'])
+            arrayBytes = storedBytes({'plot_embedding': vector})
+            before += arrayBytes
+            after += storedBytes(fields) + (0 if options['drop_array'] else arrayBytes)
+            update = {'$set': fields}
+            if options['drop_array']:
+                update['$unset'] = {'plot_embedding': ''}
+            elif FLOAT32_FIELD not in fields:
+                update['$unset'] = {FLOAT32_FIELD: ''}
+            operations.append(pymongo.UpdateOne({'_id': doc['_id']}, update))
+            usernames.add(doc.get('username'))
+            if len(operations) >= options['batch_size']:
+                collection.bulk_write(operations, ordered=False)
+                converted += len(operations)
+                operations = []
+                self.stdout.write(f'Converted {converted} posts')
+        if operations:
+            collection.bulk_write(operations, ordered=False)
+            converted += len(operations)
+
+        # Quantized scores can reorder results, so cached searches go stale.
+        for username in usernames:
+            bumpSearchVersion(collection.database, username)
+        if converted:
+            scanned = storedBytes(storedFields(vector, options['format']))
+            self.stdout.write(
+                f'Converted {converted} posts to {options["format"]}: '
+                f'{before / converted:.0f} -> {after / converted:.0f} stored bytes per post, '
+                f'{storedBytes({"plot_embedding": vector}) / scanned:.1f}x less scanned per vector.')
+        self.stdout.write(self.style.SUCCESS(f'Done, converted {converted} posts.'))
+
+        if options['recall']:
+            self.reportRecall(collection, options)
+
+    def reportRecall(self, collection, options):
+        usernames = [options['username']] if options['username'] else collection.distinct('username')
+        if not usernames:
+            raise CommandError('No posts to measure recall on.')
+        rng = random.Random(0)
+        for username in rng.sample(usernames, min(options['recall_users'], len(usernames))):
+            vectors = []
+            cursor = collection.find({'username': username},
+                                     {'plot_embedding': 1, FLOAT32_FIELD: 1, QUANTIZED_FIELD: 1})
+            for doc in cursor:
+                vector = fullVector(doc)
+                if vector is not None:
+                    vectors.append(vector)
+            if len(vectors) <= options['k']:
+                continue
+            # Sampled posts, perturbed so the query is not its own exact match.
+            noise = np.random.default_rng(0)
+            queries = [vectors[pos] + noise.normal(0, 0.01, len(vectors[pos])).astype(np.float32)
+                       for pos in rng.sample(range(len(vectors)), min(options['recall'], len(vectors)))]
+            recall = measureRecall(vectors, queries, options['k'], settings.VECTOR_RERANK_FACTOR)
+            self.stdout.write(
+                f'{username}: {len(vectors)} posts, recall@{options["k"]} '
+                f'int8 {recall["int8"]:.3f}, int8 + rerank x{settings.VECTOR_RERANK_FACTOR} '
+                f'{recall["int8+rerank"]:.3f}')
@@ -0,0 +1,86 @@
+import struct
+import numpy as np
+from datetime import datetime, timezone
+from bson.binary import Binary, USER_DEFINED_SUBTYPE
+
+# plot_embedding holds 1536 BSON doubles (~14.7 KB with the array keys);
+# these compact copies are stored as BSON Binary instead:
+#   float32: b'\x01' + 1536 little-endian float32        (~6 KB)
+#   int8:    b'\x02' + float32 scale + 1536 int8 codes   (~1.5 KB)
+QUANTIZED_FIELD = 'plot_embedding_q'
+FLOAT32_FIELD = 'plot_embedding_f32'
+# Set with every (re-)embedding, so the local index can tell which stored
+# vectors changed since it last synced.
+EMBEDDED_AT = 'embeddedAt'
+FORMATS = {'float32': 1, 'int8': 2}
+_NAMES = {code: name for name, code in FORMATS.items()}
+
+
+def quantizeInt8(vectors):
+    # Symmetric per-vector quantization: the largest component maps to 127.
+    vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+    scales = np.abs(vectors).max(axis=1) / 127
+    scales[scales == 0] = 1
+    codes = np.clip(np.rint(vectors / scales[:, None]), -127, 127).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+
+def encodeVector(vector, fmt='int8'):
+    vector = np.asarray(vector, dtype=np.float32)
+    if fmt == 'float32':
+        payload = vector.astype('<f4').tobytes()
+    elif fmt == 'int8':
+        codes, scales = quantizeInt8(vector)
+        payload = struct.pack('<f', scales[0]) + codes[0].tobytes()
+    else:
+        raise ValueError(f'Unknown vector format {fmt!r}')
+    return Binary(bytes([FORMATS[fmt]]) + payload, USER_DEFINED_SUBTYPE)
+
+
+def vectorFormat(data):
+    return _NAMES[bytes(data[:1])[0]]
+
+
+def decodeInt8(data):
+    data = bytes(data)
+    if data[0] != FORMATS['int8']:
+        raise ValueError('Not an int8 vector')
+    return np.frombuffer(data, dtype=np.int8, offset=5), struct.unpack('<f', data[1:5])[0]
+
+
+def decodeVector(data):
+    data = bytes(data)
+    fmt = vectorFormat(data)
+    if fmt == 'float32':
+        return np.frombuffer(data, dtype='<f4', offset=1).astype(np.float32)
+    codes, scale = decodeInt8(data)
+    return codes.astype(np.float32) * scale
+
+
+def fullVector(document, path='plot_embedding'):
+    # The most precise copy a document has, used for re-ranking.
+    if document.get(FLOAT32_FIELD) is not None:
+        return decodeVector(document[FLOAT32_FIELD])
+    if document.get(path) is not None:
+        return np.asarray(document[path], dtype=np.float32)
+    if document.get(QUANTIZED_FIELD) is not None:
+        return decodeVector(document[QUANTIZED_FIELD])
+    return None
+
+
+def storedFields(vector, fmt, keepFloat32=False):
+    # The fields embed_reddit/quantize_embeddings write for one vector.
+    if fmt == 'array':
+        fields = {'plot_embedding': [float(value) for value in vector]}
+    else:
+        fields = {QUANTIZED_FIELD: encodeVector(vector, fmt)}
+        if keepFloat32 and fmt == 'int8':
+            fields[FLOAT32_FIELD] = encodeVector(vector, 'float32')
+    fields[EMBEDDED_AT] = datetime.now(timezone.utc)
+    return fields
+
+
+def recallAtK(exact, approximate, k):
+    # Fraction of the exact top-k ids that the approximate search returned.
+    hits = sum(len(set(truth[:k]) & set(found[:k])) for truth, found in zip(exact, approximate))
+    return hits / (k * len(exact)) if exact else 1.0
@@ -0,0 +1,75 @@
+import secrets
+import threading
+import pymongo
+from datetime import datetime, timedelta
+from django.conf import settings
+from personalized_webapp.mongo import getDatabase
+
+# /langchain/ result pages read by /display/, in MongoDB so that any worker
+# process can answer for a handle. Each document carries its expiry, which a
+# TTL index enforces (and lookups check, since the TTL monitor lags).
+RESULTS = 'searchResults'
+
+_indexed = False
+_indexedLock = threading.Lock()
+
+
+def _collection():
+    global _indexed
+    collection = getDatabase('redditData')[RESULTS]
+    with _indexedLock:
+        if not _indexed:
+            collection.create_index([('expiresAt', pymongo.ASCENDING)], name='expiresAt_ttl',
+                                    expireAfterSeconds=0)
+            _indexed = True
+    return collection
+
+
+def _key(handle, part):
+    return f'{handle}:{part}'
+
+
+def storeResults(posts, pageSize=None):
+    # Saves ranked search results under a short opaque handle, split into
+    # pages stored as separate documents, so rendering one page only loads
+    # that page whatever the number of results.
+    pageSize = pageSize or settings.SEARCH_PAGE_SIZE
+    handle = secrets.token_urlsafe(12)
+    expiresAt = datetime.utcnow() + timedelta(seconds=settings.SEARCH_RESULT_TTL)
+    documents = [{'_id': _key(handle, 'meta'), 'count': len(posts), 'pageSize': pageSize,
+                  'expiresAt': expiresAt}]
+    for number, start in enumerate(range(0, len(posts), pageSize)):
+        documents.append({'_id': _key(handle, number), 'posts': posts[start:start + pageSize],
+                          'expiresAt': expiresAt})
+    _collection().insert_many(documents)
+    return handle, len(posts)
+
+
+def _find(handle, part):
+    return _collection().find_one({'_id': _key(handle, part), 'expiresAt': {'$gt': datetime.utcnow()}})
+
+
+def resultPage(handle, cursor=None):
+    # The page at `cursor` (a page number handed out as nextCursor or
+    # prevCursor), or None once the handle has expired.
+    meta = _find(handle, 'meta')
+    if meta is None:
+        return None
+    try:
+        number = max(int(cursor or 0), 0)
+    except ValueError:
+        number = 0
+    pages = -(-meta['count'] // meta['pageSize'])
+    number = min(number, max(pages - 1, 0))
+    page = _find(handle, number) if pages else {'posts': []}
+    if page is None:
+        return None
+    posts = page['posts']
+    return {
+        'response': posts,
+        'count': meta['count'],
+        'start': number * meta['pageSize'],
+        'end': number * meta['pageSize'] + len(posts),
+        'nextCursor': str(number + 1) if number + 1 < pages else None,
+        'prevCursor': str(number - 1) if number > 0 else None,
+    }
@@ -0,0 +1,102 @@
+import time
+import threading
+from collections import OrderedDict
+from django.conf import settings
+from personalized_webapp.metrics import cacheResult
+
+VERSIONS = 'searchVersions'
+
+
+def bumpSearchVersion(db, username):
+    # Called by everything that changes a user's userRedditData (reddit
+    # ingest, embed_reddit, the Atlas trigger); cached searches of that user
+    # taken at an older version are no longer served.
+    db[VERSIONS].update_one({'username': username}, {'$inc': {'version': 1}}, upsert=True)
+
+
+def searchVersion(db, username):
+    document = db[VERSIONS].find_one({'username': username}, {'version': 1}) or {}
+    return document.get('version', 0)
+
+
+def normalizeQuery(query):
+    return ' '.join(query.lower().split())
+
+
+class SearchCache:
+    # Results of recent searches per username, keyed on (normalized query, k)
+    # and tagged with the user's search version. A lookup with the query
+    # vector also reuses the entry of another query of that user whose
+    # vector lies within `maxDistance` cosine distance. Entries expire after
+    # `ttl` seconds; beyond `maxEntries` the least recently used go first.
+
+    def __init__(self, maxEntries=1024, ttl=600, maxDistance=0.05):
+        self.maxEntries = maxEntries
+        self.ttl = ttl
+        self.maxDistance = maxDistance
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _live(self, key, entry, version, now):
+        if entry['version'] == version and entry['expires'] > now:
+            return True
+        del self._entries[key]
+        return False
+
+    def get(self, username, query, k, version, vector=None):
+        with self._lock:
+            results = self._find(username, normalizeQuery(query), k, version, vector)
+        cacheResult('search', results is not None)
+        return results
+
+    def _find(self, username, text, k, version, vector):
+        now = time.monotonic()
+        entry = self._entries.get((username, text, k))
+        if entry is not None and self._live((username, text, k), entry, version, now):
+            self._entries.move_to_end((username, text, k))
+            return entry['results']
+        if vector is None or self.maxDistance <= 0:
+            return None
+        import numpy as np
+        query = np.asarray(vector, dtype=np.float32)
+        query = query / (np.linalg.norm(query) or 1)
+        best, bestDistance = None, self.maxDistance
+        for key, entry in list(self._entries.items()):
+            # Entries searched with a larger k cover this k as well.
+            if key[0] != username or key[2] < k or not self._live(key, entry, version, now):
+                continue
+            distance = 1 - float(entry['vector'] @ query)
+            if distance <= bestDistance:
+                best, bestDistance = key, distance
+        if best is None:
+            return None
+        self._entries.move_to_end(best)
+        return self._entries[best]['results'][:k]
+
+    def put(self, username, query, k, version, vector, results):
+        import numpy as np
+        vector = np.asarray(vector, dtype=np.float32)
+        with self._lock:
+            key = (username, normalizeQuery(query), k)
+            self._entries.pop(key, None)
+            self._entries[key] = {
+                'version': version,
+                'expires': time.monotonic() + self.ttl,
+                'vector': vector / (np.linalg.norm(vector) or 1),
+                'results': results,
+            }
+            while len(self._entries) > self.maxEntries:
+                self._entries.popitem(last=False)
+
+
+_cache = None
+_cacheLock = threading.Lock()
+
+
+def getSearchCache():
+    global _cache
+    with _cacheLock:
+        if _cache is None:
+            _cache = SearchCache(settings.SEARCH_CACHE_ENTRIES, settings.SEARCH_CACHE_TTL,
+                                 settings.SEARCH_CACHE_MAX_DISTANCE)
+        return _cache
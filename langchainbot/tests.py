@@ -1,3 +1,451 @@
-from django.test import TestCase
+import io
+import os
+import json
+import shutil
+import asyncio
+import tempfile
+from datetime import datetime, timedelta
+import httpx
+import numpy as np
+from unittest import mock
+from asgiref.sync import async_to_sync
+from bson import ObjectId
+from django.conf import settings
+from django.core.management import call_command
+from django.test import RequestFactory, SimpleTestCase, override_settings
+from langchainbot import embeddings, views
+from langchainbot.results import RESULTS, resultPage, storeResults
+from langchainbot.embeddings import EmbeddingCache, FakeEmbedder, MemoryTier, cacheKey
+from langchainbot.quantize import (EMBEDDED_AT, FLOAT32_FIELD, QUANTIZED_FIELD, decodeInt8, decodeVector,
+                                   encodeVector, fullVector, quantizeInt8, recallAtK, storedFields,
+                                   vectorFormat)
+from langchainbot import searchcache
+from langchainbot.searchcache import SearchCache, bumpSearchVersion, searchVersion
+from langchainbot.vectorindex import VectorIndex
+from personalized_webapp import aio
+from personalized_webapp.testing import MongoMockMixin
+from redditInfo import client
+from redditInfo.client import RedditClient
 
-# Create your tests here.
+
+class QuantizeTests(SimpleTestCase):
+
+    def setUp(self):
+        self.vectors = np.random.default_rng(7).normal(size=(20, 1536)).astype(np.float32)
+
+    def testFloat32RoundTripIsExact(self):
+        for vector in self.vectors:
+            data = encodeVector(vector, 'float32')
+            self.assertEqual(vectorFormat(data), 'float32')
+            self.assertEqual(len(data), 1 + 4 * 1536)
+            np.testing.assert_array_equal(decodeVector(data), vector)
+
+    def testInt8RoundTripIsWithinHalfAStep(self):
+        for vector in self.vectors:
+            data = encodeVector(vector)
+            self.assertEqual(vectorFormat(data), 'int8')
+            self.assertEqual(len(data), 1 + 4 + 1536)
+            codes, scale = decodeInt8(data)
+            self.assertAlmostEqual(scale, np.abs(vector).max() / 127, places=6)
+            self.assertEqual(np.abs(codes).max(), 127)
+            decoded = decodeVector(data)
+            self.assertLessEqual(np.abs(decoded - vector).max(), scale / 2 * (1 + 1e-5))
+            cosine = decoded @ vector / (np.linalg.norm(decoded) * np.linalg.norm(vector))
+            self.assertGreater(cosine, 0.9999)
+
+    def testZeroVectors(self):
+        vectors = np.vstack([np.zeros(1536, dtype=np.float32), self.vectors[0]])
+        codes, scales = quantizeInt8(vectors)
+        self.assertEqual(codes.dtype, np.int8)
+        self.assertFalse(codes[0].any())
+        self.assertEqual(scales[0], 1)
+        self.assertAlmostEqual(scales[1], np.abs(vectors[1]).max() / 127, places=6)
+        decoded = decodeVector(encodeVector(np.zeros(1536)))
+        self.assertTrue(np.isfinite(decoded).all())
+        self.assertFalse(decoded.any())
+
+    def testRejectsUnknownFormats(self):
+        with self.assertRaises(ValueError):
+            encodeVector(self.vectors[0], 'float16')
+        with self.assertRaises(ValueError):
+            decodeInt8(encodeVector(self.vectors[0], 'float32'))
+
+    def testFullVectorPrefersTheMostPrecise(self):
+        vector = self.vectors[0]
+        int8 = storedFields(vector, 'int8')
+        both = storedFields(vector, 'int8', keepFloat32=True)
+        self.assertNotIn(FLOAT32_FIELD, int8)
+        np.testing.assert_array_equal(fullVector(both), vector)
+        np.testing.assert_array_equal(fullVector(int8), decodeVector(int8[QUANTIZED_FIELD]))
+        np.testing.assert_array_equal(fullVector(storedFields(vector, 'array')), vector)
+        self.assertIsNone(fullVector({}))
+
+    def testRecallAtK(self):
+        exact = [[1, 2, 3, 4], [5, 6, 7, 8]]
+        self.assertEqual(recallAtK(exact, exact, 3), 1.0)
+        self.assertEqual(recallAtK(exact, [[3, 2, 1], [6, 9, 10]], 3), 4 / 6)
+        # Only the first k of each list count, and missing results are misses.
+        self.assertEqual(recallAtK(exact, [[4, 1], [5]], 2), 2 / 4)
+        self.assertEqual(recallAtK([], [], 10), 1.0)
+
+
+class VectorIndexSyncTests(MongoMockMixin, SimpleTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.indexDir = tempfile.mkdtemp()
+        self.settings = override_settings(VECTOR_INDEX_DIR=self.indexDir)
+        self.settings.enable()
+        self.embedder = FakeEmbedder(dimensions=16)
+        self.collection = self.client['userRedditData']['userRedditData']
+        self.clock = datetime(2024, 1, 1)
+
+    def tearDown(self):
+        self.settings.disable()
+        shutil.rmtree(self.indexDir)
+        super().tearDown()
+
+    def insertPost(self, text, _id=None):
+        return self.collection.insert_one({'_id': _id or ObjectId(), 'username': 'alice', 'title': text}).inserted_id
+
+    def embed(self, _id, text, fmt='array'):
+        vector = self.embedder.embed([text])[0]
+        fields = storedFields(vector, fmt)
+        # Stored with millisecond precision, so two fake embeddings of one
+        # post could otherwise share a stamp.
+        self.clock += timedelta(seconds=1)
+        fields[EMBEDDED_AT] = self.clock
+        self.collection.update_one({'_id': _id}, {'$set': fields})
+        bumpSearchVersion(self.collection.database, 'alice')
+        return vector
+
+    def topTitle(self, index, text):
+        return index.search('alice', self.embedder.embed([text])[0], 1)[0]['title']
+
+    def testPicksUpPostsEmbeddedOutOfIdOrder(self):
+        older = self.insertPost('older post')
+        newer = self.insertPost('newer post')
+        self.embed(newer, 'newer post')
+        index = VectorIndex(self.collection, format='float32')
+        self.assertEqual(index.sync('alice').ids, [newer])
+        # The older _id is embedded after the newer one was indexed.
+        self.embed(older, 'older post')
+        self.assertEqual(sorted(index.sync('alice').ids), sorted([older, newer]))
+        self.assertEqual(self.topTitle(index, 'older post'), 'older post')
+
+    def testReplacesReembeddedVectors(self):
+        _id = self.insertPost('first text')
+        self.embed(_id, 'first text')
+        index = VectorIndex(self.collection, format='float32')
+        before = index.sync('alice').vectors.copy()
+        self.embed(_id, 'second text')
+        partition = index.sync('alice')
+        self.assertEqual(partition.ids, [_id])
+        self.assertFalse((partition.vectors == before).all())
+        hit = index.search('alice', self.embedder.embed(['second text'])[0], 1)[0]
+        self.assertAlmostEqual(hit['score'], 1.0, places=4)
+
+    def testDropsDeletedPosts(self):
+        kept, deleted = self.insertPost('kept'), self.insertPost('deleted')
+        self.embed(kept, 'kept')
+        self.embed(deleted, 'deleted')
+        index = VectorIndex(self.collection, format='int8')
+        self.assertEqual(len(index.sync('alice').ids), 2)
+        self.collection.delete_one({'_id': deleted})
+        bumpSearchVersion(self.collection.database, 'alice')
+        partition = index.sync('alice')
+        self.assertEqual(partition.ids, [kept])
+        self.assertEqual(len(partition.vectors), len(partition.weights))
+
+    def testReloadedIndexOnlyRereadsChanges(self):
+        ids = [self.insertPost(f'post {number}') for number in range(3)]
+        for number, _id in enumerate(ids):
+            self.embed(_id, f'post {number}', fmt='int8')
+        VectorIndex(self.collection, format='int8').sync('alice')
+        self.embed(ids[0], 'rewritten', fmt='int8')
+        # A fresh index loads the saved partition and only re-reads ids[0].
+        index = VectorIndex(self.collection, format='int8')
+        partition = index.sync('alice')
+        self.assertEqual(sorted(partition.ids), sorted(ids))
+        self.assertEqual(self.topTitle(index, 'rewritten'), 'post 0')
+
+
+class EmbeddingCacheTests(SimpleTestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'embeddings.sqlite3')
+        self.provider = FakeEmbedder(dimensions=8)
+        self.provider.maxBatchSize = 2
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def testBatchesAndDeduplicatesMisses(self):
+        cache = EmbeddingCache(self.provider, path=self.path)
+        texts = ['a', 'b', 'a', 'c', ' b\n', 'd', 'e']
+        vectors = cache.embedMany(texts)
+        # Five distinct normalized texts in batches of two.
+        self.assertEqual(self.provider.calls, 3)
+        self.assertEqual(vectors[0], vectors[2])
+        self.assertEqual(vectors[1], vectors[4])
+        self.assertEqual(len(vectors), len(texts))
+
+    def testServesRepeatsFromMemory(self):
+        cache = EmbeddingCache(self.provider)
+        first = cache.embed('hello world')
+        self.assertEqual(cache.embed('hello \n world'), first)
+        self.assertEqual(self.provider.calls, 1)
+
+    def testPersistsToSQLite(self):
+        first = EmbeddingCache(self.provider, path=self.path).embedMany(['x', 'y'])
+        reopened = EmbeddingCache(self.provider, path=self.path)
+        self.assertEqual(reopened.embedMany(['y', 'x']), first[::-1])
+        self.assertEqual(self.provider.calls, 1)
+
+    def testKeysIncludeTheModel(self):
+        cache = EmbeddingCache(self.provider)
+        cache.embed('text', model='one')
+        cache.embed('text', model='two')
+        self.assertEqual(self.provider.calls, 2)
+        self.assertNotEqual(cacheKey('text', 'one'), cacheKey('text', 'two'))
+
+    def testMemoryTierEvictsLeastRecentlyUsed(self):
+        tier = MemoryTier(maxBytes=2 * 8 * 4)
+        tier.put('a', np.zeros(8))
+        tier.put('b', np.zeros(8))
+        tier.get('a')
+        tier.put('c', np.zeros(8))
+        self.assertIsNone(tier.get('b'))
+        self.assertIsNotNone(tier.get('a'))
+        self.assertEqual(tier.size, 2 * 8 * 4)
+
+    def testAsyncMatchesSync(self):
+        cache = EmbeddingCache(self.provider, path=self.path)
+        vectors = asyncio.run(cache.aembedMany(['p', 'q', 'p']))
+        self.assertEqual(vectors, cache.embedMany(['p', 'q', 'p']))
+        self.assertEqual(self.provider.calls, 1)
+
+
+class EmbedRedditTests(MongoMockMixin, SimpleTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.collection = self.client['redditData']['userRedditData']
+
+    def embedReddit(self, **options):
+        call_command('embed_reddit', embedder='langchainbot.embeddings.FakeEmbedder',
+                     batch_size=2, concurrency=2, stdout=io.StringIO(), **options)
+
+    def missing(self):
+        return sorted(doc['title'] for doc in self.collection.find({'plot_embedding': {'$exists': False}}))
+
+    def testUserRunDoesNotSkipOtherUsers(self):
+        for number in range(6):
+            username = 'alice' if number % 2 else 'bob'
+            self.collection.insert_one({'username': username, 'subreddit': 'python', 'title': f'post {number}'})
+        self.embedReddit(username='alice')
+        self.assertEqual(self.missing(), ['post 0', 'post 2', 'post 4'])
+        self.embedReddit()
+        self.assertEqual(self.missing(), [])
+
+    def testEmbedsPostsInsertedBelowTheLastId(self):
+        self.collection.insert_one({'_id': ObjectId('6500000000000000000000ff'), 'username': 'alice', 'title': 'new'})
+        self.embedReddit()
+        # Ingested later with an older _id, e.g. restored from a backup.
+        self.collection.insert_one({'_id': ObjectId('650000000000000000000001'), 'username': 'alice', 'title': 'old'})
+        self.embedReddit()
+        self.assertEqual(self.missing(), [])
+        self.assertEqual(self.client['redditData']['searchVersions'].find_one({'username': 'alice'})['version'], 2)
+
+
+class SearchCacheTests(SimpleTestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        clock = mock.patch.object(searchcache, 'time')
+        clock.start().monotonic.side_effect = lambda: self.now
+        self.addCleanup(clock.stop)
+        self.cache = SearchCache(maxEntries=3, ttl=60, maxDistance=0.05)
+
+    def put(self, query, k=5, version=1, vector=(1, 0, 0), username='alice'):
+        results = [f'{query} {rank}' for rank in range(k)]
+        self.cache.put(username, query, k, version, list(vector), results)
+        return results
+
+    def testNormalizesTheQuery(self):
+        results = self.put('Funny  Cats')
+        self.assertEqual(self.cache.get('alice', ' funny cats\n', 5, 1), results)
+        self.assertIsNone(self.cache.get('alice', 'funny cats', 4, 1))
+        self.assertIsNone(self.cache.get('bob', 'funny cats', 5, 1))
+
+    def testEntriesExpire(self):
+        results = self.put('cats')
+        self.now += 59
+        self.assertEqual(self.cache.get('alice', 'cats', 5, 1), results)
+        self.now += 2
+        self.assertIsNone(self.cache.get('alice', 'cats', 5, 1, vector=[1, 0, 0]))
+        self.assertEqual(len(self.cache._entries), 0)
+
+    def testEvictsTheLeastRecentlyUsed(self):
+        for query in ('a', 'b', 'c'):
+            self.put(query, vector=[ord(query), 1, 0])
+        self.cache.get('alice', 'a', 5, 1)
+        self.put('d')
+        self.assertIsNone(self.cache.get('alice', 'b', 5, 1))
+        for query in ('a', 'c', 'd'):
+            self.assertIsNotNone(self.cache.get('alice', query, 5, 1))
+
+    def testNewVersionsInvalidate(self):
+        self.put('cats', version=1)
+        self.assertIsNone(self.cache.get('alice', 'cats', 5, 2))
+        self.assertIsNone(self.cache.get('alice', 'cats', 5, 1))
+
+    def testReusesNearbyQueries(self):
+        results = self.put('cats', vector=[1, 0, 0])
+        # Cosine distance ~0.005, within maxDistance.
+        self.assertEqual(self.cache.get('alice', 'kittens', 5, 1, vector=[1, 0.1, 0]), results)
+        # ~0.29 away.
+        self.assertIsNone(self.cache.get('alice', 'dogs', 5, 1, vector=[1, 1, 0]))
+        self.assertIsNone(self.cache.get('alice', 'kittens', 5, 2, vector=[1, 0.1, 0]))
+        self.assertIsNone(self.cache.get('bob', 'kittens', 5, 1, vector=[1, 0.1, 0]))
+
+    def testNearbyEntriesMustCoverK(self):
+        results = self.put('cats', k=5)
+        self.assertEqual(self.cache.get('alice', 'kittens', 3, 1, vector=[1, 0.1, 0]), results[:3])
+        self.assertIsNone(self.cache.get('alice', 'kittens', 10, 1, vector=[1, 0.1, 0]))
+
+    def testPicksTheNearestEntry(self):
+        self.put('cats', vector=[1, 0.2, 0])
+        nearest = self.put('kittens', vector=[1, 0.05, 0])
+        self.assertEqual(self.cache.get('alice', 'kitty', 5, 1, vector=[1, 0.04, 0]), nearest)
+
+
+class SearchVersionTests(MongoMockMixin, SimpleTestCase):
+
+    def testBumpsPerUser(self):
+        db = self.client['redditData']
+        self.assertEqual(searchVersion(db, 'alice'), 0)
+        bumpSearchVersion(db, 'alice')
+        bumpSearchVersion(db, 'alice')
+        self.assertEqual(searchVersion(db, 'alice'), 2)
+        self.assertEqual(searchVersion(db, 'bob'), 0)
+
+
+@override_settings(SEARCH_RESULT_TTL=60, SEARCH_PAGE_SIZE=20)
+class ResultHandleTests(MongoMockMixin, SimpleTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.posts = [{'title': f'post {rank}', 'score': 1 - rank / 100} for rank in range(45)]
+
+    def testStoresPagesUnderAHandle(self):
+        handle, count = storeResults(self.posts)
+        self.assertEqual(count, 45)
+        self.assertNotEqual(storeResults(self.posts)[0], handle)
+        collection = self.client['redditData'][RESULTS]
+        self.assertEqual(collection.count_documents({'_id': {'$regex': f'^{handle}:'}}), 4)
+        self.assertEqual(collection.index_information()['expiresAt_ttl']['expireAfterSeconds'], 0)
+
+    def testPagesFollowTheCursors(self):
+        handle, _ = storeResults(self.posts)
+        first = resultPage(handle)
+        self.assertEqual((first['start'], first['end'], first['prevCursor']), (0, 20, None))
+        self.assertEqual(first['response'], self.posts[:20])
+        last = resultPage(handle, resultPage(handle, first['nextCursor'])['nextCursor'])
+        self.assertEqual((last['start'], last['end'], last['nextCursor']), (40, 45, None))
+        self.assertEqual(last['response'], self.posts[40:])
+        self.assertEqual(resultPage(handle, last['prevCursor'])['start'], 20)
+        # Out of range and malformed cursors are clamped.
+        self.assertEqual(resultPage(handle, '99')['start'], 40)
+        self.assertEqual(resultPage(handle, 'x')['start'], 0)
+
+    def testEmptyResults(self):
+        handle, count = storeResults([])
+        self.assertEqual(count, 0)
+        self.assertEqual(resultPage(handle)['response'], [])
+
+    def testExpiredAndUnknownHandles(self):
+        self.assertIsNone(resultPage('unknown'))
+        with override_settings(SEARCH_RESULT_TTL=-1):
+            handle, _ = storeResults(self.posts)
+        self.assertIsNone(resultPage(handle))
+        request = RequestFactory().get('/display/', {'handle': handle})
+        self.assertEqual(views.displayRedditData(request).status_code, 404)
+
+
+class AtlasSearchTests(SimpleTestCase):
+
+    def testFiltersOnTheUsernameToken(self):
+        collection = mock.Mock()
+        collection.aggregate.return_value = iter([{'title': 'post'}])
+        pristine = json.dumps(settings.SEARCH_PIPELINE)
+        self.assertEqual(views.atlasSearch(collection, 'Some_User', [0.5, 0.75], 7), [{'title': 'post'}])
+        [pipeline], _ = collection.aggregate.call_args
+        knn = pipeline[0]['$search']['knnBeta']
+        self.assertEqual((knn['vector'], knn['k']), ([0.5, 0.75], 7))
+        self.assertEqual(knn['filter'], {'equals': {'path': 'username', 'value': 'Some_User'}})
+        self.assertEqual(pipeline[2]['$match'], {'username': 'Some_User'})
+        self.assertEqual(json.dumps(settings.SEARCH_PIPELINE), pristine)
+
+    def testIndexDefinitionMapsTheSearchedFields(self):
+        with open(os.path.join(settings.BASE_DIR, 'atlas_search_index.json')) as handle:
+            fields = json.load(handle)['mappings']['fields']
+        path = settings.SEARCH_PIPELINE[0]['$search']['knnBeta']['path']
+        self.assertEqual(fields[path]['type'], 'knnVector')
+        self.assertEqual(fields['username'], {'type': 'token'})
+
+
+@override_settings(REDDIT_CLIENT_ID='client', REDDIT_SECRET='secret', EMBEDDING_CACHE_PATH='',
+                   EMBEDDING_PROVIDER='langchainbot.embeddings.OpenAIEmbedder')
+class AsyncQueryViewTests(MongoMockMixin, SimpleTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.clients = []
+        self.embedded = []
+        previous = client._client, embeddings._cache
+        client._client = RedditClient(baseUrl='https://reddit.test/', oauthUrl='https://oauth.reddit.test')
+        embeddings._cache = None
+        self.addCleanup(self.restore, previous)
+
+    def restore(self, previous):
+        client._client, embeddings._cache = previous
+
+    def upstream(self, request):
+        if request.url.path == '/api/v1/access_token':
+            return httpx.Response(200, json={'access_token': 'token', 'expires_in': 3600})
+        self.embedded.extend(json.loads(request.content)['input'])
+        return httpx.Response(200, json={'data': [{'index': 0, 'embedding': [0.5, 0.75]}]})
+
+    def newClient(self):
+        self.clients.append(httpx.AsyncClient(transport=httpx.MockTransport(self.upstream)))
+        return self.clients[-1]
+
+    def query(self, **body):
+        body = dict({'username': 'alice', 'password': 'pw', 'query': 'cats', 'numposts': '3'}, **body)
+        request = RequestFactory().post('/langchain/', json.dumps(body), content_type='application/json')
+        with mock.patch.object(aio, 'newClient', self.newClient):
+            return async_to_sync(views.redditQueryAsync)(request)
+
+    def testStoresTheResultsOfTheSearch(self):
+        posts = [{'title': 'cat'}, {'title': 'kitten'}]
+        with mock.patch.object(views, 'cachedSearch', return_value=posts) as search:
+            response = self.query()
+        search.assert_called_once_with('alice', 'cats', [0.5, 0.75], 3)
+        self.assertEqual(self.embedded, ['cats'])
+        payload = json.loads(response.content)
+        self.assertEqual(payload['count'], 2)
+        self.assertEqual(resultPage(payload['handle'])['response'], posts)
+        # The token grant and the embedding shared one client, closed since.
+        self.assertEqual(len(self.clients), 1)
+        self.assertTrue(self.clients[0].is_closed)
+
+    def testRejectsBadParameters(self):
+        response = self.query(numposts='many')
+        self.assertEqual(json.loads(response.content), {'error': 'error'})
+
+    def testSearchTimeout(self):
+        with mock.patch.object(views, 'runBlocking', side_effect=asyncio.TimeoutError):
+            response = self.query()
+        self.assertEqual(response.status_code, 504)
@@ -0,0 +1,290 @@
+import os
+import re
+import threading
+import numpy as np
+from bson import ObjectId
+from datetime import timezone
+from django.conf import settings
+from langchainbot.quantize import (EMBEDDED_AT, FLOAT32_FIELD, QUANTIZED_FIELD, decodeInt8,
+                                   decodeVector, fullVector, quantizeInt8, recallAtK, vectorFormat)
+from langchainbot.searchcache import searchVersion
+
+try:
+    import faiss
+except ImportError:
+    faiss = None
+
+
+def _indexPath(username, format='float32'):
+    safeName = re.sub(r'[^A-Za-z0-9_-]', '_', username)
+    suffix = '' if format == 'float32' else f'.{format}'
+    return os.path.join(settings.VECTOR_INDEX_DIR, f'{safeName}{suffix}.npz')
+
+
+def _normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+def _stamp(embeddedAt):
+    # embeddedAt (naive UTC as PyMongo returns it) in milliseconds; 0 for
+    # vectors written before the field existed.
+    if embeddedAt is None:
+        return 0
+    if embeddedAt.tzinfo is None:
+        embeddedAt = embeddedAt.replace(tzinfo=timezone.utc)
+    return int(embeddedAt.timestamp() * 1000)
+
+
+def _cosineScore(scores):
+    # Atlas reports knnBeta cosine scores normalized to [0, 1].
+    return (1 + scores) / 2
+
+
+class UserPartition:
+    # Vectors of a single user's posts, stored L2-normalized so that the
+    # inner product equals the cosine similarity used by Atlas knnBeta.
+    # In the 'int8' format only the quantized codes are held, with the
+    # inverse norm of each row, and scored without decoding them:
+    # cosine = (codes . query) / |codes|, whatever the per-vector scale.
+    # Each row keeps the embeddedAt stamp it was read with, and the partition
+    # the search version of the user it was last synced at.
+
+    # Rows of int8 codes converted to float32 at a time while scoring.
+    SCAN_CHUNK = 16384
+
+    def __init__(self, username, format='float32'):
+        self.username = username
+        self.format = format
+        self.ids = []
+        self.stamps = []
+        self.vectors = None
+        self.weights = None
+        self.version = None
+        self._faissIndex = None
+        # Held while syncing or searching, so concurrent requests of one user
+        # never see ids and vectors out of step or race on the saved file.
+        self.lock = threading.Lock()
+
+    def load(self):
+        path = _indexPath(self.username, self.format)
+        if not os.path.exists(path):
+            return self
+        stored = np.load(path, allow_pickle=False)
+        storedFormat = str(stored['format']) if 'format' in stored else 'float32'
+        if storedFormat != self.format:
+            # Rebuilt from MongoDB in the configured format on the next sync.
+            return self
+        self.ids = [ObjectId(value) for value in stored['ids']]
+        # Files saved without stamps are re-read from MongoDB row by row.
+        self.stamps = stored['stamps'].tolist() if 'stamps' in stored else [-1] * len(self.ids)
+        self.vectors = stored['vectors']
+        self.weights = stored['weights'] if self.format == 'int8' else None
+        self.version = int(stored['version']) if 'version' in stored else None
+        return self
+
+    def save(self):
+        os.makedirs(settings.VECTOR_INDEX_DIR, exist_ok=True)
+        path = _indexPath(self.username, self.format)
+        tmpPath = path + '.tmp.npz'
+        arrays = {
+            'ids': np.array([str(value) for value in self.ids]),
+            'stamps': np.array(self.stamps, dtype=np.int64),
+            'version': np.array(-1 if self.version is None else self.version),
+            'format': np.array(self.format),
+            'vectors': self.vectors if self.vectors is not None else np.empty((0, 0), np.float32),
+        }
+        if self.format == 'int8':
+            arrays['weights'] = self.weights if self.weights is not None else np.empty(0, np.float32)
+        np.savez(tmpPath, **arrays)
+        os.replace(tmpPath, path)
+
+    def encode(self, vector):
+        # One stored row for a full-precision vector.
+        vector = _normalize(vector)
+        if self.format == 'int8':
+            return quantizeInt8(vector)[0][0]
+        return vector
+
+    def add(self, ids, rows, stamps=None):
+        # rows come from encode() (or are int8 codes read from MongoDB).
+        if not ids:
+            return
+        rows = np.vstack(rows)
+        if self.format == 'int8':
+            norms = np.linalg.norm(rows.astype(np.float32), axis=1)
+            norms[norms == 0] = 1
+            weights = (1 / norms).astype(np.float32)
+            self.weights = weights if self.weights is None else np.concatenate([self.weights, weights])
+        if self.vectors is None or not len(self.vectors):
+            self.vectors = rows
+        else:
+            self.vectors = np.vstack([self.vectors, rows])
+        self.ids.extend(ids)
+        self.stamps.extend(stamps if stamps is not None else [0] * len(ids))
+        self._faissIndex = None
+
+    def remove(self, ids):
+        ids = set(ids)
+        if not ids:
+            return
+        keep = np.array([value not in ids for value in self.ids], dtype=bool)
+        self.ids = [value for value, kept in zip(self.ids, keep) if kept]
+        self.stamps = [stamp for stamp, kept in zip(self.stamps, keep) if kept]
+        self.vectors = self.vectors[keep]
+        if self.weights is not None:
+            self.weights = self.weights[keep]
+        self._faissIndex = None
+
+    def search(self, vector, k):
+        if self.vectors is None or not len(self.ids):
+            return []
+        query = _normalize(vector).reshape(1, -1)
+        k = min(k, len(self.ids))
+        if self.format == 'int8':
+            allScores = np.empty(len(self.ids), dtype=np.float32)
+            for start in range(0, len(self.ids), self.SCAN_CHUNK):
+                chunk = self.vectors[start:start + self.SCAN_CHUNK]
+                allScores[start:start + len(chunk)] = chunk @ query[0]
+            allScores *= self.weights
+            positions = np.argpartition(-allScores, k - 1)[:k]
+            positions = positions[np.argsort(-allScores[positions])]
+            scores = allScores[positions]
+        elif faiss is not None:
+            if self._faissIndex is None:
+                self._faissIndex = faiss.IndexFlatIP(self.vectors.shape[1])
+                self._faissIndex.add(self.vectors)
+            scores, positions = self._faissIndex.search(query, k)
+            scores, positions = scores[0], positions[0]
+        else:
+            allScores = self.vectors @ query[0]
+            positions = np.argpartition(-allScores, k - 1)[:k]
+            positions = positions[np.argsort(-allScores[positions])]
+            scores = allScores[positions]
+        return [(self.ids[pos], float(_cosineScore(score))) for pos, score in zip(positions, scores)]
+
+
+class VectorIndex:
+    # Per-username partitions of the userRedditData embeddings. A search only
+    # touches the vectors of the requesting user, so the latency depends on
+    # that user's corpus rather than on the whole collection. An 'int8' index
+    # scores k * rerankFactor candidates on the quantized codes, then re-ranks
+    # them with the full-precision vectors fetched from MongoDB.
+
+    def __init__(self, collection, path='plot_embedding', format=None, rerankFactor=None):
+        self.collection = collection
+        self.path = path
+        self.format = format or settings.VECTOR_INDEX_FORMAT
+        self.rerankFactor = settings.VECTOR_RERANK_FACTOR if rerankFactor is None else rerankFactor
+        self._partitions = {}
+        self._lock = threading.Lock()
+
+    def partition(self, username):
+        with self._lock:
+            if username not in self._partitions:
+                self._partitions[username] = UserPartition(username, self.format).load()
+            return self._partitions[username]
+
+    def _sources(self):
+        # Stored copies in order of preference: the int8 index reads the
+        # compact binary first, the float32 index the most precise copy.
+        if self.format == 'int8':
+            return [f'${QUANTIZED_FIELD}', f'${FLOAT32_FIELD}', f'${self.path}']
+        return [f'${FLOAT32_FIELD}', f'${self.path}', f'${QUANTIZED_FIELD}']
+
+    def _row(self, partition, stored):
+        # Only the chosen copy is projected, so documents that keep the double
+        # array for Atlas next to the binary never ship both.
+        if isinstance(stored, list):
+            return partition.encode(stored)
+        if partition.format == 'int8' and vectorFormat(stored) == 'int8':
+            return decodeInt8(stored)[0]
+        return partition.encode(decodeVector(stored))
+
+    def sync(self, username, batchSize=1000):
+        partition = self.partition(username)
+        with partition.lock:
+            self._sync(partition, batchSize)
+        return partition
+
+    def _sync(self, partition, batchSize):
+        # Everything that writes or deletes a user's embeddings bumps their
+        # search version, so while it is unchanged the partition is current.
+        # Otherwise the (_id, embeddedAt) pairs stored for the user are
+        # compared with the indexed ones: new and re-embedded vectors are
+        # (re)read, deleted ones dropped, whatever order they were written in.
+        # The version is read first, so a write made during the comparison
+        # bumps it again and is picked up by the next sync.
+        version = searchVersion(self.collection.database, partition.username)
+        if version == partition.version:
+            return
+        query = {'username': partition.username, '$or': [
+            {field: {'$exists': True}} for field in (QUANTIZED_FIELD, FLOAT32_FIELD, self.path)]}
+        stored = {doc['_id']: _stamp(doc.get(EMBEDDED_AT))
+                  for doc in self.collection.find(query, {EMBEDDED_AT: 1}).batch_size(batchSize)}
+        indexed = dict(zip(partition.ids, partition.stamps))
+        changed = [_id for _id, stamp in stored.items() if indexed.get(_id) != stamp]
+        partition.remove([_id for _id in indexed if _id not in stored or _id in changed])
+        first, second, third = self._sources()
+        for start in range(0, len(changed), batchSize):
+            cursor = self.collection.aggregate([
+                {'$match': {'_id': {'$in': changed[start:start + batchSize]}}},
+                {'$project': {'vector': {'$ifNull': [first, {'$ifNull': [second, third]}]}}},
+            ])
+            documents = list(cursor)
+            partition.add([doc['_id'] for doc in documents],
+                          [self._row(partition, doc['vector']) for doc in documents],
+                          [stored[doc['_id']] for doc in documents])
+        partition.version = version
+        partition.save()
+
+    def search(self, username, vector, k):
+        partition = self.partition(username)
+        rerank = partition.format == 'int8' and self.rerankFactor > 0
+        with partition.lock:
+            self._sync(partition, 1000)
+            hits = partition.search(vector, k * self.rerankFactor if rerank else k)
+        if not hits:
+            return []
+        scores = dict(hits)
+        if rerank:
+            # The full-precision copies are fetched for the candidates only.
+            projection = {QUANTIZED_FIELD: 0, EMBEDDED_AT: 0}
+        else:
+            projection = {self.path: 0, QUANTIZED_FIELD: 0, FLOAT32_FIELD: 0, EMBEDDED_AT: 0}
+        documents = self.collection.find({'_id': {'$in': list(scores)}}, projection)
+        results = []
+        query = _normalize(vector)
+        for doc in documents:
+            _id = doc.pop('_id')
+            if rerank:
+                full = fullVector(doc, self.path)
+                if full is not None:
+                    scores[_id] = float(_cosineScore(_normalize(full) @ query))
+                doc.pop(self.path, None)
+                doc.pop(FLOAT32_FIELD, None)
+            doc['score'] = scores[_id]
+            results.append(doc)
+        results.sort(key=lambda doc: doc['score'], reverse=True)
+        return results[:k]
+
+
+def measureRecall(vectors, queries, k=10, rerankFactor=4):
+    # recall@k of the int8 index, with and without re-ranking, against an
+    # exact float32 search over the same vectors.
+    ids = list(range(len(vectors)))
+    exact = UserPartition('recall', 'float32')
+    exact.add(ids, [exact.encode(vector) for vector in vectors])
+    quantized = UserPartition('recall', 'int8')
+    quantized.add(ids, [quantized.encode(vector) for vector in vectors])
+    truth, approximate, reranked = [], [], []
+    for query in queries:
+        truth.append([pos for pos, _ in exact.search(query, k)])
+        approximate.append([pos for pos, _ in quantized.search(query, k)])
+        candidates = [pos for pos, _ in quantized.search(query, k * max(rerankFactor, 1))]
+        candidateScores = exact.vectors[candidates] @ _normalize(query)
+        reranked.append([candidates[pos] for pos in np.argsort(-candidateScores)[:k]])
+    return {'int8': recallAtK(truth, approximate, k),
+            'int8+rerank': recallAtK(truth, reranked, k)}
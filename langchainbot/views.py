@@ -1,62 +1,147 @@
+import os
+import copy
+import asyncio
 import json
-import openai
-import pymongo
-import requests
+import logging
+import threading
+from pymongo.errors import PyMongoError
 from django.conf import settings
 from django.shortcuts import render
 from django.http import JsonResponse
 from django.views.decorators.csrf import csrf_exempt
+from langchainbot.results import resultPage, storeResults
+from langchainbot.searchcache import getSearchCache, searchVersion
+from redditInfo.client import aauthorization, authorization
+from personalized_webapp.aio import csrfExemptAsync, runBlocking, scopedHttpClient
+from personalized_webapp.metrics import UPSTREAM_ERRORS, span
+from personalized_webapp.mongo import getDatabase
+from personalized_webapp.lazy import lazyImport
 
-client = pymongo.MongoClient(settings.MONGO_DB_NAME)
-openai.api_key = settings.OPENAI_API_KEY
+# numpy (and faiss, for the local index) load with the first search.
+embeddings = lazyImport('langchainbot.embeddings')
+
+logger = logging.getLogger(__name__)
+
+_vectorIndex = None
+_vectorIndexPid = None
+_vectorIndexLock = threading.Lock()
+
+
+def getVectorIndex():
+    # Built on first use, per process: its collection belongs to the
+    # process's own MongoClient.
+    global _vectorIndex, _vectorIndexPid
+    with _vectorIndexLock:
+        if _vectorIndex is None or _vectorIndexPid != os.getpid():
+            from langchainbot.vectorindex import VectorIndex
+            _vectorIndex = VectorIndex(getDatabase('redditData')['userRedditData'])
+            _vectorIndexPid = os.getpid()
+        return _vectorIndex
 
 
 def get_embedding(text, model="text-embedding-ada-002"):
-    text = text.replace("\n", " ")
-    return openai.Embedding.create(input=[text], model=model)['data'][0]['embedding']
+    return embeddings.get_embeddings([text], model=model)[0]
+
+
+def atlasSearch(collection, username, vector_query, num_posts):
+    # The pre-filter is an exact match on username, which the search index
+    # maps as a token field (atlas_search_index.json); `text` would match the
+    # analyzed terms of other usernames too.
+    pipeline = copy.deepcopy(settings.SEARCH_PIPELINE)
+    pipeline[0]['$search']['knnBeta']['vector'] = vector_query
+    pipeline[0]['$search']['knnBeta']['k'] = num_posts
+    pipeline[0]['$search']['knnBeta']['filter'] = {
+        'equals': {'path': 'username', 'value': username}
+    }
+    pipeline[2]['$match']['username'] = username
+    return list(collection.aggregate(pipeline))
 
 
-def authorization(body):
-    REDDIT_DATA = {'grant_type': 'password',
-                   'username': body['username'], 'password': body['password']}
+def searchPosts(username, vector_query, num_posts):
+    with span('vector_search'):
+        if settings.VECTOR_SEARCH_ENGINE == 'local':
+            return getVectorIndex().search(username, vector_query, num_posts)
+        return atlasSearch(getDatabase('redditData')['userRedditData'],
+                           username, vector_query, num_posts)
+
+
+def cachedSearch(username, query, vector_query, num_posts):
+    # Repeats (and near repeats) of a user's query are answered from the
+    # search cache until that user's posts or embeddings change.
+    version = searchVersion(getDatabase('redditData'), username)
+    searchCache = getSearchCache()
+    results = searchCache.get(username, query, num_posts, version, vector_query)
+    if results is None:
+        results = searchPosts(username, vector_query, num_posts)
+        searchCache.put(username, query, num_posts, version, vector_query, results)
+    return results
+
+
+def queryParameters(data):
     try:
-        REDDIT_AUTH = requests.auth.HTTPBasicAuth(
-            settings.REDDIT_CLIENT_ID, settings.REDDIT_SECRET)
-        response = requests.post(
-            settings.REDDIT_BASE_URL + 'api/v1/access_token',
-            data=REDDIT_DATA,
-            headers={'user-agent': 'APP-NAME by REDDIT-USERNAME'},
-            auth=REDDIT_AUTH
-        )
-        response = response.json()
-    except:
-        return 'error'
-    return 'bearer ' + response['access_token']
+        return data['query'], int(data['numposts'])
+    except (KeyError, ValueError):
+        return None
 
 
 @csrf_exempt
 def redditQuery(request):
     data = json.loads(request.body)
-    token = authorization(data)
+    with span('reddit.token'):
+        token = authorization(data)
+    if token == 'error':
+        return JsonResponse({'error': 'invalid credentials'})
+    parameters = queryParameters(data)
+    if parameters is None:
+        return JsonResponse({'error': 'error'})
+    query, num_posts = parameters
     try:
-        if token:
-            collection = client['redditData']['userRedditData']
-            query = data['query']
-            num_posts = int(data['numposts'])
-            pipeline = settings.SEARCH_PIPELINE
+        with span('embedding'):
             vector_query = get_embedding(query)
-            pipeline[0]['$search']['knnBeta']['vector'] = vector_query
-            pipeline[0]['$search']['knnBeta']['k'] = num_posts
-            pipeline[2]['$match']['username'] = data['username']
-            cursor = collection.aggregate(pipeline)
-            redditData = []
-            for doc in cursor:
-                redditData.append(doc)
-            return JsonResponse({'response': redditData}, safe=False)
-        else:
-            return JsonResponse({'error': 'invalid credentials'})
-    except:
+    except Exception:
+        logger.exception('Could not embed the query')
+        return JsonResponse({'error': 'error'})
+    try:
+        redditData = cachedSearch(data['username'], query, vector_query, num_posts)
+    except PyMongoError:
+        logger.exception('Vector search failed')
+        UPSTREAM_ERRORS.labels('mongodb').inc()
+        return JsonResponse({'error': 'error'})
+    handle, count = storeResults(redditData)
+    return JsonResponse({'handle': handle, 'count': count})
+
+
+@csrfExemptAsync
+@scopedHttpClient
+async def redditQueryAsync(request):
+    # Same contract as redditQuery; the token grant and the embedding are
+    # awaited over httpx and the search runs on the blocking executor.
+    data = json.loads(request.body)
+    with span('reddit.token'):
+        token = await aauthorization(data)
+    if token == 'error':
+        return JsonResponse({'error': 'invalid credentials'})
+    parameters = queryParameters(data)
+    if parameters is None:
+        return JsonResponse({'error': 'error'})
+    query, num_posts = parameters
+    try:
+        with span('embedding'):
+            vector_query = (await embeddings.aget_embeddings([query]))[0]
+    except Exception:
+        logger.exception('Could not embed the query')
+        return JsonResponse({'error': 'error'})
+    try:
+        redditData = await runBlocking(cachedSearch, data['username'], query, vector_query, num_posts)
+    except asyncio.TimeoutError:
+        UPSTREAM_ERRORS.labels('mongodb').inc()
+        return JsonResponse({'error': 'timeout'}, status=504)
+    except PyMongoError:
+        logger.exception('Vector search failed')
+        UPSTREAM_ERRORS.labels('mongodb').inc()
         return JsonResponse({'error': 'error'})
+    handle, count = await runBlocking(storeResults, redditData)
+    return JsonResponse({'handle': handle, 'count': count})
 
 
 @csrf_exempt
@@ -66,6 +151,10 @@ def searchQuery(request):
 
 @csrf_exempt
 def displayRedditData(request):
-    data = request.GET.get('data', '{}')
-    data = json.loads(data)
-    return render(request, 'display.html', {'response': data['response']})
+    # /display/?handle=<handle from /langchain/>&cursor=<page cursor>
+    handle = request.GET.get('handle', '')
+    page = resultPage(handle, request.GET.get('cursor'))
+    if page is None:
+        return render(request, 'display.html', {'expired': True}, status=404)
+    page['handle'] = handle
+    return render(request, 'display.html', page)
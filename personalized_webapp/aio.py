@@ -0,0 +1,80 @@
+import asyncio
+import functools
+import threading
+import contextvars
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+
+_executor = None
+_executorLock = threading.Lock()
+_clients = weakref.WeakKeyDictionary()
+_requestClient = contextvars.ContextVar('requestClient', default=None)
+
+
+def blockingExecutor():
+    # PyMongo and SQLite calls made by the async views share this bounded
+    # pool, so a slow database queues work instead of spawning threads.
+    global _executor
+    with _executorLock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=settings.BLOCKING_POOL_SIZE,
+                                           thread_name_prefix='blocking')
+        return _executor
+
+
+async def runBlocking(func, *args, timeout=None, **kwargs):
+    # The caller stops waiting after `timeout` seconds; the worker thread
+    # still finishes its call, which PyMongo's own socket timeouts bound.
+    loop = asyncio.get_running_loop()
+    call = functools.partial(contextvars.copy_context().run, func, *args, **kwargs)
+    return await asyncio.wait_for(loop.run_in_executor(blockingExecutor(), call),
+                                  timeout or settings.MONGO_CALL_TIMEOUT)
+
+
+def csrfExemptAsync(view):
+    # django.views.decorators.csrf.csrf_exempt wraps views in a sync function
+    # before Django 5.0, which would hand Django an unawaited coroutine.
+    view.csrf_exempt = True
+    return view
+
+
+def newClient():
+    import httpx
+    return httpx.AsyncClient(
+        timeout=settings.UPSTREAM_TIMEOUT,
+        limits=httpx.Limits(max_connections=settings.HTTP_POOL_SIZE,
+                            max_keepalive_connections=settings.HTTP_POOL_SIZE))
+
+
+def httpClient():
+    # The client of the current request under WSGI (see scopedHttpClient);
+    # otherwise one pooled client per event loop, which under ASGI is a
+    # single client for the life of the process.
+    client = _requestClient.get()
+    if client is not None:
+        return client
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None:
+        client = newClient()
+        _clients[loop] = client
+    return client
+
+
+def scopedHttpClient(view):
+    # Under WSGI Django runs each async view on an event loop of its own that
+    # is closed after the response, so a client pooled on that loop would
+    # never be closed. Such requests get a client that closes with the view.
+    @functools.wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        if isinstance(request, ASGIRequest):
+            return await view(request, *args, **kwargs)
+        async with newClient() as client:
+            token = _requestClient.set(client)
+            try:
+                return await view(request, *args, **kwargs)
+            finally:
+                _requestClient.reset(token)
+    return wrapper
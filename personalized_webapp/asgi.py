@@ -2,6 +2,8 @@
 ASGI config for personalized_webapp project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+Serve it with ``uvicorn personalized_webapp.asgi:application`` and set
+ASYNC_VIEWS=True to route the ingest and search endpoints to their async views.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/4.0/howto/deployment/asgi/
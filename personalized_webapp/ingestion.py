@@ -0,0 +1,96 @@
+import logging
+import threading
+import pymongo
+from pymongo.errors import OperationFailure
+from personalized_webapp import partitions
+from personalized_webapp.metrics import DOCUMENTS_INGESTED, span
+
+logger = logging.getLogger(__name__)
+
+# Natural keys of every ingested collection, as (database, collection): fields.
+NATURAL_KEYS = {
+    ('redditData', 'userRedditData'): ('username', 'url', 'listing'),
+    ('userChromeData', 'history'): ('identity', 'data.id', 'data.lastVisitTime'),
+    ('userChromeData', 'bookmarks'): ('identity', 'url', 'dateAdded'),
+    # chrome.downloads ids are only unique per profile, hence the start time.
+    ('userChromeData', 'downloads'): ('identity', 'id', 'startTime'),
+}
+
+_indexed = set()
+_indexedLock = threading.Lock()
+
+
+def naturalKey(collection):
+    # Month partitions (history_2024_05) share the key of their collection.
+    return NATURAL_KEYS[(collection.database.name, partitions.baseName(collection.name))]
+
+
+def isPartitioned(collection):
+    return (collection.database.name == partitions.DATABASE
+            and collection.name in partitions.PARTITIONED)
+
+
+def ensureIndexes(collection, unique=True):
+    keys = naturalKey(collection)
+    return collection.create_index([(key, pymongo.ASCENDING) for key in keys],
+                                   unique=unique, name='natural_key')
+
+
+def ensureIndexesOnce(collection):
+    # Called from the ingest path so a fresh database gets its unique indexes
+    # on the first write; existing duplicates must first be removed with
+    # `manage.py ensure_indexes --dedupe`.
+    name = (collection.database.name, collection.name)
+    with _indexedLock:
+        if name in _indexed:
+            return
+        _indexed.add(name)
+    try:
+        ensureIndexes(collection)
+    except OperationFailure as error:
+        logger.warning('Could not create natural key index on %s.%s: %s', *name, error)
+
+
+def removeDuplicates(collection):
+    keys = naturalKey(collection)
+    pipeline = [
+        {'$group': {
+            '_id': {key.replace('.', '_'): '$' + key for key in keys},
+            'ids': {'$push': '$_id'},
+            'count': {'$sum': 1},
+        }},
+        {'$match': {'count': {'$gt': 1}}},
+    ]
+    removed = 0
+    for group in collection.aggregate(pipeline, allowDiskUse=True):
+        result = collection.delete_many({'_id': {'$in': group['ids'][1:]}})
+        removed += result.deleted_count
+    return removed
+
+
+def bulkUpsert(collection, documents):
+    # Inserts only the documents whose natural key is not stored yet and
+    # returns them, so repeated syncs of overlapping windows cost no writes.
+    # Chrome events are routed to their partition (see partitions.route).
+    if not documents:
+        return []
+    if isPartitioned(collection):
+        added = []
+        for target, group in partitions.route(collection.database, collection.name, documents):
+            added.extend(upsertInto(target, group))
+        return added
+    return upsertInto(collection, documents)
+
+
+def upsertInto(collection, documents):
+    ensureIndexesOnce(collection)
+    keys = naturalKey(collection)
+    operations = [
+        pymongo.UpdateOne({key: partitions.getPath(document, key) for key in keys},
+                          {'$setOnInsert': document}, upsert=True)
+        for document in documents
+    ]
+    with span('mongo.upsert'):
+        result = collection.bulk_write(operations, ordered=False)
+    DOCUMENTS_INGESTED.labels(partitions.baseName(collection.name)).inc(len(result.upserted_ids))
+    return [documents[index] for index in sorted(result.upserted_ids)]
@@ -0,0 +1,22 @@
+import types
+import importlib
+
+
+class LazyModule(types.ModuleType):
+    # Stands in for a module until one of its attributes is used, then
+    # imports it (under the import system's own per-module lock) and copies
+    # its namespace so later lookups no longer come through here.
+
+    def __init__(self, name):
+        super().__init__(name)
+
+    def __getattr__(self, attribute):
+        module = importlib.import_module(self.__name__)
+        self.__dict__.update(module.__dict__)
+        return getattr(module, attribute)
+
+
+def lazyImport(name):
+    # Keeps heavy libraries (pandas, altair) out of process startup; only the
+    # views that render charts pay for importing them.
+    return LazyModule(name)
@@ -0,0 +1,136 @@
+import os
+import time
+import asyncio
+import ipaddress
+import random
+import contextvars
+from contextlib import contextmanager
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+from prometheus_client import (CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Histogram,
+                               REGISTRY, generate_latest)
+from prometheus_client import multiprocess
+
+BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+
+REQUEST_LATENCY = Histogram(
+    'webapp_request_seconds', 'Time spent answering a request, by view.',
+    ['view', 'method', 'status'], buckets=BUCKETS)
+STAGE_LATENCY = Histogram(
+    'webapp_stage_seconds', 'Time spent in a stage of a request (token fetch, embedding, '
+    'Mongo, pandas, Altair ...).', ['stage'], buckets=BUCKETS)
+DOCUMENTS_INGESTED = Counter(
+    'webapp_documents_ingested', 'Documents newly stored, by collection.', ['collection'])
+CACHE_REQUESTS = Counter(
+    'webapp_cache_requests', 'Cache lookups, by cache and result (hit or miss).',
+    ['cache', 'result'])
+UPSTREAM_ERRORS = Counter(
+    'webapp_upstream_errors', 'Failed calls to Reddit, OpenAI or MongoDB.', ['upstream'])
+
+# Stages timed during the current request, reported in its Server-Timing header.
+_stages = contextvars.ContextVar('stages', default=None)
+
+
+@contextmanager
+def span(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_LATENCY.labels(stage).observe(elapsed)
+        stages = _stages.get()
+        if stages is not None:
+            stages.append((stage, elapsed))
+
+
+def cacheResult(cache, hit):
+    CACHE_REQUESTS.labels(cache, 'hit' if hit else 'miss').inc()
+
+
+def serverTiming(stages):
+    return ', '.join(f'{stage.replace(".", "-")};dur={elapsed * 1000:.1f}'
+                     for stage, elapsed in stages)
+
+
+class MetricsMiddleware:
+    # Times every request by view name and, for a sampled fraction of them,
+    # runs the sampling profiler so that slow requests leave a profile behind.
+    # Async-capable, so the async views under ASGI stay on the event loop.
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        state = self.begin()
+        try:
+            response = self.get_response(request)
+        finally:
+            elapsed, stages = self.end(request, state)
+        return self.finish(request, response, elapsed, stages)
+
+    async def __acall__(self, request):
+        state = self.begin()
+        try:
+            response = await self.get_response(request)
+        finally:
+            elapsed, stages = self.end(request, state)
+        return self.finish(request, response, elapsed, stages)
+
+    def begin(self):
+        token = _stages.set([])
+        profiler = None
+        if settings.PROFILE_SAMPLE_RATE and random.random() < settings.PROFILE_SAMPLE_RATE:
+            from personalized_webapp.profiling import SamplingProfiler
+            profiler = SamplingProfiler(settings.PROFILE_INTERVAL_MS / 1000).start()
+        return token, profiler, time.perf_counter()
+
+    def end(self, request, state):
+        token, profiler, start = state
+        elapsed = time.perf_counter() - start
+        stages = _stages.get()
+        _stages.reset(token)
+        if profiler is not None:
+            profiler.stop()
+            if elapsed * 1000 >= settings.PROFILE_SLOW_REQUEST_MS:
+                profiler.report(request, elapsed)
+        return elapsed, stages
+
+    def finish(self, request, response, elapsed, stages):
+        match = getattr(request, 'resolver_match', None)
+        view = match.view_name if match else 'unmatched'
+        REQUEST_LATENCY.labels(view, request.method, response.status_code).observe(elapsed)
+        if stages:
+            response['Server-Timing'] = serverTiming(stages)
+        return response
+
+
+def registry():
+    # Under a multi-process server every worker writes its samples to
+    # PROMETHEUS_MULTIPROC_DIR and the scrape merges them.
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        merged = CollectorRegistry()
+        multiprocess.MultiProcessCollector(merged)
+        return merged
+    return REGISTRY
+
+
+def scrapeAllowed(request):
+    try:
+        address = ipaddress.ip_address(request.META.get('REMOTE_ADDR', ''))
+    except ValueError:
+        return False
+    return any(address in ipaddress.ip_network(network, strict=False)
+               for network in settings.METRICS_ALLOWED_NETWORKS)
+
+
+def metrics_view(request):
+    if not scrapeAllowed(request):
+        return HttpResponseForbidden()
+    return HttpResponse(generate_latest(registry()), content_type=CONTENT_TYPE_LATEST)
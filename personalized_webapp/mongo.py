@@ -0,0 +1,54 @@
+import os
+import threading
+import pymongo
+from django.conf import settings
+
+_client = None
+_clientPid = None
+_clientLock = threading.Lock()
+
+
+def clientOptions():
+    options = {
+        'maxPoolSize': settings.MONGO_MAX_POOL_SIZE,
+        'minPoolSize': settings.MONGO_MIN_POOL_SIZE,
+        'maxIdleTimeMS': settings.MONGO_MAX_IDLE_TIME_MS,
+        'serverSelectionTimeoutMS': settings.MONGO_SERVER_SELECTION_TIMEOUT_MS,
+        'connectTimeoutMS': settings.MONGO_CONNECT_TIMEOUT_MS,
+        'socketTimeoutMS': settings.MONGO_SOCKET_TIMEOUT_MS,
+        'waitQueueTimeoutMS': settings.MONGO_WAIT_QUEUE_TIMEOUT_MS,
+        # Sockets are opened by the first operation, not by the constructor.
+        'connect': False,
+    }
+    return {name: value for name, value in options.items() if value is not None}
+
+
+def getClient():
+    # The one MongoClient of this process, shared by every app. It is created
+    # on first use, and again in a child process after fork(): a client
+    # inherited from the parent shares its sockets and monitor threads, which
+    # PyMongo does not support, so it is never reused there.
+    global _client, _clientPid
+    if _client is not None and _clientPid == os.getpid():
+        return _client
+    with _clientLock:
+        if _client is None or _clientPid != os.getpid():
+            _client = pymongo.MongoClient(settings.MONGO_DB_NAME, **clientOptions())
+            _clientPid = os.getpid()
+        return _client
+
+
+def getDatabase(name):
+    return getClient()[name]
+
+
+def _afterFork():
+    # The lock may have been held by another thread at fork time.
+    global _client, _clientPid, _clientLock
+    _client = None
+    _clientPid = None
+    _clientLock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_afterFork)
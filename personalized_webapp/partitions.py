@@ -0,0 +1,253 @@
+import re
+import zlib
+import logging
+import threading
+import bson
+import pymongo
+from datetime import datetime, timedelta, timezone
+from pymongo.errors import OperationFailure
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# With CHROME_STORAGE=monthly the raw Chrome events are stored in one
+# collection per calendar month (history_2024_05, ...), so a dashboard window
+# only reads the months it covers and retention drops whole months. Events
+# are placed by a time field that is part of their natural key, so storing
+# the same event again always lands in the same partition.
+PARTITIONED = {
+    # collection: time fields, the first one present decides
+    'history': ('data.lastVisitTime',),
+    'bookmarks': ('dateAdded',),
+    # chrome.downloads may report an empty startTime.
+    'downloads': ('startTime', 'endTime'),
+}
+DATABASE = 'userChromeData'
+SUFFIX = re.compile(r'_(\d{4})_(\d{2})$')
+ARCHIVE_SUFFIX = '_archive'
+# Events per compressed archive document.
+ARCHIVE_CHUNK = 2000
+
+_prepared = set()
+_preparedLock = threading.Lock()
+
+
+def enabled():
+    return settings.CHROME_STORAGE == 'monthly'
+
+
+def baseName(name):
+    return SUFFIX.sub('', name)
+
+
+def getPath(document, path):
+    for part in path.split('.'):
+        if not isinstance(document, dict):
+            return None
+        document = document.get(part)
+    return document
+
+
+def asDatetime(value):
+    # Chrome reports epoch milliseconds (history, bookmarks) or ISO 8601
+    # strings (downloads).
+    try:
+        if isinstance(value, datetime):
+            return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            return datetime.fromtimestamp(value / 1000, timezone.utc)
+        if isinstance(value, str) and value:
+            parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+            return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+    except (ValueError, OverflowError, OSError):
+        pass
+    return None
+
+
+def eventTime(name, document):
+    for path in PARTITIONED[name]:
+        value = asDatetime(getPath(document, path))
+        if value is not None:
+            return value
+    return None
+
+
+def partitionName(name, when):
+    return f'{name}_{when.year:04d}_{when.month:02d}'
+
+
+def monthStart(name):
+    match = SUFFIX.search(name)
+    return datetime(int(match.group(1)), int(match.group(2)), 1, tzinfo=timezone.utc)
+
+
+def nextMonth(when):
+    return datetime(when.year + when.month // 12, when.month % 12 + 1, 1, tzinfo=timezone.utc)
+
+
+def listed(db, name, pattern):
+    pattern = f'^{re.escape(name)}{pattern}$'
+    return sorted(db.list_collection_names(filter={'name': {'$regex': pattern}}))
+
+
+def existing(db, name):
+    # The month partitions of `name` present in the database, oldest first.
+    return listed(db, name, '_\\d{4}_\\d{2}')
+
+
+def allCollections(db, name):
+    # Every collection holding events of `name`: the unpartitioned one, if it
+    # is still there, followed by the month partitions.
+    names = listed(db, name, '(_\\d{4}_\\d{2})?') or [name]
+    return [db[collectionName] for collectionName in names]
+
+
+def sources(db, name, since):
+    # The collections a query over events newer than `since` has to read.
+    if not enabled():
+        return [db[name]]
+    return [db[partition] for partition in existing(db, name)
+            if nextMonth(monthStart(partition)) > since]
+
+
+def holders(db, name, document):
+    # The collections that may store `document`: its partition and, until
+    # migrate_partitions has emptied it, the unpartitioned collection. An
+    # event without a usable time was placed by its ingest time, so every
+    # partition is a candidate.
+    if not enabled():
+        return [db[name]]
+    when = eventTime(name, document)
+    if when is None:
+        return allCollections(db, name)
+    return [db[partitionName(name, when)], db[name]]
+
+
+def retentionDays(name):
+    return settings.CHROME_RETENTION_DAYS.get(name, 0)
+
+
+def retentionCutoff(name):
+    # Events older than this have expired, or None when they are kept forever.
+    days = retentionDays(name)
+    return datetime.now(timezone.utc) - timedelta(days=days) if days else None
+
+
+def ttlSeconds(name):
+    # With archiving, apply_retention removes expired events after rolling
+    # them up; otherwise MongoDB's TTL monitor does.
+    days = retentionDays(name)
+    return days * 86400 if days and not settings.CHROME_RETENTION_ARCHIVE else None
+
+
+def ensureRetentionIndex(collection, replace=False):
+    seconds = ttlSeconds(baseName(collection.name))
+    current = collection.index_information().get('eventTime_ttl')
+    if current is not None and (seconds is None or current.get('expireAfterSeconds') != seconds):
+        if not replace:
+            logger.warning('Retention of %s changed, run manage.py ensure_indexes', collection.name)
+            return
+        collection.drop_index('eventTime_ttl')
+    if seconds is not None:
+        collection.create_index([('eventTime', pymongo.ASCENDING)], name='eventTime_ttl',
+                                expireAfterSeconds=seconds)
+
+
+def prepare(collection):
+    with _preparedLock:
+        if collection.name in _prepared:
+            return
+        _prepared.add(collection.name)
+    try:
+        ensureRetentionIndex(collection)
+    except OperationFailure as error:
+        logger.warning('Could not create the retention index on %s: %s', collection.name, error)
+
+
+def route(db, name, documents):
+    # Stamps each event with its eventTime (read by the TTL index) and groups
+    # the events by the collection they are stored in. Expired events are
+    # skipped, so an extension re-sending them does not store them again
+    # after the TTL index or apply_retention removed (or archived) them.
+    groups = {}
+    now = datetime.now(timezone.utc)
+    cutoff = retentionCutoff(name)
+    skipped = 0
+    for document in documents:
+        document['eventTime'] = eventTime(name, document) or now
+        if cutoff is not None and document['eventTime'] < cutoff:
+            skipped += 1
+            continue
+        target = partitionName(name, document['eventTime']) if enabled() else name
+        groups.setdefault(target, []).append(document)
+    if skipped:
+        logger.info('Skipped %d %s events older than the retention', skipped, name)
+    for target in groups:
+        prepare(db[target])
+    return [(db[target], group) for target, group in groups.items()]
+
+
+def archiveCollection(db, name):
+    return db[name + ARCHIVE_SUFFIX]
+
+
+def archive(db, name, query, source):
+    # Rolls the matching events of `source` into zlib-compressed BSON chunks
+    # of ARCHIVE_CHUNK events in <name>_archive, one set per month, then
+    # deletes them from `source`. Returns the number archived.
+    archived, chunk = 0, []
+
+    def flush():
+        nonlocal archived
+        months = {}
+        for document in chunk:
+            when = document.get('eventTime') or eventTime(name, document) or datetime.now(timezone.utc)
+            months.setdefault(partitionName(name, when)[len(name) + 1:], []).append(document)
+        for month, documents in months.items():
+            archiveCollection(db, name).insert_one({
+                'month': month,
+                'count': len(documents),
+                'encoding': 'bson+zlib',
+                'data': bson.Binary(zlib.compress(b''.join(bson.encode(document) for document in documents))),
+                'archivedAt': datetime.now(timezone.utc),
+            })
+        source.delete_many({'_id': {'$in': [document['_id'] for document in chunk]}})
+        archived += len(chunk)
+        chunk.clear()
+
+    for document in source.find(query).sort('_id', pymongo.ASCENDING):
+        chunk.append(document)
+        if len(chunk) >= ARCHIVE_CHUNK:
+            flush()
+    if chunk:
+        flush()
+    return archived
+
+
+def archivedEvents(db, name, month=None):
+    query = {} if month is None else {'month': month}
+    for entry in archiveCollection(db, name).find(query).sort('month', pymongo.ASCENDING):
+        yield from bson.decode_all(zlib.decompress(entry['data']))
+
+
+def expire(db, name, archiveExpired=None):
+    # Applies the retention of `name`: month partitions that ended before the
+    # cutoff are dropped whole, older events elsewhere are deleted, in both
+    # cases after being archived when requested. Returns {collection: count}.
+    cutoff = retentionCutoff(name)
+    if cutoff is None:
+        return {}
+    if archiveExpired is None:
+        archiveExpired = settings.CHROME_RETENTION_ARCHIVE
+    removed = {}
+    for collection in allCollections(db, name):
+        if SUFFIX.search(collection.name) and nextMonth(monthStart(collection.name)) <= cutoff:
+            count = archive(db, name, {}, collection) if archiveExpired else collection.estimated_document_count()
+            collection.drop()
+        elif archiveExpired:
+            count = archive(db, name, {'eventTime': {'$lt': cutoff}}, collection)
+        else:
+            count = collection.delete_many({'eventTime': {'$lt': cutoff}}).deleted_count
+        if count:
+            removed[collection.name] = count
+    return removed
@@ -0,0 +1,62 @@
+import os
+import sys
+import time
+import logging
+import threading
+from collections import Counter
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+def collapse(frame):
+    # One line of the collapsed-stack format read by flamegraph.pl/speedscope.
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append(f'{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}')
+        frame = frame.f_back
+    return ';'.join(reversed(stack))
+
+
+class SamplingProfiler:
+    # Samples the stack of the thread that started it every `interval`
+    # seconds from a helper thread. Cheap enough to leave on for a sample of
+    # production requests, unlike cProfile which instruments every call.
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.samples = Counter()
+        self._target = None
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._target = threading.get_ident()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self._target)
+            if frame is not None:
+                self.samples[collapse(frame)] += 1
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        return self
+
+    def report(self, request, elapsed, top=10):
+        logger.warning('Slow request %s %s took %.0f ms, hottest stacks:\n%s',
+                       request.method, request.path, elapsed * 1000,
+                       '\n'.join(f'{count} {stack}' for stack, count in self.samples.most_common(top)))
+        if not settings.PROFILE_DIR:
+            return
+        os.makedirs(settings.PROFILE_DIR, exist_ok=True)
+        name = f"{time.strftime('%Y%m%d-%H%M%S')}-{request.path.strip('/').replace('/', '_') or 'root'}.folded"
+        with open(os.path.join(settings.PROFILE_DIR, name), 'w') as handle:
+            for stack, count in self.samples.items():
+                handle.write(f'{stack} {count}\n')
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.0/ref/settings/
 """
 import os
+from corsheaders.defaults import default_headers
 from pathlib import Path
 from dotenv import load_dotenv
 load_dotenv()
@@ -34,6 +35,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'personalized_webapp.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -45,6 +47,8 @@ MIDDLEWARE = [
 ]
 
 CORS_ORIGIN_ALLOW_ALL = True
+# The extension gzips its /ingest/ uploads.
+CORS_ALLOW_HEADERS = (*default_headers, 'content-encoding')
 # CORS_ORIGIN_WHITELIST = [os.getenv("CORS_ORIGIN_WHITELIST")]
 ROOT_URLCONF = 'personalized_webapp.urls'
 
@@ -68,13 +72,34 @@ WSGI_APPLICATION = 'personalized_webapp.wsgi.application'
 
 MONGO_DB_NAME = os.getenv("MONGO_DB_NAME")
 
+
+def optionalInt(name, default=None):
+    value = os.getenv(name)
+    return default if value in (None, '') else int(value) or None
+
+
+# Connection pool of the MongoClient shared by all apps
+# (personalized_webapp.mongo); one per process. 0 leaves a timeout unset.
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", 50))
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", 0))
+MONGO_MAX_IDLE_TIME_MS = optionalInt("MONGO_MAX_IDLE_TIME_MS", 300000)
+MONGO_SERVER_SELECTION_TIMEOUT_MS = optionalInt("MONGO_SERVER_SELECTION_TIMEOUT_MS", 10000)
+MONGO_CONNECT_TIMEOUT_MS = optionalInt("MONGO_CONNECT_TIMEOUT_MS", 10000)
+MONGO_SOCKET_TIMEOUT_MS = optionalInt("MONGO_SOCKET_TIMEOUT_MS")
+MONGO_WAIT_QUEUE_TIMEOUT_MS = optionalInt("MONGO_WAIT_QUEUE_TIMEOUT_MS")
+# djongo keeps its own client for the Django ORM (sessions, admin), which
+# needs only a few connections.
+DJONGO_MAX_POOL_SIZE = int(os.getenv("DJONGO_MAX_POOL_SIZE", 5))
+
 DATABASES = {
     'default': {
         'ENGINE': 'djongo',
         'NAME': 'mldevelopment',
         'ENFORCE_SCHEMA': False,
         'CLIENT': {
-                'host': MONGO_DB_NAME
+                'host': MONGO_DB_NAME,
+                'maxPoolSize': DJONGO_MAX_POOL_SIZE,
+                'connect': False,
         }
     }
 }
@@ -109,8 +134,140 @@ REDDIT_BASE_URL = 'https://www.reddit.com/'
 REDDIT_OAUTH_URL = 'https://oauth.reddit.com'
 REDDIT_CLIENT_ID = os.getenv("REDDIT_CLIENT_ID")
 REDDIT_SECRET = os.getenv("REDDIT_SECRET")
+REDDIT_INGEST_CONCURRENCY = int(os.getenv("REDDIT_INGEST_CONCURRENCY", 4))
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 
+# 'atlas' runs SEARCH_PIPELINE on MongoDB Atlas, 'local' uses the per-user
+# vector index persisted under VECTOR_INDEX_DIR.
+VECTOR_SEARCH_ENGINE = os.getenv("VECTOR_SEARCH_ENGINE", "atlas")
+VECTOR_INDEX_DIR = os.getenv(
+    "VECTOR_INDEX_DIR", os.path.join(BASE_DIR, "data", "vectorindex"))
+# 'float32' or 'int8' vectors held by the local index. int8 searches score
+# k * VECTOR_RERANK_FACTOR candidates on the codes, then re-rank them with
+# their full-precision vectors (0 returns the int8 ranking as is).
+VECTOR_INDEX_FORMAT = os.getenv("VECTOR_INDEX_FORMAT", "float32")
+VECTOR_RERANK_FACTOR = int(os.getenv("VECTOR_RERANK_FACTOR", 4))
+# How new embeddings are stored: 'array' writes plot_embedding as BSON
+# doubles (needed by Atlas knnBeta), 'float32'/'int8' the compact binary
+# plot_embedding_q read by the local index. EMBEDDING_KEEP_FLOAT32 stores a
+# float32 copy next to the int8 codes for re-ranking.
+EMBEDDING_STORAGE = os.getenv("EMBEDDING_STORAGE", "array")
+EMBEDDING_KEEP_FLOAT32 = os.getenv("EMBEDDING_KEEP_FLOAT32", "False") == "True"
+
+# Any class exposing embed(texts, model) and maxBatchSize can back the cache,
+# e.g. 'langchainbot.embeddings.FakeEmbedder' for offline runs.
+EMBEDDING_PROVIDER = os.getenv(
+    "EMBEDDING_PROVIDER", "langchainbot.embeddings.OpenAIEmbedder")
+EMBEDDING_CACHE_MEMORY_BYTES = int(
+    os.getenv("EMBEDDING_CACHE_MEMORY_BYTES", 64 * 1024 * 1024))
+EMBEDDING_CACHE_PATH = os.getenv(
+    "EMBEDDING_CACHE_PATH", os.path.join(BASE_DIR, "data", "embeddings.sqlite3"))
+
+# 'rollups' renders /visual/ from the pre-aggregated rollup collections kept
+# up to date by the chromepipeline ingest endpoints, 'raw' from the events.
+# The raw events are also used until rebuild_rollups has run once.
+DASHBOARD_SOURCE = os.getenv("DASHBOARD_SOURCE", "rollups")
+# Upper bound on the (time bucket, domain) points of the visit activity
+# scatter; /visual/?points= overrides it per request.
+ACTIVITY_POINT_BUDGET = int(os.getenv("ACTIVITY_POINT_BUDGET", 2000))
+# Re-render the dashboard in the background after each ingest.
+DASHBOARD_WARM_CACHE = os.getenv("DASHBOARD_WARM_CACHE", "False") == "True"
+
+# Fraction of requests run under the sampling profiler; those slower than
+# PROFILE_SLOW_REQUEST_MS log their hottest stacks and write a collapsed-stack
+# file to PROFILE_DIR.
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", 0))
+PROFILE_SLOW_REQUEST_MS = int(os.getenv("PROFILE_SLOW_REQUEST_MS", 1000))
+PROFILE_INTERVAL_MS = int(os.getenv("PROFILE_INTERVAL_MS", 5))
+PROFILE_DIR = os.getenv("PROFILE_DIR", os.path.join(BASE_DIR, "data", "profiles"))
+# Comma-separated addresses or networks allowed to scrape /metrics, matched
+# against REMOTE_ADDR (behind a proxy, that is the proxy's address).
+METRICS_ALLOWED_NETWORKS = [network.strip() for network in os.getenv(
+    "METRICS_ALLOWED_NETWORKS", "127.0.0.1,::1").split(',') if network.strip()]
+
+# Route /routine/, /downloads/, /reddit/ and /langchain/ to their async
+# views; meant for the ASGI app (uvicorn personalized_webapp.asgi:application).
+ASYNC_VIEWS = os.getenv("ASYNC_VIEWS", "False") == "True"
+# Threads running PyMongo/SQLite calls for the async views, and how long a
+# view waits on one of them (seconds).
+BLOCKING_POOL_SIZE = int(os.getenv("BLOCKING_POOL_SIZE", 32))
+MONGO_CALL_TIMEOUT = float(os.getenv("MONGO_CALL_TIMEOUT", 30))
+# Timeout (seconds) and connection pool of the async Reddit/OpenAI client.
+UPSTREAM_TIMEOUT = float(os.getenv("UPSTREAM_TIMEOUT", 15))
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", 100))
+
+# Queue history/download documents in a per-process write-behind buffer that
+# flushes unordered bulk writes every WRITE_BEHIND_BATCH_SIZE documents or
+# WRITE_BEHIND_FLUSH_MS. Submitting blocks up to WRITE_BEHIND_BLOCK_SECONDS
+# while WRITE_BEHIND_CAPACITY documents are queued, then answers 503. Failed
+# or undrained batches are spilled to WRITE_BEHIND_SPILL_DIR ('' disables it)
+# and replayed every WRITE_BEHIND_REPLAY_SECONDS; without a spill directory a
+# batch is dropped after WRITE_BEHIND_MAX_ATTEMPTS failed writes.
+WRITE_BEHIND = os.getenv("WRITE_BEHIND", "False") == "True"
+WRITE_BEHIND_BATCH_SIZE = int(os.getenv("WRITE_BEHIND_BATCH_SIZE", 1000))
+WRITE_BEHIND_FLUSH_MS = int(os.getenv("WRITE_BEHIND_FLUSH_MS", 200))
+WRITE_BEHIND_CAPACITY = int(os.getenv("WRITE_BEHIND_CAPACITY", 50000))
+WRITE_BEHIND_BLOCK_SECONDS = float(os.getenv("WRITE_BEHIND_BLOCK_SECONDS", 5))
+WRITE_BEHIND_DRAIN_SECONDS = float(os.getenv("WRITE_BEHIND_DRAIN_SECONDS", 30))
+WRITE_BEHIND_SPILL_DIR = os.getenv(
+    "WRITE_BEHIND_SPILL_DIR", os.path.join(BASE_DIR, "data", "writebehind"))
+WRITE_BEHIND_REPLAY_SECONDS = float(os.getenv("WRITE_BEHIND_REPLAY_SECONDS", 60))
+WRITE_BEHIND_MAX_ATTEMPTS = int(os.getenv("WRITE_BEHIND_MAX_ATTEMPTS", 5))
+
+# /ingest/ reads request bodies INGEST_READ_BYTES at a time, rejects NDJSON
+# lines over INGEST_MAX_LINE_BYTES and writes records in chunks of
+# INGEST_CHUNK_SIZE per type and identity.
+INGEST_READ_BYTES = int(os.getenv("INGEST_READ_BYTES", 64 * 1024))
+INGEST_MAX_LINE_BYTES = int(os.getenv("INGEST_MAX_LINE_BYTES", 1024 * 1024))
+INGEST_CHUNK_SIZE = int(os.getenv("INGEST_CHUNK_SIZE", 500))
+
+# Domains are stored with each Chrome event, split at the public suffix
+# (www.bbc.co.uk -> bbc, bbc.co.uk). Point this at a copy of
+# https://publicsuffix.org/list/public_suffix_list.dat for the full list;
+# unset, a built-in list of common multi-label suffixes is used. Events
+# stored earlier keep the domains they were stored with.
+PUBLIC_SUFFIX_LIST_PATH = os.getenv("PUBLIC_SUFFIX_LIST_PATH")
+
+# 'monthly' stores Chrome history, bookmarks and downloads in one collection
+# per month (history_2024_05, ...) so the dashboard only reads the months its
+# window covers; move existing events with `manage.py migrate_partitions`.
+CHROME_STORAGE = os.getenv("CHROME_STORAGE", "single")
+# Days Chrome events are kept (0 keeps them forever). Expired events are
+# removed by a TTL index, or with CHROME_RETENTION_ARCHIVE rolled into
+# compressed <collection>_archive documents by `manage.py apply_retention`.
+CHROME_RETENTION_DAYS = {
+    'history': int(os.getenv("HISTORY_RETENTION_DAYS", 0)),
+    'bookmarks': int(os.getenv("BOOKMARKS_RETENTION_DAYS", 0)),
+    'downloads': int(os.getenv("DOWNLOADS_RETENTION_DAYS", 0)),
+}
+CHROME_RETENTION_ARCHIVE = os.getenv("CHROME_RETENTION_ARCHIVE", "False") == "True"
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # Rendered /visual/ pages keyed by their ETag (identity, day and data
+    # versions); a day's pages are not needed once the windows move on.
+    'dashboard': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'dashboard',
+        'TIMEOUT': int(os.getenv("DASHBOARD_CACHE_TTL", 24 * 3600)),
+        'OPTIONS': {'MAX_ENTRIES': int(os.getenv("DASHBOARD_CACHE_ENTRIES", 64))},
+    },
+}
+# /langchain/ keeps the results of recent searches per user, until they
+# expire, are evicted (least recently used first) or the user's posts change.
+# A query whose embedding is within SEARCH_CACHE_MAX_DISTANCE cosine distance
+# of a cached query of the same user reuses its results (0 disables that).
+SEARCH_CACHE_ENTRIES = int(os.getenv("SEARCH_CACHE_ENTRIES", 1024))
+SEARCH_CACHE_TTL = int(os.getenv("SEARCH_CACHE_TTL", 600))
+SEARCH_CACHE_MAX_DISTANCE = float(os.getenv("SEARCH_CACHE_MAX_DISTANCE", 0.05))
+# Seconds a search result handle stays valid, and posts per /display/ page.
+# The pages are stored in the redditData.searchResults collection, removed
+# by a TTL index once expired.
+SEARCH_RESULT_TTL = int(os.getenv("SEARCH_RESULT_TTL", 1800))
+SEARCH_PAGE_SIZE = int(os.getenv("SEARCH_PAGE_SIZE", 20))
+
 SEARCH_PIPELINE = [
     {
         "$search": {
@@ -124,6 +281,9 @@ SEARCH_PIPELINE = [
     {
         "$project": {
             "plot_embedding": 0,
+            "plot_embedding_q": 0,
+            "plot_embedding_f32": 0,
+            "embeddedAt": 0,
             "_id": 0,
             'score': {
                 '$meta': 'searchScore'
@@ -0,0 +1,37 @@
+import os
+import bson
+import mongomock
+from mongomock.collection import Collection
+from chromepipeline import bookmarks
+from langchainbot import results
+from personalized_webapp import ingestion, mongo, partitions
+from visualization import rollups
+
+
+def aggregateRawBatches(self, pipeline, batchSize=1000, **kwargs):
+    # mongomock has no raw batch cursors; encode the results the same way.
+    documents = list(self.aggregate(pipeline))
+    for start in range(0, len(documents), batchSize):
+        yield b''.join(bson.encode(document) for document in documents[start:start + batchSize])
+
+
+class MongoMockMixin:
+    # Points the shared MongoClient at a fresh in-memory mongomock client for
+    # every test, and forgets the indexes created on the previous one.
+
+    def setUp(self):
+        super().setUp()
+        Collection.aggregate_raw_batches = aggregateRawBatches
+        self.client = mongomock.MongoClient()
+        self.previousClient = (mongo._client, mongo._clientPid)
+        mongo._client, mongo._clientPid = self.client, os.getpid()
+        ingestion._indexed.clear()
+        partitions._prepared.clear()
+        bookmarks._uploadsIndexed = False
+        bookmarks._leavesIndexed = False
+        results._indexed = False
+        rollups.resetIndexes()
+
+    def tearDown(self):
+        mongo._client, mongo._clientPid = self.previousClient
+        super().tearDown()
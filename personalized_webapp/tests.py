@@ -0,0 +1,363 @@
+import os
+import sys
+import time
+import asyncio
+import shutil
+import tempfile
+import unittest
+import threading
+import subprocess
+from unittest import mock
+from asgiref.sync import async_to_sync
+from bson import json_util
+from django.http import HttpResponse
+from django.test import AsyncRequestFactory, RequestFactory, SimpleTestCase, override_settings
+from prometheus_client import REGISTRY
+from personalized_webapp import mongo
+from personalized_webapp.aio import httpClient, scopedHttpClient
+from personalized_webapp.lazy import LazyModule, lazyImport
+from personalized_webapp.metrics import MetricsMiddleware, metrics_view, span
+from personalized_webapp.writebehind import BufferFull, WriteBehindBuffer
+
+
+def deadPid():
+    process = subprocess.Popen([sys.executable, '-c', ''])
+    process.wait()
+    return process.pid
+
+
+class WriteBehindMixin:
+
+    def setUp(self):
+        super().setUp()
+        self.written = []
+        self.wrote = threading.Event()
+        self.failing = False
+        self.buffers = []
+
+    def tearDown(self):
+        for buffer in self.buffers:
+            buffer.close(5)
+        super().tearDown()
+
+    def handler(self, documents):
+        if self.failing:
+            raise RuntimeError('write failed')
+        self.written.extend(documents)
+        self.wrote.set()
+
+    def makeBuffer(self, **options):
+        buffer = WriteBehindBuffer(**options)
+        buffer.register('history', self.handler)
+        self.buffers.append(buffer)
+        return buffer
+
+
+class WriteBehindTests(WriteBehindMixin, SimpleTestCase):
+
+    def testFlushesFullBatches(self):
+        buffer = self.makeBuffer(batchSize=3, flushInterval=60)
+        buffer.submit('history', [{'n': 1}, {'n': 2}])
+        self.assertFalse(self.wrote.wait(0.2))
+        buffer.submit('history', [{'n': 3}])
+        self.assertTrue(self.wrote.wait(5))
+        self.assertEqual(self.written, [{'n': 1}, {'n': 2}, {'n': 3}])
+
+    def testFlushesAfterTheInterval(self):
+        buffer = self.makeBuffer(batchSize=100, flushInterval=0.05)
+        buffer.submit('history', [{'n': 1}])
+        self.assertTrue(self.wrote.wait(5))
+        self.assertEqual(self.written, [{'n': 1}])
+
+    def testRaisesBufferFullWhenAtCapacity(self):
+        buffer = self.makeBuffer(batchSize=100, flushInterval=60, capacity=2)
+        buffer.submit('history', [{'n': 1}, {'n': 2}])
+        with self.assertRaises(BufferFull):
+            buffer.submit('history', [{'n': 3}], timeout=0.05)
+        self.assertTrue(buffer.flush(5))
+        buffer.submit('history', [{'n': 3}], timeout=0.05)
+
+    def testCloseDrainsTheQueue(self):
+        buffer = self.makeBuffer(batchSize=100, flushInterval=60)
+        buffer.submit('history', [{'n': 1}, {'n': 2}])
+        buffer.close(5)
+        self.assertEqual(self.written, [{'n': 1}, {'n': 2}])
+
+    def testDropsABatchAfterMaxAttempts(self):
+        buffer = self.makeBuffer(flushInterval=0.01, maxAttempts=3)
+        self.failing = True
+        with self.assertLogs('personalized_webapp.writebehind', 'ERROR') as logs:
+            buffer.submit('history', [{'n': 1}])
+            self.assertTrue(buffer.flush(5))
+        self.assertEqual(sum('flush of 1 history' in line for line in logs.output), 3)
+        self.assertIn('Dropping 1 history documents', logs.output[-1])
+        # The target is not blocked by the dropped batch.
+        self.failing = False
+        buffer.submit('history', [{'n': 2}])
+        self.assertTrue(buffer.flush(5))
+        self.assertEqual(self.written, [{'n': 2}])
+
+
+class WriteBehindSpillTests(WriteBehindMixin, SimpleTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.TemporaryDirectory()
+        self.spillDir = self.directory.name
+
+    def tearDown(self):
+        super().tearDown()
+        self.directory.cleanup()
+
+    def writeSpill(self, pid, documents, tail=''):
+        path = os.path.join(self.spillDir, f'spill-{pid}.jsonl')
+        with open(path, 'w') as handle:
+            for document in documents:
+                handle.write(json_util.dumps({'target': 'history', 'document': document}) + '\n')
+            handle.write(tail)
+        return path
+
+    def testSpillsFailedBatchesAndReplaysThem(self):
+        buffer = self.makeBuffer(flushInterval=0.01, spillDir=self.spillDir, replayInterval=3600)
+        self.failing = True
+        with self.assertLogs('personalized_webapp.writebehind', 'ERROR'):
+            buffer.submit('history', [{'n': 1}, {'n': 2}])
+            self.assertTrue(buffer.flush(5))
+        self.assertEqual(os.listdir(self.spillDir), [f'spill-{os.getpid()}.jsonl'])
+        self.failing = False
+        with self.assertLogs('personalized_webapp.writebehind', 'WARNING'):
+            self.assertEqual(buffer.replaySpill(), 2)
+        self.assertEqual(self.written, [{'n': 1}, {'n': 2}])
+        self.assertEqual(os.listdir(self.spillDir), [])
+
+    def testReplaySkipsTruncatedLines(self):
+        self.writeSpill(deadPid(), [{'n': 1}, {'n': 2}], tail='{"target": "history", "docu')
+        with open(os.path.join(self.spillDir, f'spill-{deadPid()}.jsonl'), 'w') as handle:
+            handle.write('not json\n' + json_util.dumps({'target': 'history', 'document': {'n': 3}}) + '\n')
+        buffer = self.makeBuffer(flushInterval=0.01, spillDir=self.spillDir)
+        with self.assertLogs('personalized_webapp.writebehind', 'ERROR') as logs:
+            buffer.submit('history', [{'n': 4}])
+            self.assertTrue(buffer.flush(5))
+        self.assertEqual(sum('unreadable line' in line for line in logs.output), 2)
+        self.assertEqual(sorted(document['n'] for document in self.written), [1, 2, 3, 4])
+        self.assertEqual(os.listdir(self.spillDir), [])
+
+    def testLeavesSpillsOfLiveProcesses(self):
+        # Still written by a live worker, and being replayed by one.
+        live = self.writeSpill(os.getppid(), [{'n': 1}])
+        replaying = self.writeSpill(deadPid(), [{'n': 2}]) + f'.replay-{os.getppid()}'
+        os.replace(replaying.rsplit('.replay-')[0], replaying)
+        # Left behind by a worker that died while replaying it.
+        orphan = self.writeSpill(deadPid(), [{'n': 3}])
+        os.replace(orphan, f'{orphan}.replay-{deadPid()}')
+        buffer = self.makeBuffer(flushInterval=0.01, spillDir=self.spillDir)
+        with self.assertLogs('personalized_webapp.writebehind', 'WARNING'):
+            self.assertEqual(buffer.replaySpill(), 1)
+        self.assertEqual(self.written, [{'n': 3}])
+        self.assertEqual(sorted(os.listdir(self.spillDir)),
+                         sorted([os.path.basename(live), os.path.basename(replaying)]))
+
+    def testReplaysPeriodically(self):
+        buffer = self.makeBuffer(flushInterval=0.01, spillDir=self.spillDir, replayInterval=0.05)
+        buffer.submit('history', [{'n': 1}])
+        self.assertTrue(buffer.flush(5))
+        self.wrote.clear()
+        with self.assertLogs('personalized_webapp.writebehind', 'WARNING'):
+            self.writeSpill(deadPid(), [{'n': 2}])
+            self.assertTrue(self.wrote.wait(5))
+            # The replay is counted in flight until it has logged.
+            self.assertTrue(buffer.flush(5))
+        self.assertEqual(self.written, [{'n': 1}, {'n': 2}])
+
+
+class ScopedHttpClientTests(SimpleTestCase):
+
+    def setUp(self):
+        self.view = scopedHttpClient(self.clientOf)
+
+    async def clientOf(self, request):
+        return httpClient()
+
+    def testWsgiRequestsCloseTheirClient(self):
+        # Django runs async views on a new event loop per WSGI request.
+        first = async_to_sync(self.view)(RequestFactory().get('/'))
+        second = async_to_sync(self.view)(RequestFactory().get('/'))
+        self.assertIsNot(first, second)
+        self.assertTrue(first.is_closed and second.is_closed)
+
+    def testAsgiRequestsShareTheLoopsClient(self):
+        async def serve():
+            first = await self.view(AsyncRequestFactory().get('/'))
+            second = await self.view(AsyncRequestFactory().get('/'))
+            self.assertIs(first, second)
+            self.assertIs(first, httpClient())
+            self.assertFalse(first.is_closed)
+            await first.aclose()
+        asyncio.run(serve())
+
+
+@override_settings(PROFILE_SAMPLE_RATE=0)
+class MetricsTests(SimpleTestCase):
+
+    def requests(self, status=200):
+        return REGISTRY.get_sample_value('webapp_request_seconds_count', {
+            'view': 'unmatched', 'method': 'GET', 'status': str(status)}) or 0
+
+    def stages(self, response):
+        return [entry.split(';')[0] for entry in response['Server-Timing'].split(', ')]
+
+    def testTimesSyncRequests(self):
+        def view(request):
+            with span('outer'):
+                with span('inner.step'):
+                    pass
+            return HttpResponse(status=201)
+        before = self.requests(201)
+        response = MetricsMiddleware(view)(RequestFactory().get('/'))
+        # Nested spans are reported as they finish, innermost first.
+        self.assertEqual(self.stages(response), ['inner-step', 'outer'])
+        self.assertRegex(response['Server-Timing'], r'^inner-step;dur=\d+\.\d, outer;dur=\d+\.\d$')
+        self.assertEqual(self.requests(201), before + 1)
+        self.assertGreaterEqual(REGISTRY.get_sample_value('webapp_stage_seconds_count', {'stage': 'outer'}), 1)
+
+    def testTimesAsyncRequestsSeparately(self):
+        async def view(request):
+            with span(request.path.strip('/')):
+                await asyncio.sleep(0.01)
+            return HttpResponse()
+        middleware = MetricsMiddleware(view)
+
+        async def serve():
+            return await asyncio.gather(*[middleware(AsyncRequestFactory().get(f'/{name}/'))
+                                          for name in ('a', 'b')])
+        before = self.requests()
+        first, second = asyncio.run(serve())
+        self.assertEqual((self.stages(first), self.stages(second)), (['a'], ['b']))
+        self.assertEqual(self.requests(), before + 2)
+
+    def testNoHeaderWithoutSpans(self):
+        response = MetricsMiddleware(lambda request: HttpResponse())(RequestFactory().get('/'))
+        self.assertFalse(response.has_header('Server-Timing'))
+
+    def testProfilesSlowRequests(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+
+        def view(request):
+            deadline = time.perf_counter() + 0.05
+            while time.perf_counter() < deadline:
+                pass
+            return HttpResponse()
+        with override_settings(PROFILE_SAMPLE_RATE=1, PROFILE_SLOW_REQUEST_MS=10,
+                               PROFILE_INTERVAL_MS=1, PROFILE_DIR=directory), \
+                self.assertLogs('personalized_webapp.profiling', 'WARNING') as logs:
+            MetricsMiddleware(view)(RequestFactory().get('/slow/page/'))
+        self.assertIn('Slow request GET /slow/page/', logs.output[0])
+        [name] = os.listdir(directory)
+        self.assertTrue(name.endswith('-slow_page.folded'))
+        with open(os.path.join(directory, name)) as handle:
+            self.assertIn('tests.py:view:', handle.read())
+
+    def testMetricsOutput(self):
+        response = metrics_view(RequestFactory().get('/metrics', REMOTE_ADDR='127.0.0.1'))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'# TYPE webapp_request_seconds histogram', response.content)
+        self.assertIn(b'webapp_upstream_errors', response.content)
+
+    def testMetricsAllowList(self):
+        def scrape(address):
+            return metrics_view(RequestFactory().get('/metrics', REMOTE_ADDR=address)).status_code
+        self.assertEqual(scrape('::1'), 200)
+        self.assertEqual(scrape('10.1.2.3'), 403)
+        self.assertEqual(scrape('not an address'), 403)
+        with override_settings(METRICS_ALLOWED_NETWORKS=['10.0.0.0/8']):
+            self.assertEqual(scrape('10.1.2.3'), 200)
+            self.assertEqual(scrape('127.0.0.1'), 403)
+
+
+class MongoClientTests(SimpleTestCase):
+
+    def setUp(self):
+        previous = (mongo._client, mongo._clientPid)
+        self.addCleanup(setattr, mongo, '_clientPid', previous[1])
+        self.addCleanup(setattr, mongo, '_client', previous[0])
+        mongo._client = mongo._clientPid = None
+        patcher = mock.patch('pymongo.MongoClient', side_effect=lambda *args, **options: object())
+        self.MongoClient = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def testSharesOneClient(self):
+        self.assertIs(mongo.getClient(), mongo.getClient())
+        self.assertEqual(self.MongoClient.call_count, 1)
+        self.assertFalse(self.MongoClient.call_args.kwargs['connect'])
+
+    def testSharesOneClientAcrossThreads(self):
+        clients = []
+        threads = [threading.Thread(target=lambda: clients.append(mongo.getClient())) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len({id(client) for client in clients}), 1)
+        self.assertEqual(self.MongoClient.call_count, 1)
+
+    def testNewClientInAnotherProcess(self):
+        parent = mongo.getClient()
+        with mock.patch('os.getpid', return_value=os.getpid() + 1):
+            child = mongo.getClient()
+            self.assertIsNot(child, parent)
+            self.assertIs(mongo.getClient(), child)
+        self.assertEqual(self.MongoClient.call_count, 2)
+
+    @mock.patch.object(mongo.settings, 'MONGO_MAX_POOL_SIZE', 5, create=True)
+    @mock.patch.object(mongo.settings, 'MONGO_MIN_POOL_SIZE', None, create=True)
+    def testOmitsUnsetOptions(self):
+        options = mongo.clientOptions()
+        self.assertEqual(options['maxPoolSize'], 5)
+        self.assertNotIn('minPoolSize', options)
+
+    @unittest.skipUnless(hasattr(os, 'register_at_fork'), 'needs os.register_at_fork')
+    def testForkedChildDropsTheClient(self):
+        mongo.getClient()
+        read, write = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            # Exit without running the parent's test machinery.
+            try:
+                os.write(write, b'%d' % (mongo._client is None and mongo._clientPid is None))
+            finally:
+                os._exit(0)
+        os.close(write)
+        with os.fdopen(read) as handle:
+            reset = handle.read()
+        os.waitpid(pid, 0)
+        self.assertEqual(reset, '1')
+        self.assertIsNotNone(mongo._client)
+
+
+class LazyModuleTests(SimpleTestCase):
+
+    def testImportsOnFirstAttribute(self):
+        module = lazyImport('colorsys')
+        self.assertIsInstance(module, LazyModule)
+        self.assertNotIn('hls_to_rgb', module.__dict__)
+        self.assertEqual(module.rgb_to_hls(0, 0, 0), (0, 0, 0))
+        # Later lookups find the copied namespace instead of __getattr__.
+        self.assertIs(module.__dict__['hls_to_rgb'], sys.modules['colorsys'].hls_to_rgb)
+
+    def testDoesNotImportUntilUsed(self):
+        with mock.patch('importlib.import_module') as importModule:
+            module = lazyImport('personalized_webapp.tests_lazy_target')
+            importModule.assert_not_called()
+            module.value
+            importModule.assert_called_once_with('personalized_webapp.tests_lazy_target')
+
+    def testMissingAttributesRaise(self):
+        module = lazyImport('colorsys')
+        with self.assertRaises(AttributeError):
+            module.missing
+
+    def testMissingModulesRaiseOnUse(self):
+        module = lazyImport('personalized_webapp.no_such_module')
+        with self.assertRaises(ModuleNotFoundError):
+            module.anything
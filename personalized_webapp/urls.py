@@ -14,20 +14,27 @@ Including another URLconf
     1. Import the include() function: from django.urls import include, path
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
+from django.conf import settings
 from django.contrib import admin
 from django.urls import path
 from chromepipeline import views as chromeviews
 from visualization import views as visviews
 from redditInfo import views as redditviews
 from langchainbot import views as langchainviews
+from personalized_webapp.metrics import metrics_view
 
 urlpatterns = [
     path("admin/", admin.site.urls),
-    path('downloads/', chromeviews.downloads),
-    path('routine/', chromeviews.routines),
+    path('downloads/', chromeviews.downloadsAsync if settings.ASYNC_VIEWS else chromeviews.downloads),
+    path('routine/', chromeviews.routinesAsync if settings.ASYNC_VIEWS else chromeviews.routines),
+    path('ingest/', chromeviews.batchIngest, name='batch_ingest'),
     path('visual/', visviews.chart_view, name='visualization'),
-    path('reddit/', redditviews.redditProcessing, name='reddit_data'),
+    path('visual/data/<str:name>/', visviews.chart_data, name='chart_data'),
+    path('reddit/', redditviews.redditProcessingAsync if settings.ASYNC_VIEWS
+         else redditviews.redditProcessing, name='reddit_data'),
     path('mysearch/', langchainviews.searchQuery, name='search_query'),
-    path('langchain/', langchainviews.redditQuery),
-    path('display/', langchainviews.displayRedditData)
+    path('langchain/', langchainviews.redditQueryAsync if settings.ASYNC_VIEWS
+         else langchainviews.redditQuery),
+    path('display/', langchainviews.displayRedditData),
+    path('metrics', metrics_view, name='metrics'),
 ]
@@ -0,0 +1,309 @@
+import os
+import re
+import glob
+import time
+import atexit
+import logging
+import threading
+from collections import OrderedDict
+from bson import json_util
+from django.conf import settings
+from personalized_webapp.metrics import UPSTREAM_ERRORS, span
+
+logger = logging.getLogger(__name__)
+
+# spill-<writer pid>.jsonl, or .replay-<pid> once a process claimed it.
+SPILL_NAME = re.compile(r'spill-(\d+)\.jsonl(?:\.replay-(\d+))?$')
+
+
+def pidAlive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class BufferFull(Exception):
+    pass
+
+
+class WriteBehindBuffer:
+    # Ingest views hand documents to submit() and return; a flusher thread
+    # coalesces them per target and calls the target's handler with up to
+    # `batchSize` documents once that many are queued or the oldest has
+    # waited `flushInterval` seconds. `capacity` bounds the queued documents:
+    # submit() blocks for room, then raises BufferFull. Documents that cannot
+    # be written (or are still queued at exit) are spilled to `spillDir` as
+    # JSON lines, which the flusher thread replays every `replayInterval`
+    # seconds. Without a spill directory a failing batch is retried
+    # `maxAttempts` times and then dropped.
+
+    def __init__(self, batchSize=1000, flushInterval=0.5, capacity=100000, spillDir=None,
+                 maxAttempts=5, replayInterval=60):
+        self.batchSize = batchSize
+        self.flushInterval = flushInterval
+        self.capacity = capacity
+        self.spillDir = spillDir
+        self.maxAttempts = maxAttempts
+        self.replayInterval = replayInterval
+        self.handlers = {}
+        self._queues = OrderedDict()
+        self._since = {}
+        self._failures = {}
+        self._nextReplay = 0
+        self._size = 0
+        self._inFlight = 0
+        self._condition = threading.Condition()
+        self._thread = None
+        self._pid = None
+        self._closing = False
+
+    def register(self, target, handler):
+        self.handlers[target] = handler
+
+    def _ensureStarted(self):
+        # Started lazily and restarted after a fork, so each worker process
+        # owns its own flusher thread.
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        self._queues.clear()
+        self._since.clear()
+        self._failures.clear()
+        self._size = 0
+        self._closing = False
+        self._pid = os.getpid()
+        # The flusher replays the spills left behind as soon as it starts.
+        self._nextReplay = time.monotonic()
+        self._thread = threading.Thread(target=self._run, name='write-behind', daemon=True)
+        self._thread.start()
+
+    def submit(self, target, documents, timeout=None):
+        if target not in self.handlers:
+            raise KeyError(f'No write-behind handler registered for {target!r}')
+        if not documents:
+            return
+        deadline = time.monotonic() + (settings.WRITE_BEHIND_BLOCK_SECONDS if timeout is None else timeout)
+        with self._condition:
+            self._ensureStarted()
+            while self._size and self._size + len(documents) > self.capacity:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise BufferFull(f'{self._size} documents are waiting to be written')
+                self._condition.wait(remaining)
+            self._enqueue(target, documents)
+            self._condition.notify_all()
+
+    def _enqueue(self, target, documents, front=False):
+        queue = self._queues.setdefault(target, [])
+        if front:
+            queue[:0] = documents
+        else:
+            queue.extend(documents)
+        self._since.setdefault(target, time.monotonic())
+        self._size += len(documents)
+
+    def _due(self, now):
+        for target, queue in self._queues.items():
+            if queue and (self._closing or len(queue) >= self.batchSize or
+                          now - self._since[target] >= self.flushInterval):
+                return target
+        return None
+
+    def _take(self, target):
+        queue = self._queues[target]
+        batch, self._queues[target] = queue[:self.batchSize], queue[self.batchSize:]
+        self._size -= len(batch)
+        self._inFlight += 1
+        if self._queues[target]:
+            self._since[target] = time.monotonic()
+        else:
+            self._since.pop(target, None)
+        self._condition.notify_all()
+        return batch
+
+    def _replayDue(self, now):
+        return bool(self.spillDir) and not self._closing and now >= self._nextReplay
+
+    def _run(self):
+        while True:
+            with self._condition:
+                now = time.monotonic()
+                replay = self._replayDue(now)
+                target = None if replay else self._due(now)
+                while not replay and target is None:
+                    if self._closing and not self._size:
+                        return
+                    deadlines = [since + self.flushInterval for since in self._since.values()]
+                    if self.spillDir and not self._closing:
+                        deadlines.append(self._nextReplay)
+                    wait = max(0, min(deadlines) - time.monotonic()) if deadlines else None
+                    self._condition.wait(wait)
+                    now = time.monotonic()
+                    replay = self._replayDue(now)
+                    target = None if replay else self._due(now)
+                if replay:
+                    # Counted in flight so flush() also waits for the replay.
+                    self._inFlight += 1
+                    self._nextReplay = now + self.replayInterval
+                else:
+                    batch = self._take(target)
+            if replay:
+                try:
+                    self.replaySpill()
+                except Exception:
+                    logger.exception('Replaying write-behind spills failed')
+                finally:
+                    with self._condition:
+                        self._inFlight -= 1
+                        self._condition.notify_all()
+                continue
+            try:
+                self._flush(target, batch)
+            finally:
+                with self._condition:
+                    self._inFlight -= 1
+                    self._condition.notify_all()
+
+    def _flush(self, target, batch):
+        try:
+            with span(f'writebehind.{target}'):
+                self.handlers[target](batch)
+        except Exception:
+            logger.exception('Write-behind flush of %d %s documents failed', len(batch), target)
+            UPSTREAM_ERRORS.labels('mongodb').inc()
+            if self.spillDir:
+                self._spill(target, batch)
+                return
+            failures = self._failures.get(target, 0) + 1
+            if failures >= self.maxAttempts:
+                # Retrying for ever would hold up the target and, once the
+                # queue fills, fail every request with BufferFull.
+                logger.error('Dropping %d %s documents after %d failed writes',
+                             len(batch), target, failures)
+                self._failures.pop(target, None)
+                return
+            self._failures[target] = failures
+            time.sleep(self.flushInterval)
+            with self._condition:
+                self._enqueue(target, batch, front=True)
+        else:
+            self._failures.pop(target, None)
+
+    def flush(self, timeout=None):
+        # Blocks until everything queued so far has been written (or spilled).
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            if self._thread is None:
+                return True
+            self._since.update({target: 0 for target, queue in self._queues.items() if queue})
+            self._condition.notify_all()
+            while self._size or self._inFlight:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+        return True
+
+    def close(self, timeout=None):
+        with self._condition:
+            if self._thread is None or self._pid != os.getpid():
+                return
+            self._closing = True
+            self._condition.notify_all()
+        self._thread.join(timeout)
+        with self._condition:
+            # Whatever the flusher could not finish in time goes to disk.
+            for target, queue in self._queues.items():
+                if queue and self.spillDir:
+                    self._spill(target, queue)
+                elif queue:
+                    logger.error('Dropping %d unwritten %s documents', len(queue), target)
+            self._queues.clear()
+            self._size = 0
+            self._thread = None
+
+    def _spillPath(self):
+        return os.path.join(self.spillDir, f'spill-{os.getpid()}.jsonl')
+
+    def _spill(self, target, documents):
+        os.makedirs(self.spillDir, exist_ok=True)
+        with open(self._spillPath(), 'a') as handle:
+            for document in documents:
+                handle.write(json_util.dumps({'target': target, 'document': document}) + '\n')
+        logger.warning('Spilled %d %s documents to %s', len(documents), target, self._spillPath())
+
+    def _claimable(self, path):
+        # A spill file still written by another live process, or being
+        # replayed by one, is left alone; this process only spills from its
+        # flusher thread, which is the one replaying.
+        match = SPILL_NAME.search(os.path.basename(path))
+        if match is None:
+            return False
+        owner = int(match.group(2) or match.group(1))
+        return owner == os.getpid() or not pidAlive(owner)
+
+    def replaySpill(self):
+        # Writes the spilled documents through their handlers, batchSize at a
+        # time; a batch that fails again is spilled again by _flush. Lines
+        # that cannot be parsed (e.g. cut short by a crash) are skipped.
+        if not self.spillDir:
+            return 0
+        replayed = 0
+        for path in sorted(glob.glob(os.path.join(self.spillDir, 'spill-*'))):
+            if not self._claimable(path):
+                continue
+            # Renaming claims the file, so two workers never replay it twice.
+            claimed = f"{path.split('.replay-')[0]}.replay-{os.getpid()}"
+            try:
+                if claimed != path:
+                    os.replace(path, claimed)
+            except FileNotFoundError:
+                continue
+            batches, count, skipped = {}, 0, 0
+            with open(claimed) as handle:
+                for number, line in enumerate(handle, start=1):
+                    try:
+                        entry = json_util.loads(line)
+                        target, document = entry['target'], entry['document']
+                    except (ValueError, KeyError, TypeError):
+                        skipped += 1
+                        logger.error('Skipping unreadable line %d of %s', number, claimed)
+                        continue
+                    if target not in self.handlers:
+                        skipped += 1
+                        logger.error('No handler to replay spilled %s documents', target)
+                        continue
+                    batch = batches.setdefault(target, [])
+                    batch.append(document)
+                    if len(batch) >= self.batchSize:
+                        self._flush(target, batches.pop(target))
+                    count += 1
+            for target, batch in batches.items():
+                self._flush(target, batch)
+            os.remove(claimed)
+            replayed += count
+            logger.warning('Replayed %d spilled documents from %s (%d lines skipped)',
+                           count, path, skipped)
+        return replayed
+
+
+_buffer = None
+_bufferLock = threading.Lock()
+
+
+def getWriteBehind():
+    global _buffer
+    with _bufferLock:
+        if _buffer is None:
+            _buffer = WriteBehindBuffer(
+                batchSize=settings.WRITE_BEHIND_BATCH_SIZE,
+                flushInterval=settings.WRITE_BEHIND_FLUSH_MS / 1000,
+                capacity=settings.WRITE_BEHIND_CAPACITY,
+                spillDir=settings.WRITE_BEHIND_SPILL_DIR,
+                maxAttempts=settings.WRITE_BEHIND_MAX_ATTEMPTS,
+                replayInterval=settings.WRITE_BEHIND_REPLAY_SECONDS)
+            atexit.register(_buffer.close, settings.WRITE_BEHIND_DRAIN_SECONDS)
+        return _buffer
@@ -0,0 +1,175 @@
+import time
+import asyncio
+import hashlib
+import logging
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from django.conf import settings
+from personalized_webapp.aio import httpClient
+from personalized_webapp.metrics import UPSTREAM_ERRORS
+
+logger = logging.getLogger(__name__)
+
+USER_AGENT = 'APP-NAME by REDDIT-USERNAME'
+
+
+class RedditClient:
+    # One pooled keep-alive session for every Reddit call, plus a per-user
+    # token cache. Concurrent requests for the same expired token wait on a
+    # per-user lock so the password grant only runs once. Beyond maxTokens
+    # users, expired tokens and idle locks are pruned.
+
+    def __init__(self, baseUrl=None, oauthUrl=None, refreshMargin=60, poolSize=20, maxTokens=1024):
+        self.baseUrl = baseUrl or settings.REDDIT_BASE_URL
+        self.oauthUrl = oauthUrl or settings.REDDIT_OAUTH_URL
+        self.refreshMargin = refreshMargin
+        self.maxTokens = maxTokens
+        self.session = requests.Session()
+        self.session.headers['User-Agent'] = USER_AGENT
+        adapter = HTTPAdapter(pool_connections=poolSize, pool_maxsize=poolSize)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self._tokens = {}
+        self._locks = {}
+        self._locksLock = threading.Lock()
+        self._pending = {}
+
+    @staticmethod
+    def _key(username, password):
+        return hashlib.sha256(f'{username}\x00{password}'.encode('utf-8')).hexdigest()
+
+    def _lock(self, key):
+        with self._locksLock:
+            if key not in self._locks and len(self._locks) >= self.maxTokens:
+                # A lock dropped while held only lets a second grant run.
+                self._locks = {other: lock for other, lock in self._locks.items() if lock.locked()}
+            return self._locks.setdefault(key, threading.Lock())
+
+    def _cached(self, key):
+        cached = self._tokens.get(key)
+        if cached and cached[1] - self.refreshMargin > time.monotonic():
+            return cached[0]
+        return None
+
+    def token(self, username, password):
+        key = self._key(username, password)
+        token = self._cached(key)
+        if token:
+            return token
+        with self._lock(key):
+            token = self._cached(key)
+            if token:
+                return token
+            response = self.session.post(
+                self.baseUrl + 'api/v1/access_token',
+                data=self._grant(username, password),
+                auth=(settings.REDDIT_CLIENT_ID, settings.REDDIT_SECRET)
+            )
+            return self._store(key, response.json())
+
+    @staticmethod
+    def _grant(username, password):
+        return {'grant_type': 'password', 'username': username, 'password': password}
+
+    def _store(self, key, response):
+        token = response['access_token']
+        now = time.monotonic()
+        if key not in self._tokens and len(self._tokens) >= self.maxTokens:
+            live = sorted((expires, other) for other, (_, expires) in self._tokens.items() if expires > now)
+            keep = {other for _, other in live[-(self.maxTokens - 1):]} if self.maxTokens > 1 else set()
+            self._tokens = {other: self._tokens[other] for other in keep}
+        self._tokens[key] = (token, now + response.get('expires_in', 3600))
+        return token
+
+    async def atoken(self, username, password):
+        # Async twin of token(): concurrent callers on the same loop await a
+        # single in-flight grant instead of blocking on the thread lock.
+        key = self._key(username, password)
+        token = self._cached(key)
+        if token:
+            return token
+        loop = asyncio.get_running_loop()
+        task = self._pending.get((loop, key))
+        if task is None:
+            task = loop.create_task(self._fetchToken(key, username, password))
+            self._pending[(loop, key)] = task
+            task.add_done_callback(lambda _: self._pending.pop((loop, key), None))
+        return await asyncio.shield(task)
+
+    async def _fetchToken(self, key, username, password):
+        response = await httpClient().post(
+            self.baseUrl + 'api/v1/access_token',
+            data=self._grant(username, password),
+            auth=(settings.REDDIT_CLIENT_ID or '', settings.REDDIT_SECRET or ''),
+            headers={'User-Agent': USER_AGENT})
+        return self._store(key, response.json())
+
+    def invalidate(self, username, password, token=None):
+        # With `token`, only forgets it if it is still the cached one, so
+        # callers rejected with the same token trigger a single new grant.
+        key = self._key(username, password)
+        cached = self._tokens.get(key)
+        if cached and (token is None or token.split(' ')[-1] == cached[0]):
+            self._tokens.pop(key, None)
+
+    def refresh(self, username, password, token=None):
+        # The authorization to retry with after Reddit answered 401 to `token`.
+        self.invalidate(username, password, token)
+        return 'bearer ' + self.token(username, password)
+
+    async def arefresh(self, username, password, token=None):
+        self.invalidate(username, password, token)
+        return 'bearer ' + await self.atoken(username, password)
+
+    def get(self, path, token, credentials=None, **kwargs):
+        # With the (username, password) the token was granted for, a 401 is
+        # retried once with a new token.
+        headers = {'Authorization': token}
+        headers.update(kwargs.pop('headers', {}))
+        response = self.session.get(self.oauthUrl + path, headers=headers, **kwargs)
+        if response.status_code == 401 and credentials:
+            headers = dict(headers, Authorization=self.refresh(*credentials, token))
+            response = self.session.get(self.oauthUrl + path, headers=headers, **kwargs)
+        return response
+
+    async def aget(self, path, token, credentials=None, **kwargs):
+        headers = {'Authorization': token, 'User-Agent': USER_AGENT}
+        headers.update(kwargs.pop('headers', {}))
+        response = await httpClient().get(self.oauthUrl + path, headers=headers, **kwargs)
+        if response.status_code == 401 and credentials:
+            headers = dict(headers, Authorization=await self.arefresh(*credentials, token))
+            response = await httpClient().get(self.oauthUrl + path, headers=headers, **kwargs)
+        return response
+
+
+_client = None
+_clientLock = threading.Lock()
+
+
+def getRedditClient():
+    global _client
+    with _clientLock:
+        if _client is None:
+            _client = RedditClient()
+        return _client
+
+
+def authorization(body):
+    try:
+        token = getRedditClient().token(body['username'], body['password'])
+    except Exception:
+        logger.warning('Reddit token request failed for %s', body.get('username'), exc_info=True)
+        UPSTREAM_ERRORS.labels('reddit').inc()
+        return 'error'
+    return 'bearer ' + token
+
+
+async def aauthorization(body):
+    try:
+        token = await getRedditClient().atoken(body['username'], body['password'])
+    except Exception:
+        logger.warning('Reddit token request failed for %s', body.get('username'), exc_info=True)
+        UPSTREAM_ERRORS.labels('reddit').inc()
+        return 'error'
+    return 'bearer ' + token
@@ -0,0 +1,149 @@
+import asyncio
+import random
+import httpx
+from django.conf import settings
+from personalized_webapp.aio import runBlocking
+from personalized_webapp.ingestion import bulkUpsert
+from redditInfo.client import USER_AGENT
+from langchainbot.searchcache import bumpSearchVersion
+from personalized_webapp.metrics import UPSTREAM_ERRORS
+
+LISTINGS = ('upvoted', 'saved', 'submitted', 'comments')
+PAGE_SIZE = 100
+# Seconds fetchPage may sleep in total for one page, as it runs inside a
+# request.
+MAX_RETRY_SLEEP = 30
+
+
+def postDocument(username, listing, post):
+    data = post['data']
+    document = {
+        'username': username,
+        'thumbnail': data.get('thumbnail'),
+        'url': data.get('url'),
+        'listing': listing,
+        'title': data.get('title', data.get('link_title')),
+        'subreddit': data.get('subreddit'),
+        'subredditType': data.get('subreddit_type'),
+        'author': data.get('author'),
+        'upvote_ratio': data.get('upvote_ratio'),
+        'ups': data.get('ups'),
+        'downs': data.get('downs'),
+        'score': data.get('score'),
+        'created': data.get('created'),
+        'num_comments': data.get('num_comments'),
+        'subreddit_subscribers': data.get('subreddit_subscribers'),
+        'nsfw': data.get('over_18'),
+        'isVideo': data.get('is_video'),
+    }
+    if post.get('kind') == 't1':
+        # A comment is keyed by its own permalink (the natural key includes
+        # the url), and carries the parent link's title and url.
+        document['url'] = settings.REDDIT_BASE_URL.rstrip('/') + data['permalink']
+        document['body'] = data.get('body')
+        document['linkUrl'] = data.get('link_url')
+    return document
+
+
+def quotaExhausted(response):
+    remaining = response.headers.get('x-ratelimit-remaining')
+    try:
+        return remaining is not None and float(remaining) < 1
+    except ValueError:
+        return False
+
+
+def retryDelay(response, attempt):
+    # Reddit sends Retry-After on 429s and x-ratelimit-reset (seconds until
+    # the window resets) on every OAuth response, so they are only waited
+    # for once rate limited; 5xx and transport errors back off exponentially.
+    if response is not None and (response.status_code == 429 or quotaExhausted(response)):
+        for header in ('retry-after', 'x-ratelimit-reset'):
+            value = response.headers.get(header)
+            if value:
+                try:
+                    return float(value)
+                except ValueError:
+                    pass
+    return min(60, 2 ** attempt) + random.random()
+
+
+async def fetchPage(client, semaphore, path, params, maxRetries=5, maxSleep=MAX_RETRY_SLEEP,
+                    refreshToken=None):
+    # refreshToken(rejected) returns a new Authorization header after a 401;
+    # the listings share the client, so only the first of them refreshes.
+    slept = 0
+    refreshed = False
+    for attempt in range(maxRetries + 1):
+        response = None
+        async with semaphore:
+            try:
+                response = await client.get(path, params=params)
+            except httpx.TransportError:
+                UPSTREAM_ERRORS.labels('reddit').inc()
+                if attempt == maxRetries or slept >= maxSleep:
+                    raise
+        if response is not None and response.status_code < 400:
+            if quotaExhausted(response):
+                await asyncio.sleep(min(retryDelay(response, attempt), maxSleep - slept))
+            return response.json()
+        if response is not None and response.status_code == 401 and refreshToken and not refreshed:
+            refreshed = True
+            rejected = response.request.headers.get('Authorization')
+            if client.headers.get('Authorization') == rejected:
+                client.headers['Authorization'] = await refreshToken(rejected)
+            continue
+        if response is not None:
+            UPSTREAM_ERRORS.labels('reddit').inc()
+        if response is not None and response.status_code != 429 and response.status_code < 500:
+            response.raise_for_status()
+        if response is not None and (attempt == maxRetries or slept >= maxSleep):
+            response.raise_for_status()
+        delay = min(retryDelay(response, attempt), maxSleep - slept)
+        slept += delay
+        await asyncio.sleep(delay)
+
+
+async def ingestListing(client, semaphore, collection, username, listing, maxItems=None, timeFilter='all',
+                        refreshToken=None):
+    after = None
+    stored = 0
+    while True:
+        params = {'limit': PAGE_SIZE, 't': timeFilter, 'raw_json': 1}
+        if after:
+            params['after'] = after
+        page = await fetchPage(client, semaphore, f'/user/{username}/{listing}', params,
+                               refreshToken=refreshToken)
+        children = page['data']['children']
+        if maxItems is not None:
+            children = children[:maxItems - stored]
+        if children:
+            documents = [postDocument(username, listing, post) for post in children]
+            await runBlocking(bulkUpsert, collection, documents)
+            stored += len(documents)
+        after = page['data'].get('after')
+        if not after or not children or (maxItems is not None and stored >= maxItems):
+            return stored
+
+
+async def ingestUser(collection, username, token, listings=LISTINGS, maxItems=None,
+                     concurrency=4, timeFilter='all', oauthUrl=None, refreshToken=None):
+    # Each listing is paginated sequentially (the after cursor chains pages)
+    # but the listings run concurrently, sharing one connection pool and a
+    # semaphore bounding the number of requests in flight. See fetchPage for
+    # refreshToken.
+    semaphore = asyncio.Semaphore(concurrency)
+    headers = {'Authorization': token, 'User-Agent': USER_AGENT}
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=oauthUrl or settings.REDDIT_OAUTH_URL, headers=headers,
+                                 limits=limits, timeout=30) as client:
+        try:
+            counts = await asyncio.gather(*[
+                ingestListing(client, semaphore, collection, username, listing, maxItems, timeFilter,
+                              refreshToken)
+                for listing in listings
+            ])
+        finally:
+            # Pages stored before a failure count as a change too.
+            await runBlocking(bumpSearchVersion, collection.database, username)
+    return dict(zip(listings, counts))
@@ -1,3 +1,344 @@
-from django.test import TestCase
+import json
+import time
+import httpx
+import asyncio
+import threading
+from unittest import mock
+from asgiref.sync import async_to_sync
+from django.test import RequestFactory, SimpleTestCase, override_settings
+from benchmarks.generate import redditListingPages
+from benchmarks.stubs import FakeReddit
+from langchainbot.searchcache import searchVersion
+from personalized_webapp import aio
+from personalized_webapp.testing import MongoMockMixin
+from redditInfo import client, views
+from redditInfo.client import RedditClient
+from redditInfo import ingest
+from redditInfo.ingest import fetchPage, ingestUser, postDocument
 
-# Create your tests here.
+
+@override_settings(REDDIT_CLIENT_ID='client', REDDIT_SECRET='secret')
+class RedditClientTests(SimpleTestCase):
+
+    def setUp(self):
+        self.reddit = FakeReddit(redditListingPages(5)).__enter__()
+        self.addCleanup(self.reddit.__exit__)
+
+    def redditClient(self, **kwargs):
+        return RedditClient(baseUrl=self.reddit.url + '/', oauthUrl=self.reddit.url, **kwargs)
+
+    def testCachesTokensPerUser(self):
+        client = self.redditClient()
+        self.assertEqual(client.token('alice', 'pw'), 'benchmark-token')
+        client.token('alice', 'pw')
+        self.assertEqual(self.reddit.requests, 1)
+        client.token('alice', 'other password')
+        self.assertEqual(self.reddit.requests, 2)
+
+    def testRefreshesTokensCloseToExpiry(self):
+        # The stub's tokens live 3600s, all within this refresh margin.
+        client = self.redditClient(refreshMargin=3600)
+        client.token('alice', 'pw')
+        client.token('alice', 'pw')
+        self.assertEqual(self.reddit.requests, 2)
+
+    def testInvalidateForcesANewGrant(self):
+        client = self.redditClient()
+        client.token('alice', 'pw')
+        client.invalidate('alice', 'pw')
+        client.token('alice', 'pw')
+        self.assertEqual(self.reddit.requests, 2)
+
+    def testConcurrentCallersShareOneGrant(self):
+        client = self.redditClient()
+        start = threading.Barrier(8)
+        tokens = []
+
+        def fetch():
+            start.wait()
+            tokens.append(client.token('alice', 'pw'))
+        threads = [threading.Thread(target=fetch) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(tokens, ['benchmark-token'] * 8)
+        self.assertEqual(self.reddit.requests, 1)
+
+    def testAsyncCallersShareOneGrant(self):
+        client = self.redditClient()
+
+        async def fetch():
+            return await asyncio.gather(*[client.atoken('alice', 'pw') for _ in range(8)])
+        self.assertEqual(asyncio.run(fetch()), ['benchmark-token'] * 8)
+        self.assertEqual(self.reddit.requests, 1)
+        self.assertEqual(client._pending, {})
+
+    def testGetFetchesListings(self):
+        client = self.redditClient()
+        token = 'bearer ' + client.token('alice', 'pw')
+        for _ in range(3):
+            response = client.get('/user/alice/upvoted', token)
+            self.assertEqual(len(response.json()['data']['children']), 5)
+        self.assertEqual(self.reddit.requests, 4)
+
+
+@override_settings(REDDIT_CLIENT_ID='client', REDDIT_SECRET='secret')
+class PaginatedIngestTests(MongoMockMixin, SimpleTestCase):
+
+    def setUp(self):
+        super().setUp()
+        # Five posts per listing, served two per page.
+        self.reddit = FakeReddit(redditListingPages(5, pageSize=2), pageSize=2).__enter__()
+        self.addCleanup(self.reddit.__exit__)
+        self.collection = self.client['redditData']['userRedditData']
+        previous = client._client
+        client._client = RedditClient(baseUrl=self.reddit.url + '/', oauthUrl=self.reddit.url)
+        self.addCleanup(setattr, client, '_client', previous)
+
+    def ingest(self, **kwargs):
+        return asyncio.run(ingestUser(self.collection, 'alice', 'bearer token',
+                                      oauthUrl=self.reddit.url, **kwargs))
+
+    def process(self, **body):
+        body = dict({'username': 'alice', 'password': 'pw', 'paginate': True}, **body)
+        request = RequestFactory().post('/reddit/', json.dumps(body), content_type='application/json')
+        with override_settings(REDDIT_OAUTH_URL=self.reddit.url):
+            return views.redditProcessing(request)
+
+    def testFollowsTheAfterCursor(self):
+        counts = self.ingest(listings=('upvoted', 'saved'))
+        self.assertEqual(counts, {'upvoted': 5, 'saved': 5})
+        # A token grant is not needed; three pages per listing.
+        self.assertEqual(self.reddit.requests, 6)
+        self.assertEqual(self.collection.count_documents({'listing': 'saved'}), 5)
+        self.assertEqual(searchVersion(self.collection.database, 'alice'), 1)
+
+    def testStopsAtMaxItems(self):
+        self.assertEqual(self.ingest(listings=('upvoted',), maxItems=3), {'upvoted': 3})
+        self.assertEqual(self.reddit.requests, 2)
+
+    def testReingestUpsertsInPlace(self):
+        self.ingest(listings=('upvoted',))
+        self.ingest(listings=('upvoted',))
+        self.assertEqual(self.collection.count_documents({}), 5)
+
+    def testPaginatedView(self):
+        response = self.process(listings=['comments'])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.collection.count_documents({'listing': 'comments'}), 5)
+
+    def testPaginatedViewReportsRedditErrors(self):
+        error = httpx.ConnectError('connection refused')
+        with mock.patch('redditInfo.views.ingestUser', side_effect=error), \
+                self.assertLogs('redditInfo.views', 'ERROR'):
+            response = self.process()
+        self.assertEqual(response.status_code, 502)
+
+
+@override_settings(REDDIT_CLIENT_ID='client', REDDIT_SECRET='secret')
+class AsyncViewTests(MongoMockMixin, SimpleTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.reddit = FakeReddit(redditListingPages(5, pageSize=2), pageSize=2).__enter__()
+        self.addCleanup(self.reddit.__exit__)
+        self.collection = self.client['redditData']['userRedditData']
+        previous = client._client
+        client._client = RedditClient(baseUrl=self.reddit.url + '/', oauthUrl=self.reddit.url)
+        self.addCleanup(setattr, client, '_client', previous)
+        self.clients = []
+
+    def newClient(self, newClient=aio.newClient):
+        self.clients.append(newClient())
+        return self.clients[-1]
+
+    def process(self, **body):
+        body = dict({'username': 'alice', 'password': 'pw'}, **body)
+        request = RequestFactory().post('/reddit/', json.dumps(body), content_type='application/json')
+        with override_settings(REDDIT_OAUTH_URL=self.reddit.url), \
+                mock.patch.object(aio, 'newClient', self.newClient):
+            return async_to_sync(views.redditProcessingAsync)(request)
+
+    def testStoresUpvotedPosts(self):
+        response = self.process(limit=5)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.collection.count_documents({'listing': 'upvoted'}), 2)
+        # The token grant and the listing shared the request's client.
+        self.assertEqual(len(self.clients), 1)
+        self.assertTrue(self.clients[0].is_closed)
+
+    def testPaginates(self):
+        response = self.process(paginate=True, listings=['saved'])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.collection.count_documents({'listing': 'saved'}), 5)
+
+    def testReportsRedditErrors(self):
+        with mock.patch.object(RedditClient, 'aget', side_effect=httpx.ConnectError('refused')), \
+                self.assertLogs('redditInfo.views', 'ERROR'):
+            response = self.process(limit=5)
+        self.assertEqual(response.status_code, 502)
+        self.assertTrue(self.clients[0].is_closed)
+
+
+class RetryTests(SimpleTestCase):
+
+    def fetch(self, responses, **kwargs):
+        responses = iter(responses)
+
+        def handler(request):
+            response = next(responses)
+            if isinstance(response, Exception):
+                raise response
+            return response
+
+        async def run():
+            sleeps = []
+
+            async def sleep(seconds):
+                sleeps.append(seconds)
+            with mock.patch.object(ingest.asyncio, 'sleep', sleep):
+                async with httpx.AsyncClient(base_url='https://oauth.example',
+                                             transport=httpx.MockTransport(handler)) as client:
+                    page = await fetchPage(client, asyncio.Semaphore(1), '/user/alice/upvoted', {}, **kwargs)
+            return page, sleeps
+        return asyncio.run(run())
+
+    def response(self, status, **headers):
+        return httpx.Response(status, json={'data': {'children': []}}, headers=headers)
+
+    def testServerErrorsBackOffExponentially(self):
+        # x-ratelimit-reset comes with every response; it is not a delay.
+        page, sleeps = self.fetch([self.response(502, **{'x-ratelimit-reset': '600'}),
+                                   httpx.ConnectError('refused'),
+                                   self.response(200, **{'x-ratelimit-reset': '600'})])
+        self.assertEqual(page, {'data': {'children': []}})
+        self.assertEqual(len(sleeps), 2)
+        self.assertTrue(1 <= sleeps[0] < 2 and 2 <= sleeps[1] < 3)
+
+    def testRateLimitsWaitForTheWindow(self):
+        _, sleeps = self.fetch([self.response(429, **{'retry-after': '7'}),
+                                self.response(200, **{'x-ratelimit-remaining': '0', 'x-ratelimit-reset': '4'})])
+        self.assertEqual(sleeps, [7, 4])
+
+    def testTotalSleepIsCapped(self):
+        with self.assertRaises(httpx.HTTPStatusError):
+            self.fetch([self.response(429, **{'retry-after': '20'})] * 6, maxSleep=30)
+        _, sleeps = self.fetch([self.response(429, **{'retry-after': '20'}),
+                                self.response(429, **{'retry-after': '20'}),
+                                self.response(200)], maxSleep=30)
+        self.assertEqual(sleeps, [20, 10])
+
+    def testRefreshesTheTokenOnceOn401(self):
+        refreshed = []
+
+        async def refreshToken(rejected):
+            refreshed.append(rejected)
+            return 'bearer new'
+
+        def handler(request):
+            ok = request.headers['Authorization'] == 'bearer new'
+            return self.response(200 if ok else 401)
+
+        async def run(**kwargs):
+            async with httpx.AsyncClient(base_url='https://oauth.example', headers={'Authorization': 'bearer old'},
+                                         transport=httpx.MockTransport(handler)) as client:
+                return await fetchPage(client, asyncio.Semaphore(1), '/user/alice/upvoted', {}, **kwargs)
+        self.assertEqual(asyncio.run(run(refreshToken=refreshToken)), {'data': {'children': []}})
+        self.assertEqual(refreshed, ['bearer old'])
+        with self.assertRaises(httpx.HTTPStatusError):
+            asyncio.run(run())
+
+    def testGivesUpWhenTheNewTokenIsRejectedToo(self):
+        async def refreshToken(rejected):
+            return 'bearer new'
+        with self.assertRaises(httpx.HTTPStatusError):
+            self.fetch([self.response(401), self.response(401), self.response(200)], refreshToken=refreshToken)
+
+
+class RedditTokenRetryTests(SimpleTestCase):
+
+    def setUp(self):
+        self.client = RedditClient(baseUrl='https://reddit.example/', oauthUrl='https://oauth.reddit.example')
+        self.client._store(self.client._key('alice', 'pw'), {'access_token': 'old'})
+        self.client.session = mock.Mock()
+        self.client.session.post.return_value.json.return_value = {'access_token': 'new'}
+
+    def testRetriesOnceWithANewToken(self):
+        self.client.session.get.side_effect = [mock.Mock(status_code=401), mock.Mock(status_code=200)]
+        response = self.client.get('/user/alice/upvoted', 'bearer old', credentials=('alice', 'pw'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([call.kwargs['headers']['Authorization'] for call in self.client.session.get.call_args_list],
+                         ['bearer old', 'bearer new'])
+        self.assertEqual(self.client.token('alice', 'pw'), 'new')
+
+    def testReturnsTheSecond401(self):
+        self.client.session.get.return_value = mock.Mock(status_code=401)
+        response = self.client.get('/user/alice/upvoted', 'bearer old', credentials=('alice', 'pw'))
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(self.client.session.get.call_count, 2)
+        # Without the credentials the 401 is returned as is.
+        self.client.get('/user/alice/upvoted', 'bearer new')
+        self.assertEqual(self.client.session.get.call_count, 3)
+
+    def testAsyncRetriesOnceWithANewToken(self):
+        grants = []
+
+        def handler(request):
+            if request.method == 'POST':
+                grants.append(request)
+                return httpx.Response(200, json={'access_token': 'new', 'expires_in': 3600})
+            return httpx.Response(200 if request.headers['Authorization'] == 'bearer new' else 401)
+
+        async def run():
+            async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as upstream:
+                with mock.patch.object(client, 'httpClient', lambda: upstream):
+                    return await asyncio.gather(*[
+                        self.client.aget('/user/alice/upvoted', 'bearer old', credentials=('alice', 'pw'))
+                        for _ in range(3)])
+        self.assertEqual([response.status_code for response in asyncio.run(run())], [200] * 3)
+        # The callers rejected with the same token share one grant.
+        self.assertEqual(len(grants), 1)
+
+    def testInvalidateOnlyForgetsTheRejectedToken(self):
+        self.client.invalidate('alice', 'pw', 'bearer stale')
+        self.assertEqual(self.client.token('alice', 'pw'), 'old')
+        self.client.invalidate('alice', 'pw', 'bearer old')
+        self.assertEqual(self.client.token('alice', 'pw'), 'new')
+
+    def testPrunesTokensAndLocks(self):
+        client = RedditClient(baseUrl='https://reddit.example/', oauthUrl='https://oauth.reddit.example',
+                              maxTokens=3)
+        client.session = self.client.session
+        for number in range(10):
+            client.token(f'user{number}', 'pw')
+        self.assertLessEqual(len(client._tokens), 3)
+        self.assertLessEqual(len(client._locks), 3)
+        self.assertEqual(client._cached(client._key('user9', 'pw')), 'new')
+        # Expired tokens go first.
+        client._tokens[client._key('user8', 'pw')] = ('old', time.monotonic() - 1)
+        client.token('user10', 'pw')
+        self.assertNotIn(client._key('user8', 'pw'), client._tokens)
+        self.assertIn(client._key('user9', 'pw'), client._tokens)
+
+
+class PostDocumentTests(SimpleTestCase):
+
+    def testCommentsAreKeyedByTheirPermalink(self):
+        comments = [{'kind': 't1', 'data': {
+            'link_url': 'https://example.com/story', 'link_title': 'Story', 'subreddit': 'python',
+            'permalink': f'/r/python/comments/abc/story/c{number}/', 'body': f'comment {number}'}}
+            for number in range(2)]
+        documents = [postDocument('alice', 'comments', comment) for comment in comments]
+        self.assertEqual([document['url'] for document in documents],
+                         ['https://www.reddit.com/r/python/comments/abc/story/c0/',
+                          'https://www.reddit.com/r/python/comments/abc/story/c1/'])
+        self.assertEqual(documents[1]['body'], 'comment 1')
+        self.assertEqual(documents[1]['linkUrl'], 'https://example.com/story')
+        self.assertEqual(documents[1]['title'], 'Story')
+
+    def testPostsKeepTheirUrl(self):
+        post = {'kind': 't3', 'data': {'url': 'https://example.com/a', 'title': 'A'}}
+        document = postDocument('alice', 'upvoted', post)
+        self.assertEqual(document['url'], 'https://example.com/a')
+        self.assertNotIn('body', document)
@@ -1,73 +1,106 @@
 import json
-import pymongo
+import asyncio
+import logging
+import httpx
 import requests
 from django.conf import settings
 from django.shortcuts import render
 from django.views.decorators.csrf import csrf_exempt
+from redditInfo.client import aauthorization, authorization, getRedditClient
+from personalized_webapp.aio import csrfExemptAsync, runBlocking, scopedHttpClient
+from personalized_webapp.ingestion import bulkUpsert
+from redditInfo.ingest import LISTINGS, ingestUser, postDocument
+from personalized_webapp.metrics import UPSTREAM_ERRORS, span
+from personalized_webapp.mongo import getDatabase
+from langchainbot.searchcache import bumpSearchVersion
 
-my_client = pymongo.MongoClient(settings.MONGO_DB_NAME)
+logger = logging.getLogger(__name__)
 
 
-def authorization(body):
-    REDDIT_DATA = {
-        'grant_type': 'password',
-        'username': body['username'],
-        'password': body['password']
-    }
-    try:
-        REDDIT_AUTH = requests.auth.HTTPBasicAuth(
-            settings.REDDIT_CLIENT_ID, settings.REDDIT_SECRET)
-        response = requests.post(
-            settings.REDDIT_BASE_URL + 'api/v1/access_token',
-            data=REDDIT_DATA,
-            headers={'user-agent': 'APP-NAME by REDDIT-USERNAME'},
-            auth=REDDIT_AUTH
-        )
-        response = response.json()
-    except:
-        return 'error'
-    return 'bearer ' + response['access_token']
+def storeUpvoted(username, children):
+    upvoteData = []
+    for post in children:
+        upvoteData.append(postDocument(username, 'upvoted', post))
+    dbname = getDatabase('redditData')
+    collection_name = dbname["userRedditData"]
+    bulkUpsert(collection_name, upvoteData)
+    bumpSearchVersion(dbname, username)
+    return upvoteData
 
 
 @csrf_exempt
 def redditProcessing(request):
     body = json.loads(request.body)
     username = body['username']
+    with span('reddit.token'):
+        token = authorization(body)
+    if token == 'error':
+        return render(request, 'bookmarks.html', {'data': []}, status=401)
+    if body.get('paginate'):
+        collection = getDatabase('redditData')['userRedditData']
+        try:
+            with span('reddit.ingest'):
+                counts = asyncio.run(ingestUser(
+                    collection, username, token,
+                    listings=body.get('listings', LISTINGS),
+                    maxItems=body.get('maxItems'),
+                    concurrency=settings.REDDIT_INGEST_CONCURRENCY,
+                    refreshToken=lambda rejected: runBlocking(
+                        getRedditClient().refresh, username, body['password'], rejected)))
+        except (httpx.HTTPError, ValueError, KeyError):
+            logger.exception('Could not fetch the listings of %s', username)
+            UPSTREAM_ERRORS.labels('reddit').inc()
+            return render(request, 'bookmarks.html', {'data': []}, status=502)
+        return render(request, 'bookmarks.html', {'data': counts})
     limit = body['limit']
-    token = authorization(body)
-    headers = {
-        'Authorization': token,
-        'User-Agent': 'APP-NAME by REDDIT-USERNAME'
-    }
-    response = requests.get(settings.REDDIT_OAUTH_URL +
-                            f'/user/{username}/upvoted?limit={limit}&t=week', headers=headers)
     try:
-        upvoteData = []
-        for post in response.json()['data']['children']:
-            upvoteData.append(
-                {
-                    'username': username,
-                    'thumbnail': post['data']['thumbnail'],
-                    'url': post['data']['url'],
-                    'listing': 'upvoted',
-                    'title': post['data']['title'],
-                    'subreddit': post['data']['subreddit'],
-                    'subredditType': post['data']['subreddit_type'],
-                    'author': post['data']['author'],
-                    'upvote_ratio': post['data']['upvote_ratio'],
-                    'ups': post['data']['ups'],
-                    'downs': post['data']['downs'],
-                    'score': post['data']['score'],
-                    'created': post['data']['created'],
-                    'num_comments': post['data']['num_comments'],
-                    'subreddit_subscribers': post['data']['subreddit_subscribers'],
-                    'nsfw': post['data']['over_18'],
-                    'isVideo': post['data']['is_video'],
-                }
-            )
-        dbname = my_client['redditData']
-        collection_name = dbname["userRedditData"]
-        collection_name.insert_many(upvoteData)
-    except Exception as e:
-        return e
+        with span('reddit.fetch'):
+            response = getRedditClient().get(
+                f'/user/{username}/upvoted', token, credentials=(username, body['password']),
+                params={'limit': limit, 't': 'week'})
+            response.raise_for_status()
+            children = response.json()['data']['children']
+    except (requests.RequestException, ValueError, KeyError):
+        logger.exception('Could not fetch the upvoted posts of %s', username)
+        UPSTREAM_ERRORS.labels('reddit').inc()
+        return render(request, 'bookmarks.html', {'data': []}, status=502)
+    upvoteData = storeUpvoted(username, children)
+    return render(request, 'bookmarks.html', {'data': upvoteData})
+
+
+@csrfExemptAsync
+@scopedHttpClient
+async def redditProcessingAsync(request):
+    body = json.loads(request.body)
+    username = body['username']
+    with span('reddit.token'):
+        token = await aauthorization(body)
+    if token == 'error':
+        return render(request, 'bookmarks.html', {'data': []}, status=401)
+    try:
+        if body.get('paginate'):
+            collection = getDatabase('redditData')['userRedditData']
+            with span('reddit.ingest'):
+                counts = await ingestUser(
+                    collection, username, token,
+                    listings=body.get('listings', LISTINGS),
+                    maxItems=body.get('maxItems'),
+                    concurrency=settings.REDDIT_INGEST_CONCURRENCY,
+                    refreshToken=lambda rejected: getRedditClient().arefresh(
+                        username, body['password'], rejected))
+            return render(request, 'bookmarks.html', {'data': counts})
+        with span('reddit.fetch'):
+            response = await getRedditClient().aget(
+                f'/user/{username}/upvoted', token, credentials=(username, body['password']),
+                params={'limit': body['limit'], 't': 'week'})
+            response.raise_for_status()
+            children = response.json()['data']['children']
+        upvoteData = await runBlocking(storeUpvoted, username, children)
+    except (httpx.TimeoutException, asyncio.TimeoutError):
+        UPSTREAM_ERRORS.labels('reddit').inc()
+        return render(request, 'bookmarks.html', {'data': []}, status=504)
+    except (httpx.HTTPError, ValueError, KeyError):
+        logger.exception('Could not fetch the upvoted posts of %s', username)
+        UPSTREAM_ERRORS.labels('reddit').inc()
+        return render(request, 'bookmarks.html', {'data': []}, status=502)
     return render(request, 'bookmarks.html', {'data': upvoteData})
@@ -0,0 +1,87 @@
+import numpy as np
+import pandas as pd
+
+# Candidate bucket widths, finest first.
+FREQUENCIES = ['1min', '5min', '15min', '1h', '3h', '6h', '12h', '1D']
+# Series the least visited domains are merged into when there are more
+# domains than the point budget can draw.
+OTHER = 'other'
+
+
+def bucketActivity(activity, budget, frequencies=FREQUENCIES):
+    # activity has 'bucket' (datetime), 'domain', 'visitCount' and
+    # 'domainCount'. Picks the finest width whose (bucket, domain) points fit
+    # the budget and re-aggregates to it; returns the frame and the width.
+    if activity.empty:
+        return activity, frequencies[0]
+    frequency = frequencies[-1]
+    for candidate in frequencies:
+        floored = activity['bucket'].dt.floor(candidate)
+        points = pd.DataFrame({'bucket': floored, 'domain': activity['domain']}).drop_duplicates()
+        if len(points) <= budget:
+            frequency = candidate
+            break
+    bucketed = activity.assign(bucket=activity['bucket'].dt.floor(frequency))
+    bucketed = bucketed.groupby(['bucket', 'domain'], observed=True, as_index=False)[
+        ['visitCount', 'domainCount']].sum()
+    return bucketed, frequency
+
+
+def lttb(x, y, threshold):
+    # Largest-triangle-three-buckets: returns the indices of `threshold`
+    # points that preserve the visual shape of the (x, y) series.
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    edges = np.linspace(1, n - 1, threshold - 1).astype(int)
+    selected = [0]
+    previous = 0
+    for i in range(threshold - 2):
+        start, end = edges[i], edges[i + 1]
+        nextStart, nextEnd = edges[i + 1], edges[i + 2] if i + 2 < len(edges) else n
+        averageX = x[nextStart:nextEnd].mean()
+        averageY = y[nextStart:nextEnd].mean()
+        areas = np.abs((x[previous] - averageX) * (y[start:end] - y[previous])
+                       - (x[previous] - x[start:end]) * (averageY - y[previous]))
+        previous = start + int(np.argmax(areas))
+        selected.append(previous)
+    selected.append(n - 1)
+    return np.array(selected)
+
+
+def foldDomains(activity, keep):
+    # Keeps the `keep` - 1 domains with the most visits and sums the rest
+    # into one OTHER series, leaving `keep` series.
+    totals = activity.groupby('domain', observed=True)['visitCount'].sum()
+    if len(totals) <= keep:
+        return activity
+    top = totals.nlargest(keep - 1).index
+    domain = activity['domain'].astype(object).where(activity['domain'].isin(top), OTHER)
+    return activity.assign(domain=domain).groupby(['bucket', 'domain'], as_index=False)[
+        ['visitCount', 'domainCount']].sum()
+
+
+def downsample(activity, budget):
+    # Splits the budget across domains and thins each domain's series with
+    # LTTB; only used when even the widest bucket exceeds the budget. LTTB
+    # keeps at least 3 points per series, so beyond budget // 3 domains the
+    # smallest are folded into OTHER first.
+    if len(activity) <= budget:
+        return activity
+    activity = foldDomains(activity, max(1, budget // 3))
+    threshold = budget // max(activity['domain'].nunique(), 1)
+    kept = []
+    for _, series in activity.sort_values('bucket').groupby('domain', observed=True):
+        x = series['bucket'].astype('int64').to_numpy()
+        if threshold < 3:
+            kept.append(series.iloc[:threshold])
+            continue
+        kept.append(series.iloc[lttb(x, series['visitCount'].to_numpy(), threshold)])
+    return pd.concat(kept, ignore_index=True)
+
+
+def adaptiveActivity(activity, budget):
+    bucketed, _ = bucketActivity(activity, budget)
+    return downsample(bucketed, budget)
@@ -0,0 +1,76 @@
+import hashlib
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.core.cache import caches
+from visualization.rollups import identityKey
+
+logger = logging.getLogger(__name__)
+
+VERSIONS = 'dataVersions'
+COLLECTIONS = ('history', 'bookmarks', 'downloads')
+ALL_IDENTITIES = '*'
+
+_warmer = ThreadPoolExecutor(max_workers=1)
+
+
+def aliases(identity):
+    if isinstance(identity, dict):
+        return [value for value in (identity.get('email'), identity.get('id')) if value]
+    return [identity] if identity else []
+
+
+def bumpVersion(db, identity, collectionName):
+    # Each identity has its own counter per collection, under identityKey()
+    # like its rollups, and records the email and id it is known by; the '*'
+    # document versions the unscoped dashboard that aggregates every identity.
+    db[VERSIONS].update_one({'identity': identityKey(identity)},
+                            {'$inc': {collectionName: 1},
+                             '$addToSet': {'aliases': {'$each': aliases(identity)}}}, upsert=True)
+    db[VERSIONS].update_one({'identity': ALL_IDENTITIES}, {'$inc': {collectionName: 1}}, upsert=True)
+
+
+def resolveIdentity(db, identity):
+    # The identityKey() of a ?identity= given as either the email or the id
+    # of a profile, so both read the same versions and rollups.
+    if not identity:
+        return None
+    document = db[VERSIONS].find_one({'aliases': identity}, {'identity': 1})
+    return document['identity'] if document else identity
+
+
+def dataVersions(db, identity=None):
+    document = db[VERSIONS].find_one({'identity': identity or ALL_IDENTITIES}) or {}
+    return tuple(document.get(name, 0) for name in COLLECTIONS)
+
+
+def versionTag(*parts):
+    return '"%s"' % hashlib.sha256(repr(parts).encode('utf-8')).hexdigest()[:32]
+
+
+def etagMatches(request, etag):
+    # If-None-Match uses weak comparison; GZipMiddleware and gzip_page turn
+    # strong ETags into W/ ones on compressed responses.
+    header = request.headers.get('If-None-Match', '')
+    tags = [value.strip() for value in header.split(',')]
+    return etag in [tag[2:] if tag.startswith('W/') else tag for tag in tags]
+
+
+def dashboardCache():
+    return caches['dashboard']
+
+
+def warm(db, identity):
+    # Renders the dashboard for the new data version in the background so the
+    # next page load is served from the cache.
+    if not settings.DASHBOARD_WARM_CACHE:
+        return
+
+    def render():
+        from visualization.views import cachedDashboard
+        try:
+            cachedDashboard(db, identityKey(identity))
+        except Exception:
+            logger.exception('Could not warm the dashboard cache')
+
+    _warmer.submit(render)
@@ -0,0 +1,97 @@
+import bson
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+try:
+    from pymongoarrow.api import Schema, aggregate_arrow_all
+except ImportError:
+    aggregate_arrow_all = None
+
+# Declared column types of the projected dashboard documents. Low-cardinality
+# strings are dictionary-encoded and reach pandas as categoricals.
+SCHEMAS = {
+    'history': pa.schema([
+        ('url', pa.string()),
+        ('title', pa.string()),
+        ('lastVisitTime', pa.float64()),
+        ('visitCount', pa.int64()),
+        ('domain', pa.string()),
+    ]),
+    'bookmarks': pa.schema([
+        ('url', pa.string()),
+        ('title', pa.string()),
+        ('dateAdded', pa.float64()),
+        ('domain', pa.string()),
+    ]),
+    'downloads': pa.schema([
+        ('mime', pa.string()),
+        ('danger', pa.string()),
+        ('status', pa.string()),
+        ('referrer', pa.string()),
+        ('referrerDomain', pa.string()),
+        ('endTime', pa.string()),
+    ]),
+}
+DICTIONARY_FIELDS = {
+    'history': ['domain'],
+    'bookmarks': ['domain'],
+    'downloads': ['mime', 'danger', 'status', 'referrerDomain'],
+}
+
+
+def decodeBatch(raw, schema):
+    # One raw BSON batch becomes one record batch; only the declared fields
+    # are kept, so no per-document dicts outlive the batch.
+    columns = {field.name: [] for field in schema}
+    for document in bson.decode_all(raw):
+        for name, values in columns.items():
+            values.append(document.get(name))
+    return pa.RecordBatch.from_arrays(
+        [pa.array(columns[field.name], type=field.type, from_pandas=True) for field in schema],
+        schema=schema)
+
+
+def aggregateTable(collection, pipeline, schema):
+    # Only pymongoarrow (which needs PyMongo 4) skips the per-document dicts;
+    # the fallback still decodes every batch with bson.decode_all.
+    if aggregate_arrow_all is not None:
+        return aggregate_arrow_all(collection, pipeline, schema=Schema(
+            {field.name: field.type for field in schema}))
+    batches = [decodeBatch(raw, schema) for raw in collection.aggregate_raw_batches(pipeline)]
+    return pa.Table.from_batches(batches, schema=schema)
+
+
+def loadTable(collections, pipeline, name):
+    # `collections` is one collection or the month partitions of one (see
+    # queries.windowSources); each is aggregated on its own and the tables
+    # are concatenated.
+    schema = SCHEMAS[name]
+    if not isinstance(collections, (list, tuple)):
+        collections = [collections]
+    tables = [aggregateTable(collection, pipeline, schema) for collection in collections]
+    table = pa.concat_tables(tables) if tables else schema.empty_table()
+    for field in DICTIONARY_FIELDS[name]:
+        index = table.schema.get_field_index(field)
+        table = table.set_column(index, field, pc.dictionary_encode(table.column(field)))
+    return table
+
+
+def arrowTypes(arrowType):
+    if pa.types.is_string(arrowType):
+        return pd.ArrowDtype(arrowType)
+    return None
+
+
+def loadFrame(collections, pipeline, name):
+    table = loadTable(collections, pipeline, name)
+    return table.to_pandas(types_mapper=arrowTypes, split_blocks=True, self_destruct=True)
+
+
+def toPlainFrame(df):
+    # Altair cannot serialize Arrow-backed columns; the aggregated chart
+    # tables are small, so they are converted back to object columns.
+    arrowColumns = [name for name, dtype in df.dtypes.items() if isinstance(dtype, pd.ArrowDtype)]
+    if arrowColumns:
+        df = df.astype({name: object for name in arrowColumns})
+    return df
@@ -0,0 +1,76 @@
+from django.core.management.base import BaseCommand
+from visualization import rollups
+from personalized_webapp import partitions
+from personalized_webapp.mongo import getDatabase
+
+SOURCES = [
+    ('history', rollups.recordHistory, [rollups.ACTIVITY, rollups.TITLES]),
+    ('bookmarks', rollups.recordBookmarks, [rollups.BOOKMARKS]),
+    ('downloads', rollups.recordDownloads, [rollups.DOWNLOADS]),
+]
+# Sources stored with rollups.PENDING marks (see chromepipeline.views).
+PENDING_SOURCES = ('history', 'downloads')
+
+
+class Command(BaseCommand):
+    help = 'Regenerate the dashboard rollup collections from the raw Chrome events.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--include-archive', action='store_true',
+                            help='Also roll up the events moved to the retention archive.')
+        parser.add_argument('--wait-seconds', type=float, default=30,
+                            help='How long to wait for rollup updates already under way.')
+
+    def handle(self, *args, **options):
+        db = getDatabase('userChromeData')
+        # The dashboard reads the raw events until the rebuild has finished.
+        rollups.markBuilt(db, False)
+        # Live updates are paused so no event is counted both by them and by
+        # this scan: events ingested meanwhile stay pending and are counted
+        # once the rollups are rebuilt, and bookmark syncs are retried later.
+        rollups.pauseUpdates(db)
+        try:
+            rollups.releaseClaims([collection for source in PENDING_SOURCES
+                                   for collection in partitions.allCollections(db, source)],
+                                  options['wait_seconds'])
+            for source, record, targets in SOURCES:
+                for target in targets:
+                    db[target].drop()
+                # Recreated here, before any other worker writes again.
+                rollups.resetIndexes()
+                rollups.ensureRollupIndexes(db)
+                batch, total = [], 0
+                for document in self.events(db, source, options):
+                    batch.append(document)
+                    if len(batch) >= options['batch_size']:
+                        record(db, batch)
+                        rollups.pauseUpdates(db)
+                        total += len(batch)
+                        batch = []
+                record(db, batch)
+                total += len(batch)
+                self.stdout.write(self.style.SUCCESS(f'{source}: rolled up {total} documents'))
+            rollups.markBuilt(db)
+        finally:
+            rollups.resumeUpdates(db)
+        for source, record, targets in SOURCES:
+            if source not in PENDING_SOURCES:
+                continue
+            pending = 0
+            for collection in partitions.allCollections(db, source):
+                while True:
+                    recorded = len(rollups.recordPendingIn(db, collection, record))
+                    if not recorded:
+                        break
+                    pending += recorded
+            if pending:
+                self.stdout.write(f'{source}: rolled up {pending} documents ingested meanwhile')
+
+    def events(self, db, source, options):
+        for collection in partitions.allCollections(db, source):
+            # Pending events are counted by the live updates after the rebuild.
+            yield from collection.find({rollups.PENDING: {'$exists': False}}).batch_size(
+                options['batch_size'])
+        if options['include_archive']:
+            yield from partitions.archivedEvents(db, source)
@@ -0,0 +1,111 @@
+import threading
+import pymongo
+from datetime import datetime, timedelta, timezone
+from personalized_webapp import partitions
+
+# Fields each chart reads, projected (and flattened) inside MongoDB.
+HISTORY_FIELDS = {
+    'url': '$data.url',
+    'title': '$data.title',
+    'lastVisitTime': '$data.lastVisitTime',
+    'visitCount': '$data.visitCount',
+    'domain': '$data.domain',
+}
+BOOKMARK_FIELDS = {
+    'url': '$url',
+    'title': '$title',
+    'dateAdded': '$dateAdded',
+    'domain': '$domain',
+}
+DOWNLOAD_FIELDS = {
+    'mime': '$mime',
+    'danger': '$danger',
+    'status': '$status',
+    'referrer': '$referrer',
+    'referrerDomain': '$referrerDomain',
+    'endTime': '$endTime',
+}
+
+# Compound indexes backing the $match stages below.
+QUERY_INDEXES = {
+    'history': 'data.lastVisitTime',
+    'bookmarks': 'dateAdded',
+    'downloads': 'endTime',
+}
+
+# Days shown by each chart.
+WINDOWS = {
+    'history': 10,
+    'bookmarks': 100,
+    'downloads': 10,
+}
+# Downloads are filtered by endTime but partitioned by startTime, so a window
+# also reads the partitions of downloads started up to this many days before.
+PARTITION_SLACK = {
+    'downloads': 7,
+}
+
+_indexed = set()
+_indexedLock = threading.Lock()
+
+
+def createQueryIndexes(collection):
+    timeField = QUERY_INDEXES[partitions.baseName(collection.name)]
+    for identityField in ('identity.email', 'identity.id'):
+        collection.create_index([(identityField, pymongo.ASCENDING),
+                                 (timeField, pymongo.ASCENDING)])
+    collection.create_index([(timeField, pymongo.ASCENDING)])
+
+
+def ensureQueryIndexes(collections):
+    # Each collection (or month partition) is indexed the first time this
+    # process reads it.
+    with _indexedLock:
+        for collection in collections:
+            if collection.name not in _indexed:
+                createQueryIndexes(collection)
+                _indexed.add(collection.name)
+
+
+def windowStart(days):
+    return datetime.now(timezone.utc) - timedelta(days=days)
+
+
+def windowSources(db, name, days=None):
+    # The collections holding the events of the chart window: the month
+    # partitions it overlaps, or the single collection.
+    days = WINDOWS[name] if days is None else days
+    collections = partitions.sources(db, name, windowStart(days + PARTITION_SLACK.get(name, 0)))
+    ensureQueryIndexes(collections)
+    return collections
+
+
+def identityMatch(identity):
+    if not identity:
+        return {}
+    return {'$or': [{'identity.email': identity}, {'identity.id': identity}]}
+
+
+def windowPipeline(identity, timeField, lowerBound, fields):
+    match = {timeField: {'$gte': lowerBound}}
+    match.update(identityMatch(identity))
+    project = {'_id': 0}
+    project.update(fields)
+    return [{'$match': match}, {'$project': project}]
+
+
+def historyPipeline(identity=None, days=WINDOWS['history']):
+    cutoff = int(windowStart(days).timestamp() * 1000)
+    return windowPipeline(identity, 'data.lastVisitTime', cutoff, HISTORY_FIELDS)
+
+
+def bookmarksPipeline(identity=None, days=WINDOWS['bookmarks']):
+    cutoff = int(windowStart(days).timestamp() * 1000)
+    return windowPipeline(identity, 'dateAdded', cutoff, BOOKMARK_FIELDS)
+
+
+def downloadsPipeline(identity=None, days=WINDOWS['downloads']):
+    # endTime is the ISO 8601 string chrome.downloads reports, which sorts
+    # lexicographically in time order.
+    cutoff = windowStart(days).strftime('%Y-%m-%dT%H:%M:%S.000Z')
+    return windowPipeline(identity, 'endTime', cutoff, DOWNLOAD_FIELDS)
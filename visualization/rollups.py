@@ -0,0 +1,303 @@
+import time
+import threading
+import pymongo
+from bson import ObjectId
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from chromepipeline.domains import normalizeUrl
+from personalized_webapp import partitions
+
+ACTIVITY = 'historyActivityRollup'
+TITLES = 'historyTitleRollup'
+BOOKMARKS = 'bookmarkRollup'
+DOWNLOADS = 'downloadRollup'
+# Holds the marker rebuild_rollups leaves once the rollups cover every
+# stored event.
+STATE = 'rollupState'
+# Raw events are stored with PENDING set until their counts are in the
+# rollups, so an update that failed after the insert is finished by the next
+# write (or the retry of the same batch) instead of being lost.
+PENDING = 'rollupPending'
+PENDING_BATCH = 5000
+# rebuild_rollups pauses the incremental updates; the pause lapses after
+# PAUSE_SECONDS unless renewed, so a crashed rebuild does not hold it.
+PAUSE_SECONDS = 600
+
+INDEXES = {
+    ACTIVITY: ['identity', 'bucket', 'domain'],
+    TITLES: ['identity', 'day', 'title'],
+    BOOKMARKS: ['identity', 'day', 'domain'],
+    DOWNLOADS: ['identity', 'day', 'dimension', 'value'],
+}
+
+_indexed = False
+_indexedLock = threading.Lock()
+_pendingIndexed = set()
+
+
+def identityKey(identity):
+    if isinstance(identity, dict):
+        return identity.get('email') or identity.get('id') or ''
+    return identity or ''
+
+
+def fromMillis(value):
+    return datetime.fromtimestamp(value / 1000, tz=timezone.utc).replace(tzinfo=None)
+
+
+def fromIso(value):
+    parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
+def floorMinute(moment):
+    return moment.replace(second=0, microsecond=0)
+
+
+def floorDay(moment):
+    return moment.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def ensureRollupIndexes(db):
+    global _indexed
+    with _indexedLock:
+        if _indexed:
+            return
+        for collectionName, keys in INDEXES.items():
+            db[collectionName].create_index(
+                [(key, pymongo.ASCENDING) for key in keys], unique=True, name='rollup_key')
+        _indexed = True
+
+
+def resetIndexes():
+    # The rollup collections were dropped: create their indexes again on the
+    # next write.
+    global _indexed
+    with _indexedLock:
+        _indexed = False
+        _pendingIndexed.clear()
+
+
+def markBuilt(db, built=True):
+    if built:
+        db[STATE].replace_one({'_id': 'rollups'}, {'builtAt': datetime.utcnow()}, upsert=True)
+    else:
+        db[STATE].delete_one({'_id': 'rollups'})
+
+
+def isBuilt(db):
+    return db[STATE].find_one({'_id': 'rollups'}) is not None
+
+
+def pauseUpdates(db, seconds=PAUSE_SECONDS):
+    until = datetime.utcnow() + timedelta(seconds=seconds)
+    db[STATE].replace_one({'_id': 'paused'}, {'until': until}, upsert=True)
+
+
+def resumeUpdates(db):
+    db[STATE].delete_one({'_id': 'paused'})
+
+
+def updatesPaused(db):
+    return db[STATE].find_one({'_id': 'paused', 'until': {'$gt': datetime.utcnow()}}) is not None
+
+
+def applyCounts(collection, counts, setOnInsert=None):
+    # counts maps a tuple of (field, value) pairs to {field: increment}; a
+    # 'value' given as a tuple of pairs is stored as a subdocument.
+    if not counts:
+        return
+    operations = []
+    for key, increments in counts.items():
+        key = {field: dict(value) if field == 'value' else value for field, value in key}
+        update = {'$inc': increments}
+        if setOnInsert:
+            update['$setOnInsert'] = setOnInsert(key)
+        operations.append(pymongo.UpdateOne(key, update, upsert=True))
+    collection.bulk_write(operations, ordered=False)
+
+
+def recordHistory(db, records, sign=1):
+    ensureRollupIndexes(db)
+    activity, titles = {}, {}
+    for record in records:
+        item = record['data']
+        if item.get('lastVisitTime') is None:
+            continue
+        identity = identityKey(record.get('identity'))
+        moment = fromMillis(item['lastVisitTime'])
+        domain = item.get('domain')
+        if domain is None:
+            domain = normalizeUrl(item.get('url'))[0]
+        visits = item.get('visitCount', 0) * sign
+        key = (('identity', identity), ('bucket', floorMinute(moment)), ('domain', domain))
+        counts = activity.setdefault(key, Counter())
+        counts['visitCount'] += visits
+        counts['visits'] += sign
+        key = (('identity', identity), ('day', floorDay(moment)), ('title', item.get('title', '')))
+        titles.setdefault(key, Counter())['visitCount'] += visits
+    applyCounts(db[ACTIVITY], activity)
+    applyCounts(db[TITLES], titles)
+
+
+def recordBookmarks(db, documents, sign=1):
+    ensureRollupIndexes(db)
+    counts = {}
+    for document in documents:
+        if document.get('dateAdded') is None:
+            continue
+        domain = document.get('domain')
+        if domain is None:
+            domain = normalizeUrl(document.get('url'))[0]
+        key = (('identity', identityKey(document.get('identity'))),
+               ('day', floorDay(fromMillis(document['dateAdded']))),
+               ('domain', domain))
+        counts.setdefault(key, Counter())['count'] += sign
+    applyCounts(db[BOOKMARKS], counts,
+                setOnInsert=lambda key: {'dayOfWeek': key['day'].strftime('%A')})
+
+
+def downloadDimensions(document):
+    referrer = document.get('referrerDomain')
+    if referrer is None:
+        referrer = normalizeUrl(document.get('referrer'))[0]
+    return [
+        ('mime', {'mime': document.get('mime')}),
+        ('dangerStatus', {'danger': document.get('danger'), 'status': document.get('status')}),
+        ('referrer', {'referrer': referrer}),
+    ]
+
+
+def recordDownloads(db, documents, sign=1):
+    ensureRollupIndexes(db)
+    counts = {}
+    for document in documents:
+        if not document.get('endTime'):
+            continue
+        day = floorDay(fromIso(document['endTime']))
+        identity = identityKey(document.get('identity'))
+        for dimension, value in downloadDimensions(document):
+            key = (('identity', identity), ('day', day), ('dimension', dimension),
+                   ('value', tuple(value.items())))
+            counts.setdefault(key, Counter())['count'] += sign
+    applyCounts(db[DOWNLOADS], counts)
+
+
+def markPending(documents):
+    for document in documents:
+        document[PENDING] = True
+    return documents
+
+
+def ensurePendingIndex(collection):
+    with _indexedLock:
+        if collection.full_name in _pendingIndexed:
+            return
+        _pendingIndexed.add(collection.full_name)
+    collection.create_index([(PENDING, pymongo.ASCENDING)], name='rollup_pending',
+                            partialFilterExpression={PENDING: {'$exists': True}})
+
+
+def recordPendingIn(db, collection, record):
+    # Claims up to PENDING_BATCH pending events under a fresh id, so two
+    # workers never count the same event, and clears the mark once `record`
+    # has counted them; on failure they are pending again.
+    ensurePendingIndex(collection)
+    ids = [document['_id'] for document in
+           collection.find({PENDING: True}, {'_id': 1}).limit(PENDING_BATCH)]
+    if not ids:
+        return []
+    claim = ObjectId()
+    collection.update_many({'_id': {'$in': ids}, PENDING: True}, {'$set': {PENDING: claim}})
+    if updatesPaused(db):
+        # Checked after claiming: rebuild_rollups pauses, then waits for the
+        # claims taken before that, so nothing is counted while it scans.
+        collection.update_many({PENDING: claim}, {'$set': {PENDING: True}})
+        return []
+    claimed = list(collection.find({PENDING: claim}, {PENDING: 0}))
+    try:
+        record(db, claimed)
+    except Exception:
+        collection.update_many({PENDING: claim}, {'$set': {PENDING: True}})
+        raise
+    collection.update_many({PENDING: claim}, {'$unset': {PENDING: ''}})
+    return claimed
+
+
+def releaseClaims(collections, timeout):
+    # Waits up to `timeout` seconds for the updates that claimed events to
+    # finish; claims still held then belong to workers that died, and their
+    # events are made pending again.
+    deadline = time.monotonic() + timeout
+    held = {PENDING: {'$exists': True, '$ne': True}}
+    while True:
+        holding = [collection for collection in collections if collection.find_one(held, {'_id': 1})]
+        if not holding or time.monotonic() >= deadline:
+            break
+        time.sleep(0.5)
+    for collection in holding:
+        collection.update_many(held, {'$set': {PENDING: True}})
+
+
+def recordPending(db, name, record, documents):
+    # Counts the pending events of the collections `documents` were stored
+    # in: the new ones and any an earlier failed update left behind. Returns
+    # the events counted.
+    collections = {}
+    for document in documents:
+        for collection in partitions.holders(db, name, document):
+            collections[collection.name] = collection
+    recorded = []
+    for collection in collections.values():
+        recorded.extend(recordPendingIn(db, collection, record))
+    return recorded
+
+
+def windowMatch(identity, field, days):
+    match = {field: {'$gte': datetime.utcnow() - timedelta(days=days)}}
+    if identity:
+        match['identity'] = identity
+    return match
+
+
+def activityRows(db, identity=None, days=10):
+    return list(db[ACTIVITY].aggregate([
+        {'$match': windowMatch(identity, 'bucket', days)},
+        {'$group': {'_id': {'bucket': '$bucket', 'domain': '$domain'},
+                    'visitCount': {'$sum': '$visitCount'}, 'domainCount': {'$sum': '$visits'}}},
+        {'$match': {'domainCount': {'$gt': 0}}},
+        {'$project': {'_id': 0, 'bucket': '$_id.bucket', 'domain': '$_id.domain',
+                      'visitCount': 1, 'domainCount': 1}},
+    ]))
+
+
+def titleRows(db, identity=None, days=10):
+    return list(db[TITLES].aggregate([
+        {'$match': windowMatch(identity, 'day', days)},
+        {'$group': {'_id': '$title', 'visitCount': {'$sum': '$visitCount'}}},
+        {'$project': {'_id': 0, 'title': '$_id', 'visitCount': 1}},
+    ]))
+
+
+def bookmarkRows(db, identity=None, days=100):
+    return list(db[BOOKMARKS].aggregate([
+        {'$match': windowMatch(identity, 'day', days)},
+        {'$group': {'_id': {'dayOfWeek': '$dayOfWeek', 'domain': '$domain'},
+                    'domainCount': {'$sum': '$count'}}},
+        {'$match': {'domainCount': {'$gt': 0}}},
+        {'$project': {'_id': 0, 'dayOfWeek': '$_id.dayOfWeek', 'domain': '$_id.domain',
+                      'domainCount': 1}},
+    ]))
+
+
+def downloadRows(db, dimension, identity=None, days=10):
+    match = windowMatch(identity, 'day', days)
+    match['dimension'] = dimension
+    rows = db[DOWNLOADS].aggregate([
+        {'$match': match},
+        {'$group': {'_id': '$value', 'count': {'$sum': '$count'}}},
+        {'$match': {'count': {'$gt': 0}}},
+    ])
+    return [dict(row['_id'], count=row['count']) for row in rows]
@@ -1,3 +1,317 @@
-from django.test import TestCase
+import io
+import functools
+from datetime import datetime, timedelta
+import numpy as np
+import pandas as pd
+from unittest import mock
+from mongomock.collection import Collection
+from django.conf import settings
+from django.core.management import call_command
+from django.http import Http404
+from django.test import RequestFactory, SimpleTestCase, override_settings
+from benchmarks import generate
+from chromepipeline import views as chromeViews
+from chromepipeline.bookmarks import syncBookmarks
+from chromepipeline.domains import annotate
+from chromepipeline.stream import RetryLater
+from personalized_webapp import partitions
+from personalized_webapp.ingestion import bulkUpsert
+from personalized_webapp.testing import MongoMockMixin, aggregateRawBatches
+from visualization import bucketing, cache, columnar, queries, rollups, views
+from visualization.management.commands import rebuild_rollups
+from visualization.views import dashboardSource, dashboardTag, rawChartData, rollupChartData
 
-# Create your tests here.
+
+class DashboardSourceTests(MongoMockMixin, SimpleTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.db = self.client['userChromeData']
+
+    def testRawUntilRollupsAreBuilt(self):
+        rollups.recordHistory(self.db, [{'identity': {'email': 'a@example.com'}, 'data': {
+            'url': 'https://example.com/', 'title': 'Example', 'lastVisitTime': 1.7e12, 'visitCount': 3}}])
+        # Incremental rollups alone miss the events stored before them.
+        self.assertEqual(dashboardSource(self.db), 'raw')
+        call_command('rebuild_rollups', stdout=io.StringIO())
+        self.assertEqual(dashboardSource(self.db), 'rollups')
+
+    def testRebuildClearsTheMarkerWhileRunning(self):
+        rollups.markBuilt(self.db)
+        seen = []
+
+        def record(db, records, sign=1):
+            seen.append(dashboardSource(db))
+        with mock.patch.object(rebuild_rollups, 'SOURCES', [('history', record, [])]):
+            call_command('rebuild_rollups', stdout=io.StringIO())
+        self.assertEqual(seen, ['raw'])
+        self.assertTrue(rollups.isBuilt(self.db))
+
+    def testRebuildRecreatesTheDroppedIndexes(self):
+        rollups.recordHistory(self.db, [{'identity': {'email': 'a@example.com'}, 'data': {
+            'url': 'https://example.com/', 'title': 'Example', 'lastVisitTime': 1.7e12, 'visitCount': 3}}])
+        call_command('rebuild_rollups', stdout=io.StringIO())
+        for collectionName in rollups.INDEXES:
+            self.assertIn('rollup_key', self.db[collectionName].index_information())
+
+    @override_settings(DASHBOARD_SOURCE='raw')
+    def testRawWhenConfigured(self):
+        rollups.markBuilt(self.db)
+        self.assertEqual(dashboardSource(self.db), 'raw')
+
+
+class DashboardVersionTests(MongoMockMixin, SimpleTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.db = self.client['userChromeData']
+        self.identity = {'email': 'a@example.com', 'id': '1234'}
+
+    def testIdentityAliasesShareVersions(self):
+        cache.bumpVersion(self.db, self.identity, 'history')
+        cache.bumpVersion(self.db, self.identity, 'bookmarks')
+        for alias in ('a@example.com', '1234'):
+            identity = cache.resolveIdentity(self.db, alias)
+            self.assertEqual(identity, 'a@example.com')
+            self.assertEqual(cache.dataVersions(self.db, identity), (1, 1, 0))
+        self.assertEqual(cache.dataVersions(self.db), (1, 1, 0))
+        self.assertEqual(cache.resolveIdentity(self.db, 'unknown'), 'unknown')
+        self.assertIsNone(cache.resolveIdentity(self.db, ''))
+
+    def testTagChangesWithTheDay(self):
+        tag = dashboardTag(self.db, 'a@example.com', 2000, 'raw')
+        self.assertEqual(dashboardTag(self.db, 'a@example.com', 2000, 'raw'), tag)
+        with mock.patch('visualization.views.datetime') as clock:
+            clock.utcnow.return_value = datetime.utcnow() + timedelta(days=1)
+            self.assertNotEqual(dashboardTag(self.db, 'a@example.com', 2000, 'raw'), tag)
+
+
+@override_settings(DASHBOARD_WARM_CACHE=False, WRITE_BEHIND=False, DASHBOARD_SOURCE='raw')
+class ChartDataTests(MongoMockMixin, SimpleTestCase):
+
+    def setUp(self):
+        super().setUp()
+        cache.dashboardCache().clear()
+        self.db = self.client['userChromeData']
+        self.identity = generate.identity(0)
+        chromeViews.storeRoutine({'routine': 'periodicHistory', 'data': {
+            'history': list(generate.historyItems(20, days=7)), 'identity': self.identity}})
+        for download in generate.downloadItems(10, days=7):
+            chromeViews.storeDownload({'download': download})
+
+    def get(self, name, etag=None, **params):
+        headers = {'HTTP_IF_NONE_MATCH': etag} if etag else {}
+        return views.chart_data(RequestFactory().get(f'/visual/data/{name}/', params, **headers), name)
+
+    def testComputesOnlyTheRequestedCollection(self):
+        with mock.patch.object(views, 'rawChartData', wraps=views.rawChartData) as query:
+            response = self.get('mime')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(query.call_args.args[2], ('downloads',))
+            # The other datasets of the same collection were cached with it.
+            self.assertEqual(self.get('danger').status_code, 200)
+            self.assertEqual(query.call_count, 1)
+            self.get('activity')
+            self.assertEqual(query.call_args.args[2], ('history',))
+        self.assertEqual(response['Content-Type'], 'application/json')
+        self.assertTrue(response.content.startswith(b'['))
+
+    def testServesTheRenderedDashboard(self):
+        views.cachedDashboard(self.db)
+        with mock.patch.object(views, 'chartDatasets') as render:
+            self.assertEqual(self.get('titles').status_code, 200)
+        render.assert_not_called()
+
+    def testNotModifiedWithoutRendering(self):
+        etag = self.get('referrer')['ETag']
+        cache.dashboardCache().clear()
+        with mock.patch.object(views, 'chartDatasets') as render:
+            response = self.get('referrer', etag=f'W/{etag}')
+        render.assert_not_called()
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        # A new data version changes the tag.
+        chromeViews.storeDownload({'download': next(generate.downloadItems(1, seed=1, days=7))})
+        self.assertEqual(self.get('referrer', etag=etag).status_code, 200)
+
+    def testVersionedUrlsAreImmutable(self):
+        etag = dashboardTag(self.db, None, settings.ACTIVITY_POINT_BUDGET, 'raw')
+        response = self.get('mime', v=etag.strip('"'))
+        self.assertEqual(response['Cache-Control'], 'private, max-age=31536000, immutable')
+        self.assertEqual(self.get('mime', v='stale')['Cache-Control'], 'private, no-cache')
+        self.assertEqual(self.get('mime')['Cache-Control'], 'private, no-cache')
+
+    def testUnknownDatasetIsNotFound(self):
+        with self.assertRaises(Http404):
+            self.get('unknown')
+
+
+@override_settings(DASHBOARD_WARM_CACHE=False, WRITE_BEHIND=False)
+class RollupConsistencyTests(MongoMockMixin, SimpleTestCase):
+    # Events within the last week, so the daily rollup windows and the exact
+    # raw windows cover the same events.
+
+    def setUp(self):
+        super().setUp()
+        self.db = self.client['userChromeData']
+        self.identity = generate.identity(0)
+
+    def ingest(self, seed=0):
+        chromeViews.storeRoutine({'routine': 'periodicHistory', 'data': {
+            'history': list(generate.historyItems(60, seed, days=7)), 'identity': self.identity}})
+        for download in generate.downloadItems(20, seed, days=7):
+            chromeViews.storeDownload({'download': download})
+
+    def assertSameCharts(self):
+        def ordered(frame, columns):
+            # Categorical columns sort by their categories, which differ.
+            frame = frame[columns].copy()
+            for column in columns:
+                if not pd.api.types.is_numeric_dtype(frame[column]):
+                    frame[column] = frame[column].astype(str)
+            return frame.sort_values(columns).reset_index(drop=True)
+        raw, rolled = rawChartData(), rollupChartData()
+        for name, frame in raw.items():
+            columns = list(frame.columns)
+            expected, actual = ordered(frame, columns), ordered(rolled[name], columns)
+            pd.testing.assert_frame_equal(actual, expected, check_dtype=False, obj=name)
+
+    def testIngestAndRebuildAgree(self):
+        chromeViews.storeRoutine({'routine': 'periodicBookmarks', 'data': {
+            'bookmarks': generate.bookmarkTree(30, days=60), 'identity': self.identity}})
+        self.ingest()
+        self.assertSameCharts()
+        call_command('rebuild_rollups', stdout=io.StringIO())
+        self.assertSameCharts()
+        self.ingest(seed=1)
+        self.assertSameCharts()
+
+    def testEventsIngestedDuringARebuildAreCountedOnce(self):
+        self.ingest()
+        rollups.pauseUpdates(self.db)
+        self.ingest(seed=1)
+        self.assertEqual(self.db['history'].count_documents({rollups.PENDING: True}), 60)
+        with self.assertRaises(RetryLater):
+            chromeViews.storeRoutine({'routine': 'periodicBookmarks', 'data': {
+                'bookmarks': generate.bookmarkTree(5), 'identity': self.identity}})
+        rollups.resumeUpdates(self.db)
+
+        def scanThenIngest(db, records, sign=1):
+            # Events arriving while the rebuild scans are left for afterwards.
+            if records and not scanThenIngest.done:
+                scanThenIngest.done = True
+                self.ingest(seed=2)
+            rollups.recordHistory(db, records, sign)
+        scanThenIngest.done = False
+        sources = [('history', scanThenIngest, [rollups.ACTIVITY, rollups.TITLES])] + rebuild_rollups.SOURCES[1:]
+        with mock.patch.object(rebuild_rollups, 'SOURCES', sources):
+            call_command('rebuild_rollups', stdout=io.StringIO(), wait_seconds=0)
+        self.assertTrue(scanThenIngest.done)
+        self.assertEqual(self.db['history'].count_documents({rollups.PENDING: {'$exists': True}}), 0)
+        self.assertSameCharts()
+
+
+@override_settings(DASHBOARD_WARM_CACHE=False, WRITE_BEHIND=False)
+class ColumnarTests(MongoMockMixin, SimpleTestCase):
+    # Without pymongoarrow, loadFrame decodes the raw BSON batches itself;
+    # its frames must hold what find() returns for the same query.
+
+    def setUp(self):
+        super().setUp()
+        fallback = mock.patch.object(columnar, 'aggregate_arrow_all', None)
+        fallback.start()
+        self.addCleanup(fallback.stop)
+        # Small raw batches, so that results span several of them.
+        batches = mock.patch.object(Collection, 'aggregate_raw_batches',
+                                    functools.partialmethod(aggregateRawBatches, batchSize=7))
+        batches.start()
+        self.addCleanup(batches.stop)
+        self.db = self.client['userChromeData']
+        identity = generate.identity(0)
+        bulkUpsert(self.db['history'], [{'data': annotate(item), 'identity': identity}
+                                        for item in generate.historyItems(60, days=8)])
+        syncBookmarks(self.db, identity, generate.bookmarkTree(40, days=60), bulkUpsert)
+        bulkUpsert(self.db['downloads'], [chromeViews.downloadDocument(download)
+                                          for download in generate.downloadItems(30, days=8)])
+        # Documents missing some of the projected fields.
+        self.db['history'].insert_one({'identity': identity, 'data': {'lastVisitTime': 4.1e12}})
+        self.db['downloads'].insert_one({'identity': identity, 'endTime': '2099-01-01T00:00:00.000Z'})
+
+    def found(self, collections, pipeline, name):
+        match, project = pipeline[0]['$match'], pipeline[1]['$project']
+        documents = [document for collection in collections for document in collection.find(match)]
+        rows = [{field: partitions.getPath(document, path.lstrip('$')) for field, path in project.items()
+                 if field != '_id'} for document in documents]
+        return pd.DataFrame(rows, columns=[field for field in project if field != '_id'])
+
+    def assertSameFrame(self, actual, expected):
+        def plain(frame):
+            frame = columnar.toPlainFrame(frame).astype(object)
+            return frame.where(frame.notna(), None).reset_index(drop=True)
+        pd.testing.assert_frame_equal(plain(actual), plain(expected))
+
+    def compare(self, name, pipeline):
+        collections = queries.windowSources(self.db, name)
+        frame = columnar.loadFrame(collections, pipeline, name)
+        expected = self.found(collections, pipeline, name)
+        self.assertGreater(len(expected), 0)
+        self.assertSameFrame(frame, expected)
+        return frame
+
+    def testMatchesFind(self):
+        history = self.compare('history', queries.historyPipeline())
+        self.assertEqual(len(history), 61)
+        self.assertIsInstance(history['domain'].dtype, pd.CategoricalDtype)
+        self.compare('bookmarks', queries.bookmarksPipeline())
+        downloads = self.compare('downloads', queries.downloadsPipeline())
+        self.assertIsInstance(downloads['referrer'].dtype, pd.ArrowDtype)
+        self.compare('history', queries.historyPipeline(generate.identity(0)['id']))
+
+    def testEmptyWindow(self):
+        frame = columnar.loadFrame([], queries.historyPipeline(), 'history')
+        self.assertEqual(list(frame.columns), list(columnar.SCHEMAS['history'].names))
+        self.assertEqual(len(frame), 0)
+
+    @override_settings(CHROME_STORAGE='monthly')
+    def testConcatenatesPartitions(self):
+        for name in ('history', 'downloads'):
+            for collection in partitions.allCollections(self.db, name):
+                documents = list(collection.find({}, {'_id': 0}))
+                self.db[name].drop()
+                bulkUpsert(self.db[name], documents)
+        self.assertGreater(len(partitions.existing(self.db, 'history')), 0)
+        self.compare('history', queries.historyPipeline())
+        self.compare('downloads', queries.downloadsPipeline())
+
+
+class DownsampleTests(SimpleTestCase):
+
+    def activity(self, domains, buckets):
+        rng = np.random.default_rng(0)
+        start = pd.Timestamp('2024-01-01')
+        rows = [(start + pd.Timedelta(days=day), f'domain{domain}.com', int(rng.integers(1, 50)), 1)
+                for domain in range(domains) for day in range(buckets)]
+        return pd.DataFrame(rows, columns=['bucket', 'domain', 'visitCount', 'domainCount'])
+
+    def testBudgetHoldsWithManyDomains(self):
+        activity = self.activity(5000, 3)
+        sampled = bucketing.adaptiveActivity(activity, 2000)
+        self.assertLessEqual(len(sampled), 2000)
+        # Folding keeps every visit.
+        self.assertEqual(sampled['visitCount'].sum(), activity['visitCount'].sum())
+        self.assertIn(bucketing.OTHER, set(sampled['domain']))
+        self.assertEqual(sampled['domain'].nunique(), 2000 // 3)
+
+    def testKeepsTheMostVisitedDomains(self):
+        activity = self.activity(40, 10)
+        activity.loc[activity['domain'] == 'domain7.com', 'visitCount'] = 1000
+        sampled = bucketing.downsample(activity, 30)
+        self.assertLessEqual(len(sampled), 30)
+        self.assertIn('domain7.com', set(sampled['domain']))
+
+    def testLeavesSmallInputsAlone(self):
+        activity = self.activity(3, 10)
+        self.assertEqual(len(bucketing.downsample(activity, 100)), 30)
+        sampled = bucketing.downsample(activity, 15)
+        self.assertLessEqual(len(sampled), 15)
+        self.assertEqual(set(sampled['domain']), set(activity['domain']))
@@ -1,12 +1,32 @@
-import pymongo
-import pandas as pd
-import altair as alt
+from datetime import datetime
 from django.conf import settings
-from urllib.parse import urlparse
+from chromepipeline.domains import domainColumns
+from visualization import cache, queries, rollups
 from django.views.decorators.csrf import csrf_exempt
-from django.http import HttpResponse
+from django.http import Http404, HttpResponse, HttpResponseNotModified
+from django.urls import reverse
+from django.views.decorators.gzip import gzip_page
+from urllib.parse import urlencode
+from personalized_webapp.metrics import cacheResult, span
+from personalized_webapp.mongo import getDatabase
+from personalized_webapp.lazy import lazyImport
 
-my_client = pymongo.MongoClient(settings.MONGO_DB_NAME)
+# Imported on the first dashboard render rather than at worker startup.
+pd = lazyImport('pandas')
+alt = lazyImport('altair')
+bucketing = lazyImport('visualization.bucketing')
+columnar = lazyImport('visualization.columnar')
+
+
+def storedDomains(df, urlColumn='url', column='domain'):
+    # Domains are normalized at ingest; only documents stored before that
+    # (or never backfilled) are parsed here, once per distinct URL.
+    if column in df.columns and df[column].notna().all():
+        return df[column]
+    parsed, _ = domainColumns(df[urlColumn])
+    if column in df.columns:
+        return df[column].astype(object).fillna(parsed)
+    return parsed
 
 
 def getRecentHistoryData(history_df):
@@ -16,8 +36,7 @@ def getRecentHistoryData(history_df):
         '%d/%m/%Y %H:%M')
     history_df['dmy'] = pd.to_datetime(
         history_df['lastVisitTime'], unit='ms').dt.strftime('%d/%m/%Y')
-    history_df['domain'] = history_df['url'].apply(
-        lambda x: urlparse(x).netloc.split('.')[-2])
+    history_df['domain'] = storedDomains(history_df)
     daysAgo = pd.Timestamp.today() - pd.Timedelta(days=10)
     return history_df[(history_df['lastVisitTime'] >= daysAgo) & (history_df['lastVisitTime'] <= pd.Timestamp.today())]
 
@@ -29,17 +48,16 @@ def getRecentBookmarksData(bookmark_df, days=100):
         '%d/%m/%Y %H:%M')
     bookmark_df['dmy'] = pd.to_datetime(
         bookmark_df['dateAdded'], unit='ms').dt.strftime('%d/%m/%Y')
-    bookmark_df['domain'] = bookmark_df['url'].apply(
-        lambda x: urlparse(x).netloc.split('.')[-2])
+    bookmark_df['domain'] = storedDomains(bookmark_df)
     bookmark_df['dayOfWeek'] = bookmark_df['dateAdded'].dt.day_name()
     daysAgo = pd.Timestamp.today() - pd.Timedelta(days=days)
     return bookmark_df[(bookmark_df['dateAdded'] >= daysAgo) & (bookmark_df['dateAdded'] <= pd.Timestamp.today())]
 
 
 def getRecentDownloadsData(downloads_df):
-    downloads_df['referrer'] = downloads_df['referrer'].apply(
-        lambda x: urlparse(x).netloc.split('.')[-2])
-    downloads_df['endTime'] = pd.to_datetime(downloads_df['endTime'])
+    downloads_df['referrer'] = storedDomains(
+        downloads_df, 'referrer', 'referrerDomain')
+    downloads_df['endTime'] = pd.to_datetime(downloads_df['endTime'], utc=True)
     days_ago = pd.Timestamp.utcnow() - pd.Timedelta(days=10)  # Convert to UTC time
     records_within_10_days = downloads_df[downloads_df['endTime'] >= days_ago]
     records_within_10_days['endTime'] = records_within_10_days['endTime'].dt.strftime(
@@ -47,27 +65,34 @@ def getRecentDownloadsData(downloads_df):
     return records_within_10_days
 
 
-def visitActivity(history_df):
+def visitActivityData(history_df, budget=None):
     records_within_10_days = getRecentHistoryData(history_df)
-    activityPlotData = records_within_10_days.groupby(['timeFormated', 'domain']).agg({
-        'visitCount': 'sum',
-        'domain': 'size'
-    }).rename(columns={'domain': 'domainCount'}).reset_index()
+    activity = pd.DataFrame({
+        'bucket': records_within_10_days['lastVisitTime'],
+        'domain': records_within_10_days['domain'],
+        'visitCount': records_within_10_days['visitCount'],
+        'domainCount': 1,
+    })
+    return bucketing.adaptiveActivity(activity, budget or settings.ACTIVITY_POINT_BUDGET)
 
+
+def visitActivityChart(activityPlotData):
+    # activityPlotData is either a DataFrame or an alt.UrlData reference, so
+    # every encoding declares its type.
     brush = alt.selection_interval()
     color_palette = 'inferno'
     points = alt.Chart(activityPlotData).mark_point(shape='triangle').encode(
-        x=alt.X('timeFormated', title='Date and Time', axis=alt.Axis(
-            labelAngle=60, tickCount=activityPlotData.shape[0] // 10, labelFontSize=8)),
-        y=alt.Y('visitCount').title('Total Current Visits'),
+        x=alt.X('bucket:T', title='Date and Time', axis=alt.Axis(
+            labelAngle=60, labelFontSize=8)),
+        y=alt.Y('visitCount:Q').title('Total Current Visits'),
         color=alt.Color('domain:N', title='Domain name',
                         scale=alt.Scale(scheme=color_palette)),
-        tooltip=alt.Tooltip('timeFormated'),
+        tooltip=alt.Tooltip('bucket:T'),
     ).add_selection(brush).properties(width=400)
 
     bars = alt.Chart(activityPlotData).mark_bar(orient='horizontal').encode(
-        y=alt.Y('domain').title('Domain'),
-        x=alt.X('domainCount').title('Total Visits'),
+        y=alt.Y('domain:N').title('Domain'),
+        x=alt.X('domainCount:Q').title('Total Visits'),
         opacity=alt.value(0.8),
         color=alt.Color('domain:N', title='Domain name',
                         scale=alt.Scale(scheme=color_palette)),
@@ -77,11 +102,18 @@ def visitActivity(history_df):
     return points & bars
 
 
-def mostVisited(history_df, k=10):
+def visitActivity(history_df):
+    return visitActivityChart(visitActivityData(history_df))
+
+
+def mostVisitedData(history_df):
     records_within_10_days = getRecentHistoryData(history_df)
-    titleGroup = records_within_10_days.groupby(['title']).agg({
+    return records_within_10_days.groupby(['title']).agg({
         'visitCount': 'sum',
     }).rename(columns={'domain': 'domainCount'}).reset_index()
+
+
+def mostVisitedChart(titleGroup, k=10):
     return alt.Chart(titleGroup).transform_window(
         rank='rank(visitCount)',
         sort=[alt.SortField('visitCount', order='descending')]
@@ -98,14 +130,25 @@ def mostVisited(history_df, k=10):
     ).interactive()
 
 
-def bookMarksActivity(bookmarks_df):
-    data = getRecentBookmarksData(bookmarks_df).groupby(['dayOfWeek', 'domain']).agg({
+def mostVisited(history_df, k=10):
+    return mostVisitedChart(mostVisitedData(history_df), k)
+
+
+def bookMarksActivityData(bookmarks_df):
+    return getRecentBookmarksData(bookmarks_df).groupby(['dayOfWeek', 'domain'], observed=True).agg({
         'domain': 'sum',
         'domain': 'size'
-    }).rename(columns={'domain': 'domainCount'}).reset_index().sort_values(by='domainCount', ascending=False)
-    top_domains_weekly = (data.groupby('dayOfWeek')
-                          .apply(lambda x: x.nlargest(3, 'domainCount'))
-                          .reset_index(drop=True))
+    }).rename(columns={'domain': 'domainCount'}).reset_index()
+
+
+def topBookmarkedDomains(data):
+    data = data.sort_values(by='domainCount', ascending=False)
+    return (data.groupby('dayOfWeek')
+            .apply(lambda x: x.nlargest(3, 'domainCount'))
+            .reset_index(drop=True))
+
+
+def bookMarksActivityChart(top_domains_weekly):
     color_palette = 'viridis'
     return alt.Chart(top_domains_weekly, title='Top 3 bookmarked domains each day in the past week').mark_bar().encode(
         x=alt.X('dayOfWeek:N', title='Day of Week',
@@ -113,39 +156,48 @@ def bookMarksActivity(bookmarks_df):
         y=alt.Y('domainCount:Q', title='Number of visits'),
         color=alt.Color('domain:N', title='',
                         scale=alt.Scale(scheme=color_palette)),
-        tooltip=['domain', 'domainCount']
+        tooltip=['domain:N', 'domainCount:Q']
     ).properties(width=200, height=300, resolve=alt.Resolve(scale={'color': 'independent'})).interactive()
 
 
+def bookMarksActivity(bookmarks_df):
+    return bookMarksActivityChart(topBookmarkedDomains(bookMarksActivityData(bookmarks_df)))
+
+
+def bookMarksCountsChart(numberOfbookmarks):
+    return alt.Chart(numberOfbookmarks, title='Days vs No. of bookmarks').mark_line().encode(
+        x=alt.X('dayOfWeek:N', title='Day of Week',
+                axis=alt.Axis(labelAngle=0,)),
+        y=alt.Y('count:Q', title='Total bookmarks'),
+    ).properties(width=200, resolve=alt.Resolve(scale={'color': 'independent'}))
+
+
 def bookMarksCounts(bookmarks_df):
     data = getRecentBookmarksData(bookmarks_df)
     numberOfbookmarks = data.groupby(
         'dayOfWeek')['dayOfWeek'].count().reset_index(name='count')
-    return alt.Chart(numberOfbookmarks, title='Days vs No. of bookmarks').mark_line().encode(
-        x=alt.X('dayOfWeek', title='Day of Week',
-                axis=alt.Axis(labelAngle=0,)),
-        y=alt.Y('count', title='Total bookmarks'),
-    ).properties(width=200, resolve=alt.Resolve(scale={'color': 'independent'}))
+    return bookMarksCountsChart(numberOfbookmarks)
 
 
-def mimeInformation(download_df):
+def mimeInformationChart(mime_counts):
     color_palette = 'category20b'
-    mime_counts = download_df['mime'].value_counts().reset_index()
-    mime_counts.columns = ['mime', 'count']
     return alt.Chart(mime_counts, title='Distribution of downloaded file types').mark_arc(innerRadius=50).encode(
-        theta=alt.Theta("count", title="Number of files"),
+        theta=alt.Theta("count:Q", title="Number of files"),
         color=alt.Color("mime:N", title='File type',
                         scale=alt.Scale(scheme=color_palette)),
-        tooltip=[alt.Tooltip('count', title='Number of files'),
-                 alt.Tooltip('mime', title='Type')]
+        tooltip=[alt.Tooltip('count:Q', title='Number of files'),
+                 alt.Tooltip('mime:N', title='Type')]
     ).properties(resolve=alt.Resolve(scale={'color': 'independent'}))
 
 
-def nsfwInformation(download_df):
-    danger = download_df.groupby(['danger', 'status']).agg({
-        'status': 'sum',
-        'status': 'size'
-    }).rename(columns={'status': 'statusCount'}).reset_index().sort_values(by='statusCount', ascending=False)
+def mimeInformation(download_df):
+    mime_counts = download_df['mime'].value_counts().reset_index()
+    mime_counts.columns = ['mime', 'count']
+    mime_counts = mime_counts[mime_counts['count'] > 0]
+    return mimeInformationChart(mime_counts)
+
+
+def nsfwInformationChart(danger):
     color_palette = 'tableau10'
     return alt.Chart(danger, title='File Security and Status Information').mark_bar(opacity=0.8).encode(
         y=alt.Y('status:O', title='', axis=alt.Axis(labelAngle=0,)),
@@ -156,66 +208,254 @@ def nsfwInformation(download_df):
     ).properties(resolve=alt.Resolve(scale={'color': 'independent'}))
 
 
-def referrerInformation(download_df):
-    referrer_df = download_df.groupby(['referrer']).agg({
-        'referrer': 'size',
-    }).rename(columns={'referrer': 'refcount'}).reset_index()
+def nsfwInformation(download_df):
+    danger = download_df.groupby(['danger', 'status'], observed=True).agg({
+        'status': 'sum',
+        'status': 'size'
+    }).rename(columns={'status': 'statusCount'}).reset_index().sort_values(by='statusCount', ascending=False)
+    return nsfwInformationChart(danger)
+
+
+def referrerFrame(referrer_df):
     example = pd.DataFrame([{'referrer': 'yahoo', 'refcount': 2}])
-    referrer_df = pd.concat([referrer_df, example])
+    return pd.concat([referrer_df, example])
+
 
+def referrerInformationChart(referrer_df):
     color_palette = 'set1'
     base = alt.Chart(referrer_df, title='Information about number of downloads associated with a referrer').encode(
         theta=alt.Theta("refcount:Q").stack(True),
-        radius=alt.Radius("refcount").scale(
+        radius=alt.Radius("refcount:Q").scale(
             type="sqrt", zero=True, range=[20, 100]),
         color=alt.Color("referrer:N", title='Referrer',
                         scale=alt.Scale(scheme=color_palette)),
         opacity=alt.value(0.8),
-        tooltip=[alt.Tooltip('refcount', title='Number of visits'), alt.Tooltip(
-            'referrer', title='Referrer')]
+        tooltip=[alt.Tooltip('refcount:Q', title='Number of visits'), alt.Tooltip(
+            'referrer:N', title='Referrer')]
     )
     pie = base.mark_arc(outerRadius=120).properties(
         resolve=alt.Resolve(scale={'color': 'independent'}))
     return pie
 
 
-@csrf_exempt
-def chart_view(request):
-    history_collection = my_client['userChromeData']['history']
-    retrieved = history_collection.find({})
-    history_data = []
-    for histData in retrieved:
-        history_data.append(histData['data'])
-    history_df = pd.DataFrame(history_data)
-
-    uservisitActivity = visitActivity(history_df)
-    userMostVisited = mostVisited(history_df)
+def referrerInformation(download_df):
+    referrer_df = download_df.groupby(['referrer']).agg({
+        'referrer': 'size',
+    }).rename(columns={'referrer': 'refcount'}).reset_index()
+    return referrerInformationChart(referrerFrame(referrer_df))
+
+
+# The collection each dataset is computed from, so that chart_data only has to
+# read one of them on a cache miss.
+DATASET_SOURCES = {
+    'activity': 'history', 'titles': 'history',
+    'bookmarkDomains': 'bookmarks', 'bookmarkCounts': 'bookmarks',
+    'mime': 'downloads', 'danger': 'downloads', 'referrer': 'downloads',
+}
+SOURCES = ('history', 'bookmarks', 'downloads')
+
+
+def rawChartData(identity=None, budget=None, sources=SOURCES):
+    db = getDatabase('userChromeData')
+    data = {}
+    if 'history' in sources:
+        history_df = columnar.loadFrame(
+            queries.windowSources(db, 'history'), queries.historyPipeline(identity), 'history')
+        data['activity'] = visitActivityData(history_df, budget)
+        data['titles'] = mostVisitedData(history_df)
+    if 'bookmarks' in sources:
+        bookmark_df = columnar.loadFrame(
+            queries.windowSources(db, 'bookmarks'), queries.bookmarksPipeline(identity), 'bookmarks')
+        data['bookmarkDomains'] = bookMarksActivityData(bookmark_df)
+        data['bookmarkCounts'] = getRecentBookmarksData(bookmark_df).groupby(
+            'dayOfWeek')['dayOfWeek'].count().reset_index(name='count')
+    if 'downloads' in sources:
+        download_df = columnar.loadFrame(
+            queries.windowSources(db, 'downloads'), queries.downloadsPipeline(identity), 'downloads')
+        download_df = getRecentDownloadsData(download_df)
+        mime_counts = download_df['mime'].value_counts().reset_index()
+        mime_counts.columns = ['mime', 'count']
+        data['mime'] = mime_counts[mime_counts['count'] > 0]
+        data['danger'] = download_df.groupby(
+            ['danger', 'status'], observed=True).size().reset_index(name='statusCount')
+        data['referrer'] = download_df.groupby(['referrer']).size().reset_index(name='refcount')
+    return {name: columnar.toPlainFrame(frame) for name, frame in data.items()}
+
+
+def rollupChartData(identity=None, budget=None, sources=SOURCES):
+    db = getDatabase('userChromeData')
+    data = {}
+    if 'history' in sources:
+        activity = pd.DataFrame(rollups.activityRows(db, identity),
+                                columns=['bucket', 'domain', 'visitCount', 'domainCount'])
+        activity['bucket'] = pd.to_datetime(activity['bucket'])
+        data['activity'] = bucketing.adaptiveActivity(activity, budget or settings.ACTIVITY_POINT_BUDGET)
+        data['titles'] = pd.DataFrame(rollups.titleRows(db, identity), columns=['title', 'visitCount'])
+    if 'bookmarks' in sources:
+        bookmarkDomains = pd.DataFrame(rollups.bookmarkRows(db, identity),
+                                       columns=['dayOfWeek', 'domain', 'domainCount'])
+        data['bookmarkDomains'] = bookmarkDomains
+        data['bookmarkCounts'] = bookmarkDomains.groupby('dayOfWeek', as_index=False)[
+            'domainCount'].sum().rename(columns={'domainCount': 'count'})
+    if 'downloads' in sources:
+        data['mime'] = pd.DataFrame(rollups.downloadRows(db, 'mime', identity), columns=['mime', 'count'])
+        data['danger'] = pd.DataFrame(rollups.downloadRows(db, 'dangerStatus', identity),
+                                      columns=['danger', 'status', 'count']).rename(columns={'count': 'statusCount'})
+        data['referrer'] = pd.DataFrame(rollups.downloadRows(db, 'referrer', identity),
+                                        columns=['referrer', 'count']).rename(columns={'count': 'refcount'})
+    return data
+
+
+def chartFrames(data):
+    # The exact table each chart plots; these are also the datasets served by
+    # chart_data.
+    frames = dict(data)
+    if 'bookmarkDomains' in data:
+        frames['bookmarkDomains'] = topBookmarkedDomains(data['bookmarkDomains'])
+    if 'danger' in data:
+        frames['danger'] = data['danger'].sort_values(by='statusCount', ascending=False)
+    if 'referrer' in data:
+        frames['referrer'] = referrerFrame(data['referrer'])
+    return frames
+
+
+def dashboardChart(frames, urls=None):
+    def source(name):
+        if urls:
+            return alt.UrlData(urls[name], format=alt.DataFormat(type='json'))
+        return frames[name]
+
     historyCharts = alt.vconcat(
-        uservisitActivity, userMostVisited).resolve_scale(color='independent')
-
-    bookmark_collection = my_client['userChromeData']["bookmarks"]
-    retrieved = bookmark_collection.find({})
-    bookmarks_data = []
-    for bookmark in retrieved:
-        bookmarks_data.append(bookmark)
-    bookmark_df = pd.DataFrame(bookmarks_data)
-    stackedBookmarkChart = bookMarksActivity(bookmark_df)
-    countsBookmarksChart = bookMarksCounts(bookmark_df)
+        visitActivityChart(source('activity')),
+        mostVisitedChart(source('titles'))).resolve_scale(color='independent')
     bookmarkCharts = alt.vconcat(
-        stackedBookmarkChart, countsBookmarksChart).resolve_scale(color='independent')
-
-    download_collection = my_client['userChromeData']['downloads']
-    retrieved = download_collection.find({})
-    download_data = []
-    for download in retrieved:
-        download_data.append(download)
-    download_df = pd.DataFrame(download_data)
-    download_df = getRecentDownloadsData(download_df)
-    mimeDataChart = mimeInformation(download_df)
-    dangerDataChart = nsfwInformation(download_df)
-    referrerChart = referrerInformation(download_df)
+        bookMarksActivityChart(source('bookmarkDomains')),
+        bookMarksCountsChart(source('bookmarkCounts'))).resolve_scale(color='independent')
     downloadCharts = alt.vconcat(
-        mimeDataChart, dangerDataChart, referrerChart).resolve_scale(color='independent')
+        mimeInformationChart(source('mime')), nsfwInformationChart(source('danger')),
+        referrerInformationChart(source('referrer'))).resolve_scale(color='independent')
+    return alt.hconcat(historyCharts, bookmarkCharts, downloadCharts)
+
+
+def dataUrl(name, identity, budget, etag):
+    query = urlencode({'identity': identity or '', 'points': budget, 'v': etag.strip('"')})
+    return f"{reverse('chart_data', args=[name])}?{query}"
+
+
+def dashboardSource(db):
+    # The rollups only count the events ingested since they were created, so
+    # they are read once rebuild_rollups has filled them from the raw events.
+    if settings.DASHBOARD_SOURCE == 'rollups' and rollups.isBuilt(db):
+        return 'rollups'
+    return 'raw'
+
+
+def chartDatasets(identity, budget, source, sources=SOURCES):
+    with span('dashboard.query'):
+        if source == 'raw':
+            data = rawChartData(identity, budget, sources)
+        else:
+            data = rollupChartData(identity, budget, sources)
+    with span('dashboard.transform'):
+        frames = chartFrames(data)
+    with span('dashboard.serialize'):
+        datasets = {name: frame.to_json(orient='records', date_format='iso').encode('utf-8')
+                    for name, frame in frames.items()}
+    return frames, datasets
+
+
+def renderDashboard(identity, budget, etag, source):
+    frames, datasets = chartDatasets(identity, budget, source)
+    with span('dashboard.render'):
+        urls = {name: dataUrl(name, identity, budget, etag) for name in frames}
+        html = dashboardChart(frames, urls).to_html()
+    return {'html': html, 'datasets': datasets}
+
+
+def dashboardTag(db, identity, budget, source):
+    # The windows end today, so the tag also changes when the day does.
+    today = datetime.utcnow().date().isoformat()
+    return cache.versionTag(identity, budget, source, today, cache.dataVersions(db, identity))
+
+
+def pointBudget(request):
+    try:
+        return max(10, int(request.GET.get('points', settings.ACTIVITY_POINT_BUDGET)))
+    except ValueError:
+        return settings.ACTIVITY_POINT_BUDGET
+
+
+def cachedDashboard(db, identity=None, budget=None):
+    # The HTML shell only references the datasets by URL; both are cached
+    # together under the ETag of the current data version.
+    budget = budget or settings.ACTIVITY_POINT_BUDGET
+    source = dashboardSource(db)
+    etag = dashboardTag(db, identity, budget, source)
+    state = cache.dashboardCache().get(etag)
+    cacheResult('dashboard', state is not None)
+    if state is None:
+        state = renderDashboard(identity, budget, etag, source)
+        cache.dashboardCache().set(etag, state)
+    return etag, state
+
+
+@csrf_exempt
+def chart_view(request):
+    db = getDatabase('userChromeData')
+    identity = cache.resolveIdentity(db, request.GET.get('identity'))
+    budget = pointBudget(request)
+    with span('dashboard.version'):
+        etag = dashboardTag(db, identity, budget, dashboardSource(db))
+    if cache.etagMatches(request, etag):
+        response = HttpResponseNotModified()
+    else:
+        etag, state = cachedDashboard(db, identity, budget)
+        response = HttpResponse(state['html'], content_type='text/html')
+    response['ETag'] = etag
+    response['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+def cachedDataset(db, identity, budget, etag, source, name):
+    # Served from the rendered dashboard when there is one; otherwise only the
+    # datasets read from the same collection are computed, and cached on
+    # their own so the other requests of the page load share them.
+    state = cache.dashboardCache().get(etag)
+    if state is not None:
+        cacheResult('dashboard', True)
+        return state['datasets'][name]
+    dataTag = cache.versionTag(etag, name)
+    dataset = cache.dashboardCache().get(dataTag)
+    cacheResult('dataset', dataset is not None)
+    if dataset is None:
+        collectionName = DATASET_SOURCES[name]
+        _, datasets = chartDatasets(identity, budget, source, (collectionName,))
+        cache.dashboardCache().set_many({cache.versionTag(etag, other): value
+                                         for other, value in datasets.items()})
+        dataset = datasets[name]
+    return dataset
+
 
-    allCharts = alt.hconcat(historyCharts, bookmarkCharts, downloadCharts)
-    return HttpResponse(allCharts.to_html(), content_type='text/html')
+@gzip_page
+def chart_data(request, name):
+    if name not in DATASET_SOURCES:
+        raise Http404
+    db = getDatabase('userChromeData')
+    identity = cache.resolveIdentity(db, request.GET.get('identity'))
+    budget = pointBudget(request)
+    source = dashboardSource(db)
+    with span('dashboard.version'):
+        etag = dashboardTag(db, identity, budget, source)
+    dataTag = cache.versionTag(etag, name)
+    if cache.etagMatches(request, dataTag):
+        response = HttpResponseNotModified()
+    else:
+        dataset = cachedDataset(db, identity, budget, etag, source, name)
+        response = HttpResponse(dataset, content_type='application/json')
+    response['ETag'] = dataTag
+    if request.GET.get('v') == etag.strip('"'):
+        # The URL names the data version, so its content never changes.
+        response['Cache-Control'] = 'private, max-age=31536000, immutable'
+    else:
+        response['Cache-Control'] = 'private, no-cache'
+    return response